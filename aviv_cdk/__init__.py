@@ -1,5 +1,39 @@
 __version__='0.0.8'
 
+import importlib
+
+# Submodules are loaded on first access (PEP 562): each of them pulls a set of
+# jsii backed aws_cdk packages and `import aviv_cdk` shouldn't pay for all of them.
+_submodules = (
+    'assets',
+    'build_sizing',
+    'cdk_lambda',
+    'coldstart',
+    'core',
+    'iam',
+    'iam_idp',
+    'layers',
+    'pipelines',
+    'policy_compaction',
+    'policy_simulator',
+    'power_tuning',
+    'profiling',
+    'secretsmanager',
+    'ssm_cache',
+    'stepfunctions',
+    'synth'
+)
+
+
+def __getattr__(name: str):
+    if name in _submodules:
+        return importlib.import_module(f"{__name__}.{name}")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_submodules))
+
 
 def __json_load(filename: str) -> dict:
     import json
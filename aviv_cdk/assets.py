@@ -0,0 +1,107 @@
+"""Zero-copy, content hashed lambda assets
+
+aviv_cdk.assets.lambda_code(path) is a drop-in for aws_lambda.Code.from_asset(path):
+
+- the source tree is hashed once per process (until its files change) and
+  given to CDK as a custom asset hash, so CDK doesn't fingerprint it again
+- directories are staged by hard-linking their files into cdk.out (local
+  bundling) instead of copying them, falling back to a copy across devices
+- a zip file is staged as is (single copy by CDK)
+
+CDKLambda uses it when the code of lambda_attrs/layer_attrs is a path (str).
+"""
+import os
+import errno
+import shutil
+import typing
+import jsii
+from aws_cdk import (
+    aws_lambda,
+    core
+)
+from . import incremental
+from .incremental import hash_path
+
+
+_hashes = dict()
+
+
+def _signature(path: str) -> tuple:
+    """Cheap change detection: relative paths, sizes and mtimes"""
+    if not os.path.isdir(path):
+        st = os.stat(path)
+        return (st.st_size, st.st_mtime_ns)
+    signature = list()
+    for root, dirs, files in os.walk(path, followlinks=True):
+        dirs.sort()
+        for name in sorted(files):
+            st = os.stat(os.path.join(root, name))
+            signature.append((os.path.relpath(os.path.join(root, name), path), st.st_size, st.st_mtime_ns))
+    return tuple(signature)
+
+
+def tree_hash(path: str) -> str:
+    """Content hash of a file or directory tree, computed again only when a file changed"""
+    key = os.path.realpath(path)
+    signature = _signature(key)
+    cached = _hashes.get(key)
+    if cached and cached[0] == signature:
+        return cached[1]
+    digest = hash_path(key)
+    _hashes[key] = (signature, digest)
+    return digest
+
+
+def link_tree(src: str, dst: str) -> int:
+    """Recreate src in dst with hard links (copies across devices)
+
+    Symlinks are followed, to files and directories alike: dst holds their content.
+
+    Returns:
+        int: number of files copied instead of linked
+    """
+    copied = 0
+    for root, dirs, files in os.walk(src, followlinks=True):
+        target = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(target, exist_ok=True)
+        for name in files:
+            try:
+                os.link(os.path.join(root, name), os.path.join(target, name))
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+                shutil.copy2(os.path.join(root, name), os.path.join(target, name))
+                copied += 1
+    return copied
+
+
+@jsii.implements(core.ILocalBundling)
+class LinkBundling:
+    """Local 'bundling' hard-linking a source tree into the CDK asset staging directory"""
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def try_bundle(self, output_dir: str, *options, **kwoptions) -> bool:
+        link_tree(self.path, output_dir)
+        return True
+
+
+def lambda_code(path: str, *, scope: core.Construct=None, **options) -> aws_lambda.AssetCode:
+    """aws_lambda.Code.from_asset(path) with a precomputed hash and zero-copy staging for directories
+
+    Args:
+        path (str): directory or zip file
+        scope (core.Construct, optional): records the content hash as an input of its stack (see aviv_cdk.incremental)
+        options: other AssetOptions (exclude, follow...), mind that they aren't part of the hash
+    """
+    options['asset_hash'] = tree_hash(path)
+    if scope is not None:
+        incremental.track(scope, ('file', path, options['asset_hash']))
+    options['asset_hash_type'] = core.AssetHashType.CUSTOM
+    if os.path.isdir(path) and 'bundling' not in options:
+        options['bundling'] = core.BundlingOptions(
+            # Never pulled: local bundling always succeeds
+            image=core.BundlingDockerImage.from_registry('scratch'),
+            local=LinkBundling(path)
+        )
+    return aws_lambda.Code.from_asset(path, **options)
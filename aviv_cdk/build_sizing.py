@@ -0,0 +1,146 @@
+"""CodeBuild compute type sizing from past build durations
+
+The history is a JSON list of builds, either simple records:
+
+    [{"action": "tests", "compute_type": "BUILD_GENERAL1_SMALL", "duration": 840}, ...]
+
+or builds as exported by `aws codebuild batch-get-builds` with an added
+"action" key (compute type from environment.computeType, duration from
+startTime/endTime).
+
+For each action, the duration on the other compute types is estimated from
+the closest measured one (vCPUs ratio, with only a part of the build benefiting from
+more CPUs) and the cheapest compute type meeting the target duration is
+picked, or the fastest one if none does.
+"""
+import re
+import json
+import math
+import logging
+import datetime
+import typing
+
+
+# compute type: (vCPUs, on-demand linux price per build minute in USD)
+SIZES = {
+    'SMALL': (2, 0.005),
+    'MEDIUM': (4, 0.01),
+    'LARGE': (8, 0.02),
+}
+
+
+def _size(compute_type: str) -> str:
+    name = str(compute_type).split('.')[-1].replace('BUILD_GENERAL1_', '')
+    if name not in SIZES:
+        raise ValueError(f"Unsupported compute type: {compute_type}")
+    return name
+
+
+def _timestamp(value) -> float:
+    """Epoch of an epoch or ISO 8601 time (2021-01-20T10:00:00[.123][Z|+00:00])"""
+    if isinstance(value, (int, float)):
+        return float(value)
+    # strptime %z only accepts [+-]HHMM before python 3.7
+    value = re.sub(r'(Z|[+-]\d\d:?\d\d)$', lambda m: '+0000' if m.group(1) == 'Z' else m.group(1).replace(':', ''), value)
+    fmt = '%Y-%m-%dT%H:%M:%S.%f%z' if '.' in value else '%Y-%m-%dT%H:%M:%S%z'
+    return datetime.datetime.strptime(value, fmt).timestamp()
+
+
+def load_history(filename: str) -> typing.Dict[str, typing.Dict[str, typing.List[float]]]:
+    """Load a builds history file
+
+    Returns:
+        dict: action -> compute type (SMALL, MEDIUM, LARGE) -> durations (seconds)
+    """
+    with open(filename) as fp:
+        builds = json.load(fp)
+    if isinstance(builds, dict):
+        builds = builds.get('builds', list())
+    history = dict()
+    for build in builds:
+        if 'duration' in build:
+            duration = float(build['duration'])
+        else:
+            duration = _timestamp(build['endTime']) - _timestamp(build['startTime'])
+        compute_type = build.get('compute_type') or build['environment']['computeType']
+        history.setdefault(build['action'], dict()).setdefault(_size(compute_type), list()).append(duration)
+    return history
+
+
+class ComputeSizer:
+    history: typing.Dict[str, typing.Dict[str, typing.List[float]]]
+    choices: typing.Dict[str, dict]
+
+    def __init__(self, history: typing.Union[str, dict], *, target: int=600, parallel_fraction: float=0.5, percentile: int=90) -> None:
+        """Pick CodeBuild compute types from past build durations
+
+        Args:
+            history (str|dict): history file (see load_history) or its loaded content
+            target (int, optional): target build duration (seconds). Defaults to 600.
+            parallel_fraction (float, optional): part of a build that scales with vCPUs. Defaults to 0.5.
+            percentile (int, optional): durations percentile compared to the target. Defaults to 90.
+        """
+        self.history = load_history(history) if isinstance(history, str) else history
+        self.target = target
+        self.parallel_fraction = parallel_fraction
+        self.percentile = percentile
+        self.choices = dict()
+
+    def _percentile(self, durations: typing.List[float]) -> float:
+        durations = sorted(durations)
+        rank = (len(durations) - 1) * self.percentile / 100
+        low = math.floor(rank)
+        high = min(low + 1, len(durations) - 1)
+        return durations[low] + (durations[high] - durations[low]) * (rank - low)
+
+    def estimates(self, action: str) -> typing.Optional[typing.Dict[str, float]]:
+        """Estimated duration (seconds) of an action per compute type, None without history"""
+        measured = dict((size, self._percentile(durations)) for size, durations in self.history.get(action, dict()).items() if durations)
+        if not measured:
+            return None
+        estimates = dict()
+        for size, (vcpus, _) in SIZES.items():
+            if size in measured:
+                estimates[size] = measured[size]
+            else:
+                # From the closest measured compute type
+                ref = min(measured, key=lambda m: (abs(math.log(SIZES[m][0] / vcpus)), -len(self.history[action][m])))
+                speedup = SIZES[ref][0] / vcpus
+                estimates[size] = measured[ref] * ((1 - self.parallel_fraction) + self.parallel_fraction * speedup)
+        return estimates
+
+    def choose(self, action: str) -> typing.Optional[str]:
+        """Cheapest compute type (SMALL, MEDIUM, LARGE) meeting the target duration for this action
+
+        Returns:
+            str: compute type name, None without history
+        """
+        estimates = self.estimates(action)
+        if not estimates:
+            return None
+        costs = dict((size, math.ceil(duration / 60) * SIZES[size][1]) for size, duration in estimates.items())
+        candidates = [size for size in SIZES if estimates[size] <= self.target]
+        if candidates:
+            choice = min(candidates, key=lambda size: (costs[size], estimates[size]))
+        else:
+            choice = min(SIZES, key=lambda size: estimates[size])
+        self.choices[action] = dict(
+            compute_type=choice,
+            target=self.target,
+            estimated_duration=round(estimates[choice]),
+            estimated_cost=round(costs[choice], 4),
+            estimates=dict((size, round(duration)) for size, duration in estimates.items())
+        )
+        logging.info(f"Compute sizing: {action} -> {choice} (~{round(estimates[choice])}s, target {self.target}s)")
+        return choice
+
+    def compute_type(self, action: str) -> typing.Optional['cb.ComputeType']:
+        """Same as choose() as a codebuild ComputeType"""
+        choice = self.choose(action)
+        if not choice:
+            return None
+        from aws_cdk import aws_codebuild as cb
+        return getattr(cb.ComputeType, choice)
+
+    def report(self) -> dict:
+        return dict(self.choices)
@@ -1,20 +1,78 @@
 import os
-import sys
+import json
+import typing
+import hashlib
 import logging
+import zipfile
 from aws_cdk import (
-    aws_ssm as ssm,
-    aws_events_targets,
-    aws_events,
     aws_lambda,
     core
 )
+from . import assets, incremental, power_tuning
+from .coldstart import minify
+
+# CloudFormation Code.ZipFile limit
+INLINE_LIMIT = 4096
+INLINE_DIR = '.aviv-cdk/inline'
+# Event sent by the warmer rule, handlers can return early on it
+WARMER_EVENT = {'aviv:warmer': True}
+# Runtimes without arm64 (Graviton) support
+NO_ARM64_RUNTIMES = ('python2.7', 'python3.6', 'python3.7', 'nodejs10.x', 'ruby2.5', 'java8', 'go1.x', 'dotnetcore2.1')
+# CDKLambda.performance() presets
+PERFORMANCE_PROFILES = {
+    # Graviton when possible, pay per use
+    'cost': dict(arm64='auto'),
+    # More memory (and CPU), kept warm
+    'latency': dict(arm64='auto', memory_size=1024, warmer=5),
+    # No cold start during office hours
+    'office-hours': dict(arm64='auto', memory_size=1024, provisioned_concurrency=0, provisioned_schedule={
+        'cron(0 7 ? * MON-FRI *)': 2,
+        'cron(0 20 ? * MON-FRI *)': 0
+    }),
+}
+
+
+def _layer_key(layer_attrs: dict) -> str:
+    """Identical layers: same code content and props"""
+    key = dict()
+    for name, value in layer_attrs.items():
+        if isinstance(value, aws_lambda.AssetCode):
+            value = assets.tree_hash(value.path)
+        elif isinstance(value, (list, tuple)):
+            # compatible_runtimes
+            value = [getattr(v, 'name', v) for v in value]
+        key[name] = value
+    return json.dumps(key, sort_keys=True, default=repr)
+
+
+def architecture_neutral(code: aws_lambda.Code) -> bool:
+    """True if the code has no native (compiled) files, so runs on x86_64 and arm64"""
+    if code is None or isinstance(code, aws_lambda.InlineCode):
+        return True
+    if not isinstance(code, aws_lambda.AssetCode):
+        # S3 / ECR code: can't tell
+        return False
+    native = ('.so', '.pyd', '.dylib')
+    if os.path.isdir(code.path):
+        for root, dirs, files in os.walk(code.path):
+            if any(name.endswith(native) or '.so.' in name for name in files):
+                return False
+        return True
+    if zipfile.is_zipfile(code.path):
+        with zipfile.ZipFile(code.path) as zf:
+            return not any(name.endswith(native) or '.so.' in name for name in zf.namelist())
+    return False
+
 
 class CDKLambda(core.Construct):
     _layer = None
     _lambda = None
+    _alias = None
     _assets: dict = None
+    _code: aws_lambda.Code = None
+    _layer_code: aws_lambda.Code = None
 
-    def __init__(self,  scope: core.Construct, id: str, *, lambda_attrs: aws_lambda.FunctionProps=None, layer_attrs=None, remote_account_grant=False, use_layer=True, cfn_outputs=False):
+    def __init__(self,  scope: core.Construct, id: str, *, lambda_attrs: aws_lambda.FunctionProps=None, layer_attrs=None, remote_account_grant=False, use_layer=True, cfn_outputs=False, share_layer=True, optimize_code: typing.Union[bool, dict]=False, export_layer=True):
         """Provides a CDK Construct for AWS Lambda and Layers
 
         Args:
@@ -24,23 +82,50 @@ class CDKLambda(core.Construct):
             layer_attrs (aws_lambda.LayerVersionProps, optional): [description]. Defaults to None.
             remote_account_grant (bool, optional): [description]. Defaults to False.
             use_layer (bool, optional): [description]. Defaults to True.
+            share_layer (bool, optional): reuse an identical layer (code content and props) of the same stack. Defaults to True.
+            optimize_code (bool|dict, optional): pack path (str) codes for cold starts, see aviv_cdk.coldstart.pack (options as a dict). Defaults to False.
+            export_layer (bool, optional): layer ARN SSM parameter, named after the id (/<id>/layer). Defaults to True.
+
+        A code given as a path (str) in lambda_attrs/layer_attrs is staged with aviv_cdk.assets.lambda_code (hashed once, hard-linked).
+        With the 'aviv:power-tuning' context, the memory_size tuned with `aviv-aws tune` (see aviv_cdk.power_tuning) is used when lambda_attrs has none.
         """
         super().__init__(scope, id)
 
         if layer_attrs:
-            self._layer = aws_lambda.LayerVersion(
-                self, "layer",
-                **layer_attrs
-            )
-            ssm_name = "/{}/layer".format(id.replace('-', '/'))
-            ssm.StringParameter(self, 'Layer', string_value=self._layer.layer_version_arn, parameter_name=ssm_name)
-            if remote_account_grant:
+            from aws_cdk import aws_ssm as ssm
+            if isinstance(layer_attrs.get('code'), str):
+                runtimes = layer_attrs.get('compatible_runtimes')
+                layer_attrs = dict(layer_attrs, code=self._path_code(layer_attrs['code'], runtimes[0] if runtimes else None, optimize_code, self))
+            self._layer = self._shared_layer(layer_attrs) if share_layer else None
+            if not self._layer:
+                self._layer = aws_lambda.LayerVersion(
+                    self, "layer",
+                    **layer_attrs
+                )
+                if share_layer:
+                    self._layers()[_layer_key(layer_attrs)] = self._layer
+            self._layer_code = layer_attrs.get('code')
+            if export_layer:
+                ssm_name = "/{}/layer".format(id.replace('-', '/'))
+                ssm.StringParameter(self, 'Layer', string_value=self._layer.layer_version_arn, parameter_name=ssm_name)
+            if remote_account_grant and not self._layer.node.try_find_child('remote-account-grant'):
                 self._layer.add_permission('remote-account-grant', account_id='*')
 
         if lambda_attrs:
+            if isinstance(lambda_attrs.get('code'), str):
+                lambda_attrs = dict(lambda_attrs, code=self._path_code(lambda_attrs['code'], lambda_attrs.get('runtime'), optimize_code, self))
+            tuning_file = power_tuning.enabled(self)
+            tuned = power_tuning.memory_size(self.node.path, tuning_file) if tuning_file else None
+            if tuned and lambda_attrs.get('memory_size'):
+                logging.warning(f"{self.node.path}: memory_size {lambda_attrs['memory_size']} kept over the tuned {tuned}")
+            elif tuned:
+                logging.info(f"{self.node.path}: tuned memory_size {tuned} (was {lambda_attrs.get('memory_size', 128)})")
+                lambda_attrs = dict(lambda_attrs, memory_size=tuned)
+                incremental.track(self, ('power-tuning', tuned))
             self._lambda = aws_lambda.Function(
                 self, "lambda", **lambda_attrs
             )
+            self._code = lambda_attrs.get('code')
             if self._layer and use_layer:
                 self._lambda.add_layers(self._layer)
         if cfn_outputs:
@@ -48,7 +133,101 @@ class CDKLambda(core.Construct):
             if self._layer:
                 core.CfnOutput(self, 'LayerArn', value=self._layer.from_layer_version_arn)
 
-    def _cron(self, event_name: str='Rule', event: dict=None, cron: aws_events.Schedule=None):
+    @staticmethod
+    def _path_code(path: str, runtime: aws_lambda.Runtime=None, optimize_code: typing.Union[bool, dict]=False, scope: core.Construct=None) -> aws_lambda.AssetCode:
+        if not optimize_code or not os.path.isdir(path):
+            return assets.lambda_code(path, scope=scope)
+        if scope is not None:
+            # The source, the packed directory is an asset of its own
+            incremental.track(scope, ('file', path, assets.tree_hash(path)))
+        from . import coldstart
+        options = dict(optimize_code) if isinstance(optimize_code, dict) else dict()
+        if runtime and runtime.name.startswith('python'):
+            options.setdefault('runtime', runtime.name.replace('python', ''))
+        return coldstart.packed_code(path, **options)
+
+    def _layers(self) -> dict:
+        """Layers created by CDKLambda constructs in this stack, by _layer_key"""
+        stack = core.Stack.of(self)
+        if not hasattr(stack, '_aviv_layers'):
+            stack._aviv_layers = dict()
+        return stack._aviv_layers
+
+    def _shared_layer(self, layer_attrs: dict) -> aws_lambda.LayerVersion:
+        layer = self._layers().get(_layer_key(layer_attrs))
+        if layer:
+            logging.info(f"Layer: {self.node.path} shares {layer.node.path}")
+        return layer
+
+    def performance(self, profile: str=None, *, arm64: typing.Union[bool, str]=None, memory_size: int=None, reserved_concurrency: int=None, provisioned_concurrency: int=None, provisioned_schedule: typing.Dict[str, int]=None, warmer: int=None) -> typing.Optional[aws_lambda.Alias]:
+        """Performance settings of the lambda
+
+        Args:
+            profile (str, optional): PERFORMANCE_PROFILES preset, the other arguments override it. Defaults to None.
+            arm64 (bool, optional): run on Graviton, 'auto': when the runtime supports it and the code and layer are architecture neutral. Defaults to None (x86_64).
+            memory_size (int, optional): memory (MB), CPU is allocated in proportion. Defaults to None (unchanged).
+            reserved_concurrency (int, optional): reserved concurrent executions. Defaults to None.
+            provisioned_concurrency (int, optional): provisioned concurrency of a 'live' alias. Defaults to None (no alias).
+            provisioned_schedule (dict, optional): schedule expression ('cron(...)', 'rate(...)') -> provisioned concurrency. Defaults to None.
+            warmer (int, optional): invoke the function (or alias) with WARMER_EVENT every N minutes. Defaults to None.
+
+        Raises:
+            ValueError: arm64 with a runtime not supporting it (NO_ARM64_RUNTIMES)
+
+        Returns:
+            aws_lambda.Alias: 'live' alias when provisioned_concurrency is set
+        """
+        options = dict(PERFORMANCE_PROFILES[profile]) if profile else dict()
+        for name, value in dict(arm64=arm64, memory_size=memory_size, reserved_concurrency=reserved_concurrency, provisioned_concurrency=provisioned_concurrency, provisioned_schedule=provisioned_schedule, warmer=warmer).items():
+            if value is not None:
+                options[name] = value
+        cfn = self._lambda.node.default_child
+
+        runtime = self._lambda.runtime.name
+        if options.get('arm64') is True and runtime in NO_ARM64_RUNTIMES:
+            raise ValueError(f"{self.node.path}: {runtime} doesn't run on arm64")
+        neutral = architecture_neutral(self._code) and architecture_neutral(self._layer_code)
+        if options.get('arm64') == 'auto':
+            options['arm64'] = neutral and runtime not in NO_ARM64_RUNTIMES
+        if options.get('arm64'):
+            if not neutral:
+                logging.warning(f"{self.node.path}: arm64 with native code (.so) in the lambda or its layer")
+            cfn.add_property_override('Architectures', ['arm64'])
+            if self._layer and neutral:
+                self._layer.node.default_child.add_property_override('CompatibleArchitectures', ['x86_64', 'arm64'])
+        if options.get('memory_size'):
+            cfn.memory_size = options['memory_size']
+        if options.get('reserved_concurrency') is not None:
+            cfn.reserved_concurrent_executions = options['reserved_concurrency']
+
+        if options.get('provisioned_concurrency') is not None:
+            self._alias = aws_lambda.Alias(
+                self, 'live',
+                alias_name='live',
+                version=self._lambda.current_version,
+                provisioned_concurrent_executions=options['provisioned_concurrency'] or None
+            )
+            if options.get('provisioned_schedule'):
+                from aws_cdk import aws_applicationautoscaling as appscaling
+                capacities = options['provisioned_schedule'].values()
+                scaling = self._alias.add_auto_scaling(min_capacity=min(capacities), max_capacity=max(max(capacities), 1))
+                for i, (expression, capacity) in enumerate(options['provisioned_schedule'].items()):
+                    scaling.scale_on_schedule(
+                        f"provisioned{i}",
+                        schedule=appscaling.Schedule.expression(expression),
+                        # Both bounds, or the capacity is never scaled in
+                        min_capacity=capacity,
+                        max_capacity=capacity
+                    )
+
+        if options.get('warmer'):
+            from aws_cdk import aws_events
+            self._cron('Warmer', event=WARMER_EVENT, cron=aws_events.Schedule.rate(core.Duration.minutes(options['warmer'])), function=self._alias)
+        logging.info(f"{self.node.path}: performance {options}")
+        return self._alias
+
+    def _cron(self, event_name: str='Rule', event: dict=None, cron: 'aws_events.Schedule'=None, function: aws_lambda.IFunction=None):
+        from aws_cdk import aws_events, aws_events_targets
         # See https://docs.aws.amazon.com/lambda/latest/dg/tutorial-scheduled-events-schedule-expressions.html
         if not cron:
             cron = aws_events.Schedule.cron(
@@ -60,23 +239,52 @@ class CDKLambda(core.Construct):
             )
         rule = aws_events.Rule(self, event_name, schedule=cron)
         target = aws_events_targets.LambdaFunction(
-            self._lambda,
+            function or self._lambda,
             event=aws_events.RuleTargetInput.from_object(event)
         )
         return rule.add_target(target)
 
     @staticmethod
-    def _code_inline(filepath):
+    def _code_inline(filepath, limit: int=INLINE_LIMIT) -> str:
         """Streamline file into a string for a simple AWS Lambda
 
+        The code is minified when its UTF-8 size exceeds the limit.
+
         Args:
-            filepath ([type]): [description]
+            filepath (str): python file
+            limit (int, optional): inline code size limit (bytes). Defaults to INLINE_LIMIT.
 
         Returns:
-            [type]: [description]
+            str: code, possibly still over the limit (see inline_code)
         """
         with open(filepath, encoding="utf8") as fp:
             code = fp.read()
-        if sys.getsizeof(code) > 4096:
-            logging.warning(f"Code inline size if > 4096: {sys.getsizeof(code)}")
+        size = len(code.encode('utf8'))
+        if size > limit:
+            code = minify(code)
+            logging.info(f"Code inline {filepath} minified: {size} -> {len(code.encode('utf8'))} bytes")
+        if len(code.encode('utf8')) > limit:
+            logging.warning(f"Code inline size is > {limit}: {len(code.encode('utf8'))}")
         return code
+
+    @staticmethod
+    def inline_code(filepath, limit: int=INLINE_LIMIT) -> aws_lambda.Code:
+        """Inline (minified if needed) lambda code, or a content hashed asset with the file as index.py when it can't fit
+
+        Args:
+            filepath (str): python file (handler: 'index.<function>')
+            limit (int, optional): inline code size limit (bytes). Defaults to INLINE_LIMIT.
+        """
+        code = CDKLambda._code_inline(filepath, limit)
+        if len(code.encode('utf8')) <= limit:
+            return aws_lambda.Code.from_inline(code)
+        with open(filepath, 'rb') as fp:
+            content = fp.read()
+        # Absolute: jsii resolves relative asset paths against the cwd of its node process
+        path = os.path.abspath(os.path.join(INLINE_DIR, hashlib.sha256(content).hexdigest()[:16]))
+        if not os.path.exists(os.path.join(path, 'index.py')):
+            os.makedirs(path, exist_ok=True)
+            with open(os.path.join(path, 'index.py'), 'wb') as fp:
+                fp.write(content)
+        logging.warning(f"Code inline {filepath} doesn't fit in {limit} bytes, using an asset")
+        return assets.lambda_code(path)
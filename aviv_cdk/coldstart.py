@@ -0,0 +1,248 @@
+"""Cold start optimised lambda packages
+
+pack(src, dst) copies a lambda code (or layer) directory and makes it
+cheaper to load:
+
+- docstrings are stripped from the .py files (line numbers are kept, python >= 3.8)
+- tests directories, __pycache__ and *.pyc leftovers are dropped
+- boto3/botocore (already in the Lambda python runtime) are dropped, or only
+  the service models not listed in boto_services when the code pins its own
+- .pyc files are precompiled (unchecked hash, so zip timestamps don't matter)
+  when the build python is the runtime version
+
+It returns a report with the size contributed by each top level package.
+CDKLambda(..., optimize_code=True) packs path (str) codes with packed_code().
+
+minify() is the more aggressive version used for inline lambda code (see
+CDKLambda.inline_code): no docstrings, comments, blank lines, one space indents.
+
+import_time() is the matching benchmark: time to import a handler module from
+a directory or zip in a fresh interpreter.
+"""
+import os
+import io
+import ast
+import sys
+import json
+import shutil
+import hashlib
+import logging
+import zipfile
+import tempfile
+import tokenize
+import py_compile
+import subprocess
+import typing
+
+
+PACKED_DIR = '.aviv-cdk/packed'
+RUNTIME_BOTO = ('boto3', 'botocore', 's3transfer')
+SKIP_DIRS = ('__pycache__', 'tests', 'test')
+
+
+def strip_docstrings(source: str) -> str:
+    """Remove the module docstring and replace the class and function ones by `...`, line numbers are kept
+
+    The source is returned as is before python 3.8 (no end_lineno/end_col_offset in the ast).
+    """
+    if sys.version_info < (3, 8):
+        return source
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        return source
+    lines = source.splitlines(keepends=True)
+    docstrings = list()
+    for node in ast.walk(tree):
+        if not isinstance(node, (ast.Module, ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)):
+            continue
+        if node.body and isinstance(node.body[0], ast.Expr) and isinstance(node.body[0].value, ast.Constant) and isinstance(node.body[0].value.value, str):
+            docstrings.append((node.body[0], isinstance(node, ast.Module)))
+    # Bottom up so that offsets stay valid
+    for doc, module in sorted(docstrings, key=lambda d: d[0].lineno, reverse=True):
+        first, last = lines[doc.lineno - 1], lines[doc.end_lineno - 1]
+        # col offsets are in utf8 bytes
+        prefix = first.encode('utf8')[:doc.col_offset].decode('utf8')
+        suffix = last.encode('utf8')[doc.end_col_offset:].decode('utf8')
+        if suffix.strip() and not suffix.strip().startswith('#'):
+            # `"""doc"""; statement`
+            continue
+        # Nothing may come before `from __future__` imports
+        body = '' if module else '...'
+        lines[doc.lineno - 1:doc.end_lineno] = [prefix + body + '\n' * (doc.end_lineno - doc.lineno) + suffix]
+    return ''.join(lines)
+
+
+def _source(lines: typing.List[str], start: tuple, end: tuple) -> str:
+    if start[0] == end[0]:
+        return lines[start[0] - 1][start[1]:end[1]]
+    return lines[start[0] - 1][start[1]:] + ''.join(lines[start[0]:end[0] - 1]) + lines[end[0] - 1][:end[1]]
+
+
+def minify(source: str) -> str:
+    """Python source without docstrings, comments and blank lines, indented with one space per level"""
+    source = strip_docstrings(source)
+    lines = source.splitlines(keepends=True)
+    words = (tokenize.NAME, tokenize.NUMBER, tokenize.STRING)
+    fstring_start = getattr(tokenize, 'FSTRING_START', None)
+    fstring_end = getattr(tokenize, 'FSTRING_END', None)
+    out = list()
+    depth = 0
+    prev = None
+    fstring = list()
+    for token in tokenize.generate_tokens(io.StringIO(source).readline):
+        kind, string = token.type, token.string
+        # python >= 3.12 tokenizes f-strings, keep them as written
+        if fstring_start is not None and kind == fstring_start:
+            fstring.append(token.start)
+            continue
+        if fstring:
+            if kind == fstring_end:
+                start = fstring.pop()
+                if not fstring:
+                    kind, string = tokenize.STRING, _source(lines, start, token.end)
+            if fstring:
+                continue
+        if kind in (tokenize.COMMENT, tokenize.NL, tokenize.ENCODING, tokenize.ENDMARKER):
+            continue
+        if kind == tokenize.INDENT:
+            depth += 1
+        elif kind == tokenize.DEDENT:
+            depth -= 1
+        elif kind == tokenize.NEWLINE:
+            out.append('\n')
+            prev = None
+        else:
+            if prev is None:
+                out.append(' ' * depth)
+            elif (prev.type in words and kind in words) or (prev.type == tokenize.NUMBER and string.startswith('.')):
+                out.append(' ')
+            out.append(string)
+            prev = token._replace(type=kind)
+    return ''.join(out)
+
+
+def _read(filename: str) -> str:
+    with open(filename, 'rb') as fp:
+        encoding, _ = tokenize.detect_encoding(fp.readline)
+    with open(filename, encoding=encoding) as fp:
+        return fp.read()
+
+
+def _skip(relpath: str, boto_services: typing.Optional[typing.List[str]]) -> bool:
+    parts = relpath.split(os.sep)
+    if any(part in SKIP_DIRS for part in parts[:-1]) or relpath.endswith(('.pyc', '.pyo')):
+        return True
+    top = parts[0] if len(parts) == 1 or parts[0] != 'python' else parts[1]
+    if boto_services is None:
+        dist = top.split('-')[0]
+        return top in RUNTIME_BOTO or (top.endswith('.dist-info') and dist in RUNTIME_BOTO)
+    # botocore/data/<service>/... and boto3/data/<service>/...
+    if top in ('boto3', 'botocore'):
+        index = parts.index(top)
+        if len(parts) > index + 3 and parts[index + 1] == 'data':
+            return parts[index + 2] not in boto_services
+    return False
+
+
+def pack(src: str, dst: str, *, runtime: str='3.8', strip: bool=True, boto_services: typing.List[str]=None) -> dict:
+    """Copy src into dst optimised for cold starts
+
+    Args:
+        src (str): lambda code or layer directory
+        dst (str): output directory (must not exist)
+        runtime (str, optional): lambda python version, .pyc are only compiled when it's the build one. Defaults to '3.8'.
+        strip (bool, optional): strip docstrings. Defaults to True.
+        boto_services (list, optional): keep the bundled boto3/botocore with only these service models. Defaults to None (dropped).
+
+    Returns:
+        dict: sizes (bytes) before/after and per top level package
+    """
+    compiled = runtime == '{}.{}'.format(*sys.version_info[:2])
+    if not compiled:
+        logging.warning(f"Cold start: building with python {sys.version_info[0]}.{sys.version_info[1]}, .pyc for {runtime} aren't precompiled")
+    report = dict(before=0, after=0, packages=dict())
+    for root, dirs, files in os.walk(src):
+        dirs.sort()
+        for name in sorted(files):
+            filename = os.path.join(root, name)
+            relpath = os.path.relpath(filename, src)
+            report['before'] += os.path.getsize(filename)
+            if _skip(relpath, boto_services):
+                continue
+            target = os.path.join(dst, relpath)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if name.endswith('.py') and strip:
+                with open(target, 'w', encoding='utf8') as fp:
+                    fp.write(strip_docstrings(_read(filename)))
+                shutil.copymode(filename, target)
+            else:
+                shutil.copy2(filename, target)
+            if name.endswith('.py') and compiled:
+                try:
+                    py_compile.compile(target, doraise=True, invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+                except py_compile.PyCompileError as e:
+                    logging.warning(f"Cold start: can't compile {relpath}: {e.msg}")
+
+    for root, dirs, files in os.walk(dst):
+        for name in files:
+            relpath = os.path.relpath(os.path.join(root, name), dst)
+            parts = relpath.split(os.sep)
+            package = parts[1] if parts[0] == 'python' and len(parts) > 1 else parts[0]
+            size = os.path.getsize(os.path.join(root, name))
+            report['after'] += size
+            report['packages'][package] = report['packages'].get(package, 0) + size
+    report['packages'] = dict(sorted(report['packages'].items(), key=lambda kv: (-kv[1], kv[0])))
+    logging.info(f"Cold start: {src} packed {report['before']} -> {report['after']} bytes, top packages: {list(report['packages'].items())[:5]}")
+    return report
+
+
+def packed(path: str, *, packed_dir: str=PACKED_DIR, **options) -> str:
+    """pack() into a directory named after the source content and options, packed once
+
+    Returns:
+        str: packed directory (absolute path, as jsii resolves relative asset paths against the cwd of its node process)
+    """
+    from .incremental import hash_path
+    digest = hashlib.sha256()
+    digest.update(hash_path(path).encode('utf8'))
+    digest.update(json.dumps(options, sort_keys=True).encode('utf8'))
+    digest.update('{}.{}'.format(*sys.version_info[:2]).encode('utf8'))
+    dst = os.path.abspath(os.path.join(packed_dir, digest.hexdigest()[:16]))
+    if not os.path.exists(dst):
+        tmp = dst + '.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        report = pack(path, tmp, **options)
+        with open(tmp + '.report.json', 'w') as fp:
+            json.dump(report, fp, indent=2)
+        os.replace(tmp, dst)
+        os.replace(tmp + '.report.json', dst + '.report.json')
+    return dst
+
+
+def packed_code(path: str, **options) -> 'aws_lambda.AssetCode':
+    """packed() as a lambda AssetCode"""
+    from . import assets
+    return assets.lambda_code(packed(path, **options))
+
+
+def import_time(path: str, module: str, *, runs: int=5) -> float:
+    """Median time (seconds) to import module from a lambda code directory or zip, in fresh interpreters
+
+    Layer style python/ prefixes are added to sys.path too.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        if zipfile.is_zipfile(path):
+            with zipfile.ZipFile(path) as zf:
+                zf.extractall(tmp)
+            path = tmp
+        code = io.StringIO()
+        code.write("import sys, time\n")
+        code.write(f"sys.path[:0] = [{path!r}, {os.path.join(path, 'python')!r}]\n")
+        code.write(f"start = time.perf_counter()\nimport {module}\nprint(time.perf_counter() - start)\n")
+        timings = list()
+        for _ in range(runs):
+            # -B: measure what's shipped, don't write a __pycache__ in the artifact
+            result = subprocess.run([sys.executable, '-B', '-c', code.getvalue()], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+            timings.append(float(result.stdout.strip().splitlines()[-1]))
+    return sorted(timings)[len(timings) // 2]
@@ -1,11 +1,9 @@
 import os
+import time
 import subprocess
 import typing
 import constructs
-from aws_cdk import (
-    aws_ssm,
-    core
-)
+from aws_cdk import core
 # from aws_cdk.core import Stack, Environment, App, Construct
 
 # Disable SAM spyware, should be opt-in
@@ -24,6 +22,16 @@ class Stack(core.Stack):
         tags: typing.Mapping[str, str]=None,
         termination_protection: bool=False) -> None:
 
+        profiler = getattr(scope.node.root, 'profiler', None) if scope else None
+        if profiler:
+            if not synthesizer:
+                # Same default as core.Stack
+                if scope.node.try_get_context('@aws-cdk/core:newStyleStackSynthesis'):
+                    synthesizer = core.DefaultStackSynthesizer()
+                else:
+                    synthesizer = core.LegacyStackSynthesizer()
+            synthesizer = profiler.synthesizer(id, synthesizer)
+
         super().__init__(
             scope,
             id,
@@ -35,6 +43,11 @@ class Stack(core.Stack):
             tags=tags,
             termination_protection=termination_protection
         )
+        from . import incremental
+        incremental.track(self, dict(
+            cls=type(self).__name__, analytics_reporting=analytics_reporting, description=description, env=env,
+            stack_name=stack_name, tags=tags, termination_protection=termination_protection
+        ))
 
 
 class Environment(core.Environment):
@@ -45,6 +58,9 @@ class Environment(core.Environment):
 
 
 class App(core.App):
+    profiler = None
+    ssm_cache = None
+
     def __init__(
         self,
         analytics_reporting: typing.Optional[bool]=False,  # This should be opt-in
@@ -55,6 +71,7 @@ class App(core.App):
         stack_traces: typing.Optional[bool]=None,
         tree_metadata: typing.Optional[bool]=None) -> None:
 
+        self._aviv_context = context
         super().__init__(
             analytics_reporting=analytics_reporting,
             auto_synth=auto_synth,
@@ -65,8 +82,55 @@ class App(core.App):
             tree_metadata=tree_metadata
         )
 
+        from . import profiling, ssm_cache
+        if profiling.enabled(self):
+            self.profiler = profiling.SynthProfiler()
+            self.profiler.start()
+        cache_file = ssm_cache.enabled(self)
+        if cache_file:
+            self.ssm_cache = ssm_cache.SSMCache(cache_file)
+        from . import policy_compaction
+        if policy_compaction.enabled(self):
+            from .iam import PolicyCompactor
+            core.Aspects.of(self).add(PolicyCompactor())
+
+    def synth(self, *args, **options) -> 'cx_api.CloudAssembly':
+        """Synthesize the app
+
+        Depending on the context/env, SSM lookups are resolved in bulk (aviv_cdk.ssm_cache), only one partition
+        of the stacks is synthesized (aviv_cdk.synth), unchanged stacks are reused from cache (aviv_cdk.incremental)
+        and a cdk.profile.json report is written (aviv_cdk.profiling).
+        """
+        from . import synth, incremental
+        if self.ssm_cache:
+            self.ssm_cache.resolve()
+        partition = synth.partition_from_env()
+        if partition:
+            synth.select_partition(self, *partition)
+        synth_cache = None
+        cache_dir = incremental.enabled(self)
+        if cache_dir:
+            synth_cache = incremental.SynthCache(cache_dir, context=self._aviv_context)
+            synth_cache.prepare(self)
+
+        start = time.perf_counter()
+        try:
+            assembly = super().synth(*args, **options)
+        finally:
+            if self.profiler:
+                self.profiler.stop()
+                self.profiler.write(self.outdir, synth_time=time.perf_counter() - start)
+        if synth_cache:
+            synth_cache.finalize(self.outdir)
+        return assembly
+
 
 def ssm_lookup(scope, parameter_name):
+    """SSM parameter lookup, batched and cached when the App has an ssm_cache (see aviv_cdk.ssm_cache)"""
+    cache = getattr(scope.node.root, 'ssm_cache', None)
+    if cache:
+        return cache.lookup(scope, parameter_name)
+    from aws_cdk import aws_ssm
     return aws_ssm.StringParameter.value_from_lookup(scope, parameter_name=parameter_name)
 
 
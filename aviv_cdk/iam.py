@@ -1,8 +1,28 @@
+import os
+import json
+import typing
+import logging
+import jsii
 from aws_cdk import (
     aws_iam as iam,
-    aws_secretsmanager as asm,
     core
 )
+from . import policy_compaction
+
+
+def managed_policy(scope: core.Construct, name: str) -> iam.IManagedPolicy:
+    """AWS managed policy (name under arn:aws:iam::aws:policy/ or full ARN), imported once per stack
+
+    All the Role/SAMLRole of a stack share the same import construct.
+    """
+    stack = core.Stack.of(scope)
+    if not hasattr(stack, '_aviv_managed_policies'):
+        stack._aviv_managed_policies = dict()
+    policies = stack._aviv_managed_policies
+    if name not in policies:
+        arn = name if name.startswith('arn:') else 'arn:aws:iam::aws:policy/{}'.format(name)
+        policies[name] = iam.ManagedPolicy.from_managed_policy_arn(stack, 'ManagedPolicy-{}'.format(arn.split(':policy/')[-1]), managed_policy_arn=arn)
+    return policies[name]
 
 
 class SecurityCredentials(core.Construct):
@@ -13,6 +33,7 @@ class SecurityCredentials(core.Construct):
         self.user = user
 
     def console_password(self, secret_name: str, template: str = None, key: str = None):
+        from aws_cdk import aws_secretsmanager as asm
         self.secret = asm.Secret(
             self,
             id,
@@ -31,6 +52,8 @@ class SecurityCredentials(core.Construct):
             user_name = self.user.user_name
         userkey = iam.CfnAccessKey(self, 'key', user_name=user_name)
 
+        from aws_cdk import aws_secretsmanager as asm
+
         secret = asm.CfnSecret(
             self, 'userKey',
             name='iam/user/{}/accesskey'.format(user_name),
@@ -60,17 +83,8 @@ class Role(iam.Role):
             permissions_boundary: AWS supports permissions boundaries for IAM entities (users or roles). A permissions boundary is an advanced feature for using a managed policy to set the maximum permissions that an identity-based policy can grant to an IAM entity. An entity's permissions boundary allows it to perform only the actions that are allowed by both its identity-based policies and its permissions boundaries. Default: - No permissions boundary.
         """
         if policies:
-            # Here the scope is the higher level construct/node, NOT self as the lookup is made before *this* construct calls its parent
-            mpolicies = [
-                iam.ManagedPolicy.from_managed_policy_arn(
-                    # scope, '{}-{}-{}'.format(mpname, id, scope.node.id),
-                    scope, '{}-{}'.format(mpname, id),
-                    managed_policy_arn='arn:aws:iam::aws:policy/{}'.format(mpname)
-                ) for mpname in policies
-            ]
-            if not managed_policies:
-                managed_policies = list()
-            managed_policies += mpolicies
+            # Imported once per stack (see managed_policy), NOT per role
+            managed_policies = list(managed_policies or list()) + [managed_policy(scope, mpname) for mpname in policies]
         super().__init__(
             scope=scope, id=id, assumed_by=assumed_by, description=description, external_ids=external_ids, inline_policies=inline_policies,
             managed_policies=managed_policies, max_session_duration=max_session_duration, path=path, permissions_boundary=permissions_boundary, role_name=id
@@ -78,7 +92,7 @@ class Role(iam.Role):
 
 
 class SAMLRole(Role):
-    def __init__(self, scope: core.Construct, id: str, federated: str, *, description=None, external_ids=None, inline_policies=None,
+    def __init__(self, scope: core.Construct, id: str, federated: str, *, description=None, policies: list=None, external_ids=None, inline_policies=None,
         managed_policies=None, max_session_duration=None, path=None, permissions_boundary=None) -> None:
         """Same as CDK IAM Role above. The assumed_by is a FederatedPrincipal 'federated' (your IAM Idp arn).
 
@@ -94,6 +108,208 @@ class SAMLRole(Role):
         )
 
         super().__init__(
-            scope=scope, id=id, assumed_by=assumed_by, description=description, external_ids=external_ids, inline_policies=inline_policies,
+            scope=scope, id=id, assumed_by=assumed_by, description=description, policies=policies, external_ids=external_ids, inline_policies=inline_policies,
             managed_policies=managed_policies, max_session_duration=max_session_duration, path=path, permissions_boundary=permissions_boundary
         )
+
+
+def _principal(assumed_by: str) -> iam.IPrincipal:
+    if assumed_by.endswith('.amazonaws.com'):
+        return iam.ServicePrincipal(assumed_by)
+    if assumed_by.isdigit():
+        return iam.AccountPrincipal(assumed_by)
+    return iam.ArnPrincipal(assumed_by)
+
+
+def roles(scope: core.Construct, spec: typing.Union[str, dict]) -> typing.Dict[str, Role]:
+    """Create many roles from a compact spec
+
+        defaults:
+          federated: arn:aws:iam::123456789012:saml-provider/idp
+          max_session_duration: 43200
+          policies: [ReadOnlyAccess]
+        roles:
+          admin:
+            policies: [AdministratorAccess]
+          deploy:
+            assumed_by: codebuild.amazonaws.com   # service, account id or ARN
+            description: CI deployments
+
+    Each role gets the defaults, its own values replacing them (policies are
+    added to the default ones). Roles with a 'federated' IdP are SAMLRole.
+
+    Args:
+        scope (core.Construct): CDK Construct/Stack
+        spec (str|dict): YAML/JSON file, or its loaded content
+
+    Returns:
+        dict: role id -> Role
+    """
+    if isinstance(spec, str):
+        with open(spec, encoding="utf8") as fp:
+            if os.path.splitext(spec)[1] == '.json':
+                spec = json.load(fp)
+            else:
+                import yaml
+                spec = yaml.safe_load(fp)
+    defaults = spec.get('defaults', dict())
+    created = dict()
+    for rid, props in spec['roles'].items():
+        props = dict(defaults, **(props or dict()))
+        props['policies'] = list(dict.fromkeys(defaults.get('policies', list()) + (props.get('policies') or list())))
+        if isinstance(props.get('max_session_duration'), int):
+            props['max_session_duration'] = core.Duration.seconds(props['max_session_duration'])
+        federated = props.pop('federated', None)
+        if federated:
+            created[rid] = SAMLRole(scope, rid, federated, **props)
+        else:
+            created[rid] = Role(scope, rid, assumed_by=_principal(props.pop('assumed_by')), **props)
+    return created
+
+
+class _CompactedTemplate(core.Construct):
+    """Compacts the template of a stack once written (synthesized after it: added to its stage after it)"""
+    def __init__(self, scope: core.Construct, id: str, stack: core.Stack, compactor: 'PolicyCompactor') -> None:
+        super().__init__(scope, id)
+        self._stack = stack
+        self._compactor = compactor
+
+    def _synthesize(self, session: core.ISynthesisSession) -> None:
+        filename = os.path.join(session.outdir, self._stack.template_file)
+        with open(filename) as fp:
+            template = json.load(fp)
+        self._compactor.compact_template(template, self._stack.node.path)
+        with open(filename, 'w') as fp:
+            json.dump(template, fp, indent=2)
+
+
+@jsii.implements(core.IAspect)
+class PolicyCompactor:
+    """Aspect compacting the IAM policies of the stacks it's applied to, see aviv_cdk.policy_compaction
+
+        core.Aspects.of(stack).add(iam.PolicyCompactor())
+
+    (or `-c aviv:compact-policies=1` / AVIV_CDK_COMPACT_POLICIES=1 with aviv_cdk.core.App)
+
+    Policies, managed policies and role/user/group inline policies are compacted.
+    When the inline policies of a role/user/group of the stack are still over
+    the limit all together, what doesn't fit goes into managed policies: the
+    first statements of each policy are kept inline, the others are moved to
+    managed policies attached to the same roles/users/groups (and added to the
+    DependsOn of the resources depending on the policy). A policy only
+    attached to principals out of the stack is checked against the limit on
+    its own. Managed policies are never split: their ARN may be attached
+    anywhere.
+
+    The synthesized templates are compacted, not the L1s: the L1 of an
+    iam.Policy is an instance of an unexported class, that jsii gives to
+    python as an opaque construct (no properties, no overrides).
+    """
+    # Principal resource types, with the policies property listing them
+    PRINCIPALS = {'AWS::IAM::Role': 'Roles', 'AWS::IAM::User': 'Users', 'AWS::IAM::Group': 'Groups'}
+
+    def __init__(self, *, catalog: typing.Dict[str, typing.List[str]]=None, inline_limit: int=policy_compaction.INLINE_LIMIT, managed_limit: int=policy_compaction.MANAGED_LIMIT,
+        user_inline_limit: int=policy_compaction.USER_INLINE_LIMIT, group_inline_limit: int=policy_compaction.GROUP_INLINE_LIMIT) -> None:
+        self.catalog = catalog
+        self.inline_limit = inline_limit
+        self.managed_limit = managed_limit
+        self.limits = dict(Roles=inline_limit, Users=user_inline_limit, Groups=group_inline_limit)
+        # policy path (stack path/logical id[/inline policy name]) -> sizes before and after
+        self.report = dict()
+        self._stacks = set()
+
+    def visit(self, node: core.IConstruct) -> None:
+        if not core.CfnResource.is_cfn_resource(node):
+            return
+        stack = core.Stack.of(node)
+        if stack.node.path not in self._stacks:
+            self._stacks.add(stack.node.path)
+            _CompactedTemplate(core.Stage.of(stack), f"PolicyCompaction{stack.node.unique_id}", stack, self)
+
+    def _compact(self, path: str, document: dict) -> dict:
+        compacted = policy_compaction.compact(document, self.catalog)
+        before, after = policy_compaction.size(document), policy_compaction.size(compacted)
+        self.report[path] = (before, after)
+        logging.info(f"Policy compaction: {path} {before} -> {after}")
+        return compacted
+
+    def _managed(self, resources: dict, logical_id: str, document: dict, **principals):
+        """Managed policies with the statements of a resource that don't fit inline"""
+        for part in policy_compaction.split(document, self.managed_limit):
+            count = 2
+            while f"{logical_id}Part{count}" in resources:
+                count += 1
+            name = f"{logical_id}Part{count}"
+            resources[name] = dict(Type='AWS::IAM::ManagedPolicy', Properties=dict(PolicyDocument=part, **principals))
+            # What waits for the statements keeps waiting for all of them
+            for resource in resources.values():
+                depends = resource.get('DependsOn')
+                if depends == logical_id or (isinstance(depends, list) and logical_id in depends):
+                    resource['DependsOn'] = policy_compaction._list(depends) + [name]
+            logging.warning(f"Policy compaction: {logical_id} statements moved to the managed policy {name}")
+
+    def _keep(self, resources: dict, logical_id: str, limit: int) -> dict:
+        """Keep the first statements of a policy under limit, the others in managed policies attached to its principals"""
+        properties = resources[logical_id]['Properties']
+        head, rest = policy_compaction.take(properties['PolicyDocument'], limit)
+        if rest:
+            properties['PolicyDocument'] = head
+            self._managed(resources, logical_id, rest, **dict((field, properties[field]) for field in self.PRINCIPALS.values() if properties.get(field)))
+        return head
+
+    def _principal(self, resources: dict, logical_id: str, field: str, attached: typing.List[str]):
+        """What exceeds the limit of the inline policies of a role/user/group all together goes into managed policies"""
+        properties = resources[logical_id].get('Properties', dict())
+        inline = properties.get('Policies') or list()
+        limit = self.limits[field]
+        total = sum(policy_compaction.size(resources[policy]['Properties']['PolicyDocument']) for policy in attached) \
+            + sum(policy_compaction.size(p['PolicyDocument']) for p in inline)
+        if total <= limit:
+            return
+        logging.warning(f"Policy compaction: {logical_id} inline policies are {total} characters, over {limit}")
+        # Policy resources keep at least a statement, then the principal own inline policies fill what's left
+        budget = limit
+        for policy in attached:
+            budget -= policy_compaction.size(self._keep(resources, policy, budget))
+        kept = list()
+        for policy in inline:
+            if policy_compaction.size(policy['PolicyDocument']) <= budget:
+                kept.append(policy)
+                budget -= policy_compaction.size(policy['PolicyDocument'])
+            else:
+                self._managed(resources, logical_id, policy['PolicyDocument'], **{field: [{'Ref': logical_id}]})
+        if kept:
+            properties['Policies'] = kept
+        else:
+            properties.pop('Policies', None)
+
+    def compact_template(self, template: dict, name: str='') -> dict:
+        """Compact the IAM policies of a CloudFormation template (in place)
+
+        Args:
+            template (dict): synthesized template
+            name (str): prefix of the report keys (stack path)
+        """
+        resources = template.get('Resources', dict())
+        for logical_id, resource in list(resources.items()):
+            properties = resource.get('Properties', dict())
+            if resource['Type'] in ('AWS::IAM::Policy', 'AWS::IAM::ManagedPolicy'):
+                properties['PolicyDocument'] = self._compact(f"{name}/{logical_id}", properties['PolicyDocument'])
+                if resource['Type'] == 'AWS::IAM::ManagedPolicy' and policy_compaction.size(properties['PolicyDocument']) > self.managed_limit:
+                    logging.warning(f"Policy compaction: {name}/{logical_id} is over {self.managed_limit} characters, managed policies are not split")
+            elif resource['Type'] in self.PRINCIPALS:
+                for policy in properties.get('Policies') or list():
+                    policy['PolicyDocument'] = self._compact(f"{name}/{logical_id}/{policy['PolicyName']}", policy['PolicyDocument'])
+
+        policies = [logical_id for logical_id, resource in resources.items() if resource['Type'] == 'AWS::IAM::Policy']
+        owned = set()
+        for logical_id, resource in list(resources.items()):
+            field = self.PRINCIPALS.get(resource['Type'])
+            if field:
+                attached = [policy for policy in policies if {'Ref': logical_id} in (resources[policy]['Properties'].get(field) or list())]
+                owned.update(attached)
+                self._principal(resources, logical_id, field, attached)
+        for policy in policies:
+            if policy not in owned and policy_compaction.size(resources[policy]['Properties']['PolicyDocument']) > self.inline_limit:
+                self._keep(resources, policy, self.inline_limit)
+        return template
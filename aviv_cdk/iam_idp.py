@@ -1,71 +1,164 @@
 import os
 import sys
+import gzip
+import typing
+import hashlib
 import logging
+import datetime
+from xml.etree import ElementTree
 from aws_cdk import (
     aws_iam as iam,
     aws_lambda,
-    aws_ssm as ssm,
-    aws_cloudformation as cfn,
     core
 )
 from .cdk_lambda import CDKLambda
+from . import incremental, layers
+
+# Construct id of the provider function shared by a stack
+SAML_PROVIDER_FUNCTION = 'SAMLProviderFunction'
+# Larger metadata documents are passed as a gzip S3 asset instead of a property
+METADATA_INLINE_LIMIT = 4096
+METADATA_DIR = '.aviv-cdk/saml-metadata'
+SAML_METADATA_NS = '{urn:oasis:names:tc:SAML:2.0:metadata}'
+
+
+def load_metadata(path: str) -> str:
+    """SAML metadata document of an IdP, validated
+
+    Raises:
+        ValueError: not an IdP SAML metadata document, or not of a size IAM accepts (1000 to 10M characters)
+    """
+    with open(path, 'rb') as fp:
+        data = fp.read()
+    try:
+        root = ElementTree.fromstring(data)
+    except ElementTree.ParseError as e:
+        raise ValueError(f"{path}: invalid XML, {e}")
+    if root.tag not in (f"{SAML_METADATA_NS}EntityDescriptor", f"{SAML_METADATA_NS}EntitiesDescriptor"):
+        raise ValueError(f"{path}: not a SAML metadata document ({root.tag})")
+    if root.find(f".//{SAML_METADATA_NS}IDPSSODescriptor") is None:
+        raise ValueError(f"{path}: no IDPSSODescriptor")
+    metadata = data.decode('utf8')
+    if not 1000 <= len(metadata) <= 10000000:
+        raise ValueError(f"{path}: {len(metadata)} characters, IAM accepts 1000 to 10000000")
+    valid_until = root.get('validUntil')
+    if valid_until and valid_until[:10] < datetime.date.today().isoformat():
+        logging.warning(f"{path}: SAML metadata expired on {valid_until}")
+    return metadata
+
+
+def _metadata_asset(metadata: str) -> str:
+    """Reproducible gzip of metadata, named after its content
+
+    The path is absolute: jsii resolves relative asset paths against the cwd of its node process.
+    """
+    os.makedirs(METADATA_DIR, exist_ok=True)
+    filename = os.path.abspath(os.path.join(METADATA_DIR, '{}.xml.gz'.format(hashlib.sha256(metadata.encode('utf8')).hexdigest()[:16])))
+    if not os.path.exists(filename):
+        with open(filename + '.tmp', 'wb') as fp:
+            fp.write(gzip.compress(metadata.encode('utf8'), mtime=0))
+        os.replace(filename + '.tmp', filename)
+    return filename
+
+
+def _function_attrs(cfn_lambda: str=None, cfn_resources_path: str=None) -> typing.Tuple[str, str, dict, dict]:
+    """cfn_lambda, cfn_resources_path, lambda_attrs and layer_attrs of a SAML provider function"""
+    share_path = sys.prefix + '/share/aviv-cdk/'
+    if not cfn_lambda:
+        cfn_lambda = f"{share_path}iam-idp/saml.py"
+    runtime = aws_lambda.Runtime.PYTHON_3_7
+    # The packaged saml.py is over the inline limit even minified: an asset, unless cfn_lambda is small enough
+    lambda_attrs=dict(
+            code=CDKLambda.inline_code(cfn_lambda),
+            handler='index.handler',
+            timeout=core.Duration.seconds(20),
+            runtime=runtime
+    )
+    if not cfn_resources_path and os.path.exists('build/artifacts-cfn_resources.zip'):
+        cfn_resources_path='build/artifacts-cfn_resources.zip'
+    elif not cfn_resources_path:
+        requirements = f"{share_path}cfn-resources/requirements.txt"
+        if not os.path.exists(requirements):
+            raise FileNotFoundError(f"No {requirements} to build the cfn_resources layer from, provide the path for the AssetCode in the cfn_resources_path argument")
+        # Wheels for the lambda python: 'python3.7' -> '3.7'
+        cfn_resources_path = layers.build_layer(requirements, name='cfn_resources', python_version=runtime.name.replace('python', ''))
+    layer_attrs=dict(
+        description='cfn_resources layer for idp',
+        code=cfn_resources_path,
+        compatible_runtimes=[
+            # aws_lambda.Runtime.PYTHON_3_6,
+            aws_lambda.Runtime.PYTHON_3_7,
+            aws_lambda.Runtime.PYTHON_3_8
+        ]
+    )
+    return cfn_lambda, cfn_resources_path, lambda_attrs, layer_attrs
+
+
+def _grant(function: CDKLambda, cfn_lambda: str, cfn_resources_path: str):
+    incremental.track_file(function, cfn_lambda)
+    incremental.track_file(function, cfn_resources_path)
+    # Add required policies for the lambda to create an IAM idp
+    function._lambda.add_to_role_policy(
+        iam.PolicyStatement(
+            actions=['iam:CreateSAMLProvider', 'iam:GetSAMLProvider', 'iam:UpdateSAMLProvider', 'iam:DeleteSAMLProvider', 'iam:TagSAMLProvider', 'iam:ListSAMLProviderTags'],
+            effect=iam.Effect.ALLOW,
+            resources=['*']
+        )
+    )
+
+
+def saml_provider_function(scope: core.Construct, *, cfn_lambda: str=None, cfn_resources_path: str=None) -> CDKLambda:
+    """Custom::SAMLProvider(s) lambda and layer, created once per stack
+
+    The arguments of the first call are used.
+    """
+    stack = core.Stack.of(scope)
+    if not hasattr(stack, '_aviv_saml_provider'):
+        cfn_lambda, cfn_resources_path, lambda_attrs, layer_attrs = _function_attrs(cfn_lambda, cfn_resources_path)
+        # Same id in every stack: no layer parameter, its name would collide
+        stack._aviv_saml_provider = CDKLambda(stack, SAML_PROVIDER_FUNCTION, lambda_attrs=lambda_attrs, layer_attrs=layer_attrs, remote_account_grant=False, export_layer=False)
+        _grant(stack._aviv_saml_provider, cfn_lambda, cfn_resources_path)
+    return stack._aviv_saml_provider
 
 
 class IAMIdpSAML(CDKLambda):
-    _idp: cfn.CfnCustomResource = None
+    _idp: 'cfn.CfnCustomResource' = None
 
-    def __init__(self,  scope: core.Construct, id: str, idp_name: str, idp_url: str, *, cfn_lambda:str = None, cfn_resources_path: str=None, debug=False):
+    def __init__(self,  scope: core.Construct, id: str, idp_name: str, idp_url: str=None, *, idp_metadata: str=None, cfn_lambda:str = None, cfn_resources_path: str=None, debug=False, shared_function: bool=False):
         """Create an IAM SAML Identity Provider
 
         Args:
             scope (core.Construct): [description]
             id (str): [description]
             idp_name (str): IAM Idp name
-            idp_url (str): Your SAML Identity provider URL
+            idp_url (str, optional): Your SAML Identity provider URL, fetched at each deployment
+            idp_metadata (str, optional): Your SAML Identity provider metadata XML file, read at synth instead of idp_url (see load_metadata)
+            cfn_resources_path (str, optional): cfn_resources layer zip or directory. Defaults to build/artifacts-cfn_resources.zip or a layer built with aviv_cdk.layers.
+            shared_function (bool, optional): use the provider lambda shared by the stack (saml_provider_function) instead of its own. Defaults to False.
         """
-        if not cfn_lambda:
-            share_path = sys.prefix + '/share/aviv-cdk/' # TODO: FIX This should be cfn_resources?
-            cfn_lambda = f"{share_path}iam-idp/saml.py"
-        lambda_attrs=dict(
-                code=aws_lambda.Code.from_inline(CDKLambda._code_inline(cfn_lambda)),
-                handler='index.handler',
-                timeout=core.Duration.seconds(20),
-                runtime=aws_lambda.Runtime.PYTHON_3_7
-        )
-        if not cfn_resources_path:
-            # TODO: check how to facilitate this? at least it is now documented in the README
-            if not os.path.exists('build/artifacts-cfn_resources.zip'):
-                raise FileNotFoundError('You need to generate a "build/artifacts-cfn_resources.zip" first or provide the path for the AssetCode in the cfn_resources_path argument')
-            cfn_resources_path='build/artifacts-cfn_resources.zip'
-        # layer_attrs=dict(
-        layer_attrs=aws_lambda.LayerVersionProps(
-            description='cfn_resources layer for idp',
-            code=aws_lambda.Code.from_asset(cfn_resources_path),
-            compatible_runtimes=[
-                # aws_lambda.Runtime.PYTHON_3_6,
-                aws_lambda.Runtime.PYTHON_3_7,
-                aws_lambda.Runtime.PYTHON_3_8
-            ]
+        if bool(idp_url) == bool(idp_metadata):
+            raise ValueError(f"{id}: provide either idp_url or idp_metadata")
+        from aws_cdk import (
+            aws_ssm as ssm,
+            aws_cloudformation as cfn
         )
 
-        # Create lambda function + layer
-        super().__init__(scope, id, lambda_attrs=lambda_attrs, layer_attrs=layer_attrs._values, remote_account_grant=False)
-        # Add required policies for the lambda to create an IAM idp
-        self._lambda.add_to_role_policy(
-            iam.PolicyStatement(
-                actions=['iam:CreateSAMLProvider', 'iam:UpdateSAMLProvider', 'iam:DeleteSAMLProvider'],
-                effect=iam.Effect.ALLOW,
-                resources=['*']
-            )
-        )
+        if shared_function:
+            super().__init__(scope, id)
+            function = saml_provider_function(self, cfn_lambda=cfn_lambda, cfn_resources_path=cfn_resources_path)
+            self._lambda, self._layer = function._lambda, function._layer
+        else:
+            cfn_lambda, cfn_resources_path, lambda_attrs, layer_attrs = _function_attrs(cfn_lambda, cfn_resources_path)
+            # Create lambda function + layer
+            super().__init__(scope, id, lambda_attrs=lambda_attrs, layer_attrs=layer_attrs, remote_account_grant=False)
+            _grant(self, cfn_lambda, cfn_resources_path)
+        incremental.track(self, idp_name, idp_url)
+        properties = dict(Name=idp_name, URL=idp_url) if idp_url else self._metadata_properties(idp_name, idp_metadata)
         self._idp = cfn.CustomResource(
             self, "identityProvider",
             resource_type='Custom::SAMLProvider',
             provider=cfn.CustomResourceProvider.from_lambda(self._lambda.current_version),
-            properties=dict(
-                Name=idp_name,
-                URL=idp_url
-            )
+            properties=properties
         )
         self.response = self._idp.get_att("Response").to_string()
 
@@ -75,6 +168,21 @@ class IAMIdpSAML(CDKLambda):
         core.CfnOutput(self, 'SSMIAMIdpSAMLArn', value=ssm_name)
         core.CfnOutput(self, 'IAMIdpSAMLArn', value=self._idp.ref)
 
+    def _metadata_properties(self, idp_name: str, idp_metadata: str) -> dict:
+        """Custom::SAMLProvider properties of a metadata file: inline or gzip S3 asset, and its sha256
+
+        The properties only change, and the provider is only updated, when the document does.
+        """
+        metadata = load_metadata(idp_metadata)
+        incremental.track_file(self, idp_metadata)
+        properties = dict(Name=idp_name, MetadataHash=hashlib.sha256(metadata.encode('utf8')).hexdigest())
+        if len(metadata.encode('utf8')) <= METADATA_INLINE_LIMIT:
+            return dict(properties, Metadata=metadata)
+        from aws_cdk import aws_s3_assets
+        asset = aws_s3_assets.Asset(self, 'metadata', path=_metadata_asset(metadata))
+        asset.grant_read(self._lambda)
+        return dict(properties, MetadataS3=dict(Bucket=asset.s3_bucket_name, Key=asset.s3_object_key))
+
     @property
     def arn(self):
         return self._idp.ref
@@ -82,3 +190,50 @@ class IAMIdpSAML(CDKLambda):
     @property
     def idp(self):
         return self._idp
+
+
+class IAMIdpSAMLProviders(core.Construct):
+    _idps: 'cfn.CustomResource' = None
+
+    def __init__(self, scope: core.Construct, id: str, providers: typing.Dict[str, str], *, cfn_lambda: str=None, cfn_resources_path: str=None):
+        """Create several IAM SAML Identity Providers with one custom resource
+
+        The Custom::SAMLProviders resource is backed by the provider lambda shared
+        by the stack (see saml_provider_function), which fetches the metadata of
+        all the providers concurrently.
+
+        Args:
+            scope (core.Construct): [description]
+            id (str): [description]
+            providers (dict): IAM Idp name -> SAML Identity provider metadata URL
+            cfn_lambda (str, optional): provider lambda code. Defaults to the packaged saml.py.
+            cfn_resources_path (str, optional): cfn_resources layer zip or directory, see IAMIdpSAML.
+        """
+        super().__init__(scope, id)
+        from aws_cdk import (
+            aws_ssm as ssm,
+            aws_cloudformation as cfn
+        )
+
+        function = saml_provider_function(self, cfn_lambda=cfn_lambda, cfn_resources_path=cfn_resources_path)
+        incremental.track(self, *sorted(providers.items()))
+        self._idps = cfn.CustomResource(
+            self, "identityProviders",
+            resource_type='Custom::SAMLProviders',
+            provider=cfn.CustomResourceProvider.from_lambda(function._lambda.current_version),
+            properties=dict(
+                Providers=[dict(Name=name, URL=url) for name, url in sorted(providers.items())]
+            )
+        )
+
+        # Export
+        for name in sorted(providers):
+            ssm.StringParameter(self, f"ssm-{name}", string_value=self.arn(name), parameter_name='/{}/{}'.format(id.replace('-', '/'), name))
+
+    def arn(self, idp_name: str) -> str:
+        """ARN of an IAM Idp"""
+        return self._idps.get_att(idp_name).to_string()
+
+    @property
+    def idps(self):
+        return self._idps
@@ -0,0 +1,237 @@
+"""Incremental synth: reuse the previous synth output of unchanged stacks
+
+Enabled on aviv_cdk.core.App with the 'aviv:incremental' context or the
+AVIV_CDK_INCREMENTAL env var (1 or the cache directory). Before synth, each
+group of dependent top level stacks (see aviv_cdk.synth.stack_groups) gets
+a fingerprint of its inputs:
+
+- aviv_cdk version, the app context and CDK_* environment variables
+- the construct tree (paths and classes)
+- the CloudFormation properties of every resource, as given to CDK (the
+  tree.json attributes, resolved when possible)
+- the content of every asset source (AssetStaging)
+- the Python sources of the app (__main__) and of the construct classes used
+- the inputs recorded with track() / track_file(): Stack props, buildspecs,
+  lambda code given as a path...
+
+Groups with a cached fingerprint are left out of the synth and their
+artifacts copied back from the cache into the cloud assembly. A group with an
+asset whose source can't be hashed is always synthesized. Anything else a
+stack depends on (e.g. values read from the network) must be recorded with
+track() to invalidate the cache.
+"""
+import os
+import sys
+import json
+import shutil
+import hashlib
+import inspect
+import logging
+import typing
+from aws_cdk import core
+from . import __version__, synth
+
+
+INCREMENTAL_ENV = 'AVIV_CDK_INCREMENTAL'
+INCREMENTAL_CONTEXT = 'aviv:incremental'
+CACHE_DIR = '.aviv-cdk/synth-cache'
+
+
+def enabled(scope: core.Construct=None) -> typing.Optional[str]:
+    """Returns the cache directory if incremental synth is enabled"""
+    value = os.environ.get(INCREMENTAL_ENV)
+    if not value and scope is not None:
+        value = scope.node.try_get_context(INCREMENTAL_CONTEXT)
+    if not value or str(value).lower() in ('0', 'false', 'no', 'off'):
+        return None
+    if str(value).lower() in ('1', 'true', 'yes', 'on'):
+        return CACHE_DIR
+    return str(value)
+
+
+def _inputs(stack: core.Stack) -> list:
+    if not hasattr(stack, '_aviv_inputs'):
+        stack._aviv_inputs = list()
+    return stack._aviv_inputs
+
+
+def track(scope: core.Construct, *values):
+    """Record values the stack of scope depends on (must be JSON serializable or have a stable repr)"""
+    _inputs(core.Stack.of(scope)).extend(values)
+
+
+def hash_path(path: str) -> str:
+    """sha256 of a file, or of a directory tree (relative paths and contents, symlinks followed)"""
+    digest = hashlib.sha256()
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path, followlinks=True):
+            dirs.sort()
+            for name in sorted(files):
+                filename = os.path.join(root, name)
+                digest.update(os.path.relpath(filename, path).encode('utf8') + b'\0')
+                with open(filename, 'rb') as fp:
+                    digest.update(fp.read())
+    else:
+        with open(path, 'rb') as fp:
+            digest.update(fp.read())
+    return digest.hexdigest()
+
+
+def track_file(scope: core.Construct, path: str):
+    """Record a file or directory the stack of scope depends on (buildspec, lambda code, assets...)"""
+    track(scope, ('file', path, hash_path(path)))
+
+
+def _source(module_name: str) -> str:
+    module = sys.modules.get(module_name)
+    try:
+        return inspect.getsource(module) if module else ''
+    except (OSError, TypeError):
+        return ''
+
+
+def _properties(stack: core.Stack, resource: core.CfnResource):
+    """CloudFormation type and properties of a resource, as in tree.json"""
+    inspector = core.TreeInspector()
+    resource.inspect(inspector)
+    try:
+        return stack.resolve(inspector.attributes)
+    except Exception:
+        # e.g. cross stack references, only resolvable once the app is prepared
+        return json.dumps(inspector.attributes, sort_keys=True, default=str)
+
+
+def _asset(staging: core.AssetStaging) -> typing.Optional[list]:
+    """Asset hash and source content hash, None when the source can't be hashed"""
+    from .assets import tree_hash
+    path = staging.source_path
+    if not path or not os.path.exists(path):
+        return None
+    return [staging.asset_hash, tree_hash(path)]
+
+
+def fingerprint(stacks: typing.List[core.Stack], context: dict=None) -> typing.Optional[str]:
+    """Fingerprint of a group of stacks inputs, None if an asset of the group can't be fingerprinted"""
+    digest = hashlib.sha256()
+
+    def update(value):
+        digest.update(json.dumps(value, sort_keys=True, default=repr).encode('utf8'))
+        digest.update(b'\0')
+
+    update(__version__)
+    update(context or dict())
+    update(os.environ.get('CDK_CONTEXT_JSON'))
+    update(sorted((k, v) for k, v in os.environ.items() if k.startswith('CDK_') and k not in ('CDK_CONTEXT_JSON', 'CDK_OUTDIR')))
+    update(_source('__main__'))
+    modules = set()
+    for stack in stacks:
+        update(_inputs(stack))
+        for construct in stack.node.find_all():
+            cls = type(construct)
+            update([construct.node.path, cls.__module__, cls.__name__])
+            modules.add(cls.__module__)
+            if isinstance(construct, core.CfnResource):
+                update(_properties(stack, construct))
+            elif isinstance(construct, core.AssetStaging):
+                asset = _asset(construct)
+                if asset is None:
+                    logging.info(f"Incremental synth: {construct.node.path} source can't be hashed, {stack.node.id} isn't cached")
+                    return None
+                update(asset)
+    for module in sorted(modules):
+        if not module.split('.')[0] in ('aws_cdk', 'constructs', 'jsii'):
+            update(_source(module))
+    return digest.hexdigest()
+
+
+class SynthCache:
+    def __init__(self, cache_dir: str=CACHE_DIR, context: dict=None) -> None:
+        self.cache_dir = cache_dir
+        self.context = context
+        self.fresh = dict()
+        self.reused = dict()
+
+    def _dir(self, stacks: typing.List[core.Stack], fp: str) -> str:
+        return os.path.join(self.cache_dir, stacks[0].node.id, fp)
+
+    def prepare(self, app: core.App) -> typing.List[str]:
+        """Remove the stack groups with a cache hit from the app
+
+        Returns:
+            list: ids of the stacks reused from cache
+        """
+        reused = list()
+        for group in synth.stack_groups(app):
+            fp = fingerprint(group, self.context)
+            if fp is None:
+                continue
+            gdir = self._dir(group, fp)
+            if os.path.exists(os.path.join(gdir, 'manifest.json')):
+                self.reused[gdir] = [stack.node.id for stack in group]
+                for stack in group:
+                    reused.append(stack.node.id)
+                    app.node.try_remove_child(stack.node.id)
+            else:
+                # Manifest artifacts are named after the stack name, the tree after the construct id
+                self.fresh[gdir] = dict((stack.artifact_id, stack.node.id) for stack in group)
+        logging.info(f"Incremental synth: {len(reused)} stack(s) from cache")
+        return reused
+
+    def finalize(self, outdir: str):
+        """Save freshly synthesized groups to the cache and restore the cached ones in outdir"""
+        with open(os.path.join(outdir, 'manifest.json')) as fp:
+            manifest = json.load(fp)
+        # Dummy values for missing context lookups mustn't be cached
+        if not manifest.get('missing'):
+            for gdir, stack_ids in self.fresh.items():
+                self._save(outdir, manifest, stack_ids, gdir)
+        if self.reused:
+            synth.merge([outdir] + list(self.reused), outdir)
+
+    @staticmethod
+    def _artifact_files(outdir: str, artifact_id: str, artifact: dict) -> typing.Set[str]:
+        files = set()
+        properties = artifact.get('properties', dict())
+        for key in ('templateFile', 'file'):
+            if key in properties:
+                files.add(properties[key])
+        if artifact['type'] == 'cdk:asset-manifest':
+            with open(os.path.join(outdir, properties['file'])) as fp:
+                assets = json.load(fp)
+            for asset in assets.get('files', dict()).values():
+                files.add(asset['source']['path'])
+            for asset in assets.get('dockerImages', dict()).values():
+                files.add(asset['source']['directory'])
+        for entries in artifact.get('metadata', dict()).values():
+            for entry in entries:
+                if entry['type'] == 'aws:cdk:asset':
+                    files.add(entry['data']['path'])
+        return files
+
+    def _save(self, outdir: str, manifest: dict, stack_ids: typing.Dict[str, str], gdir: str):
+        artifacts = dict()
+        for aid, artifact in manifest['artifacts'].items():
+            if aid in stack_ids or aid in [f"{sid}.assets" for sid in stack_ids]:
+                artifacts[aid] = artifact
+        if os.path.exists(os.path.dirname(gdir)):
+            # Only keep the last fingerprint per group
+            shutil.rmtree(os.path.dirname(gdir))
+        os.makedirs(gdir)
+        for aid, artifact in artifacts.items():
+            for name in self._artifact_files(outdir, aid, artifact):
+                src = os.path.join(outdir, name)
+                if os.path.isdir(src):
+                    shutil.copytree(src, os.path.join(gdir, name))
+                elif os.path.exists(src):
+                    shutil.copy2(src, os.path.join(gdir, name))
+
+        treefile = os.path.join(outdir, 'tree.json')
+        if os.path.exists(treefile):
+            with open(treefile) as fp:
+                tree = json.load(fp)
+            children = tree['tree'].get('children', dict())
+            tree['tree']['children'] = dict((k, v) for k, v in children.items() if k in stack_ids.values())
+            with open(os.path.join(gdir, 'tree.json'), 'w') as fp:
+                json.dump(tree, fp, indent=2)
+        with open(os.path.join(gdir, 'manifest.json'), 'w') as fp:
+            json.dump(dict(manifest, artifacts=artifacts, missing=[]), fp, indent=2)
@@ -0,0 +1,151 @@
+"""Lambda dependency layers built from a requirements.txt
+
+    from aviv_cdk import layers
+    CDKLambda(self, 'fn', layer_attrs=dict(code=layers.layer_code('lambdas/cfn_resources/requirements.txt')), ...)
+
+build_layer() installs the requirements for the Lambda platform (manylinux
+wheels, python/ prefix) from a local wheel cache, only downloading what is
+missing from it, and writes a reproducible zip: sorted entries, fixed
+timestamps and permissions, no __pycache__, tests or dist-info bookkeeping.
+The zip is named after the lock hash (requirements, python version,
+platform) and isn't built again while that hash is unchanged.
+"""
+import os
+import sys
+import glob
+import hashlib
+import logging
+import zipfile
+import tempfile
+import subprocess
+import typing
+
+
+WHEEL_CACHE = '.aviv-cdk/wheels'
+LAYERS_DIR = 'build/layers'
+ZIP_DATE = (1980, 1, 1, 0, 0, 0)
+# Bump to rebuild the layers after a change of this module
+BUILDER_VERSION = 1
+
+JUNK_DIRS = ('__pycache__', 'tests', 'test')
+JUNK_SUFFIXES = ('.pyc', '.pyo')
+# dist-info files nothing reads at runtime (METADATA, entry_points.txt... are kept for importlib.metadata)
+DIST_INFO_JUNK = ('RECORD', 'INSTALLER', 'REQUESTED', 'WHEEL', 'direct_url.json')
+
+
+def read_requirements(requirements: str) -> typing.List[str]:
+    """Requirement lines without comments and blank lines, -r includes expanded"""
+    lines = list()
+    with open(requirements) as fp:
+        for line in fp:
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            if line.startswith(('-r ', '--requirement ')):
+                include = os.path.join(os.path.dirname(requirements), line.split(None, 1)[1])
+                lines.extend(read_requirements(include))
+            else:
+                lines.append(line)
+    return lines
+
+
+def lock_hash(requirements: str, *, python_version: str='3.8', platform: str='manylinux2014_x86_64') -> str:
+    """Hash of everything that ends up in the layer"""
+    digest = hashlib.sha256()
+    for value in [BUILDER_VERSION, python_version, platform] + sorted(read_requirements(requirements)):
+        digest.update(str(value).encode('utf8') + b'\0')
+    return digest.hexdigest()
+
+
+def _pip(*args: str):
+    cmd = [sys.executable, '-m', 'pip', '--disable-pip-version-check', '--quiet'] + list(args)
+    logging.debug(f"Layer: {' '.join(cmd)}")
+    return subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+
+
+def _junk(relpath: str) -> bool:
+    parts = relpath.split(os.sep)
+    if any(part in JUNK_DIRS for part in parts[:-1]) or relpath.endswith(JUNK_SUFFIXES):
+        return True
+    return len(parts) > 1 and parts[-2].endswith('.dist-info') and parts[-1] in DIST_INFO_JUNK
+
+
+def write_zip(src: str, filename: str) -> int:
+    """Reproducible zip of src: same files, same bytes
+
+    Returns:
+        int: number of files
+    """
+    entries = list()
+    for root, dirs, files in os.walk(src):
+        for name in files:
+            relpath = os.path.relpath(os.path.join(root, name), src)
+            if not _junk(relpath):
+                entries.append(relpath)
+    tmp = filename + '.tmp'
+    with zipfile.ZipFile(tmp, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for relpath in sorted(entries):
+            info = zipfile.ZipInfo(relpath.replace(os.sep, '/'), date_time=ZIP_DATE)
+            mode = 0o755 if os.access(os.path.join(src, relpath), os.X_OK) else 0o644
+            info.external_attr = (0o100000 | mode) << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with open(os.path.join(src, relpath), 'rb') as fp:
+                zf.writestr(info, fp.read())
+    os.replace(tmp, filename)
+    return len(entries)
+
+
+def build_layer(requirements: str, *, name: str=None, outdir: str=LAYERS_DIR, wheel_cache: str=WHEEL_CACHE, python_version: str='3.8', platform: str='manylinux2014_x86_64', index_url: str=None, prefix: str='python') -> str:
+    """Build a layer zip from a requirements file, unless it's already built
+
+    Args:
+        requirements (str): requirements.txt path (pin versions for a stable lock hash)
+        name (str, optional): layer name. Defaults to the requirements directory name.
+        outdir (str, optional): where the zip is written. Defaults to LAYERS_DIR.
+        wheel_cache (str, optional): local wheel cache/index directory. Defaults to WHEEL_CACHE.
+        python_version (str, optional): Lambda runtime python version. Defaults to '3.8'.
+        platform (str, optional): wheels platform. Defaults to 'manylinux2014_x86_64'.
+        index_url (str, optional): package index to download missing wheels from. Defaults to pip's.
+        prefix (str, optional): directory of the packages in the zip. Defaults to 'python'.
+
+    Returns:
+        str: layer zip path (absolute, as jsii resolves relative asset paths against the cwd of its node process)
+    """
+    name = name or os.path.basename(os.path.dirname(os.path.abspath(requirements)))
+    lock = lock_hash(requirements, python_version=python_version, platform=platform)
+    filename = os.path.abspath(os.path.join(outdir, f"{name}-{lock[:16]}.zip"))
+    if os.path.exists(filename):
+        logging.info(f"Layer: {filename} is up to date")
+        return filename
+
+    os.makedirs(outdir, exist_ok=True)
+    os.makedirs(wheel_cache, exist_ok=True)
+    target = ['--only-binary=:all:', '--platform', platform, '--python-version', python_version, '--implementation', 'cp']
+    with tempfile.TemporaryDirectory() as tmp:
+        install = ['install', '-r', requirements, '-t', os.path.join(tmp, prefix), '--no-compile'] + target
+        # Offline from the wheel cache first
+        result = _pip(*install, '--no-index', '--find-links', wheel_cache)
+        if result.returncode:
+            download = ['download', '-r', requirements, '-d', wheel_cache] + target
+            if index_url:
+                download += ['--index-url', index_url]
+            result = _pip(*download)
+            if result.returncode:
+                raise RuntimeError(f"Layer {name}: pip download failed\n{result.stdout}")
+            result = _pip(*install, '--no-index', '--find-links', wheel_cache)
+            if result.returncode:
+                raise RuntimeError(f"Layer {name}: pip install failed\n{result.stdout}")
+        count = write_zip(tmp, filename)
+
+    # Only keep the current build
+    for old in glob.glob(os.path.join(os.path.dirname(filename), f"{name}-*.zip")):
+        if old != filename:
+            os.remove(old)
+    logging.info(f"Layer: {filename} built ({count} files)")
+    return filename
+
+
+def layer_code(requirements: str, **options) -> 'aws_lambda.AssetCode':
+    """build_layer() as a lambda AssetCode (options are passed to build_layer)"""
+    from . import assets
+    return assets.lambda_code(build_layer(requirements, **options))
@@ -1,21 +1,20 @@
 import os
+import json
 import logging
 import typing
+import functools
 import constructs
 from . import __json_load as loadjson
+from .core import ssm_lookup
+from . import incremental
 from aws_cdk import (
     aws_codebuild as cb,
     aws_codepipeline as cp,
     aws_codepipeline_actions as cpa,
-    aws_codestarconnections as csc,
-    aws_cloudformation as cfn,
-    aws_s3,
-    aws_ssm,
-    aws_kms,
-    aws_ec2,
     aws_iam,
     core
 )
+# aws_codestarconnections, aws_s3, aws_kms & aws_ec2 are only imported where used
 
 
 # Force CDK 'new' bootstrap/synth style
@@ -33,18 +32,93 @@ def buildenv(environment_variables: dict):
             envs[env] = cb.BuildEnvironmentVariable(value=value)
     return envs
 
-def load_buildspec(specfile):
+BUILDSPEC_CACHE_SIZE = 64
+
+# Pipeline build cache profiles: local cache modes, or 's3' for the pipeline artifact bucket
+CACHE_PROFILES = {
+    'docker': [cb.LocalCacheMode.DOCKER_LAYER],
+    'source': [cb.LocalCacheMode.SOURCE],
+    'custom': [cb.LocalCacheMode.CUSTOM],
+    'local': [cb.LocalCacheMode.DOCKER_LAYER, cb.LocalCacheMode.SOURCE, cb.LocalCacheMode.CUSTOM],
+    's3': None
+}
+CACHE_PREFIX = 'codebuild-cache/'
+
+def load_buildspec(specfile) -> cb.BuildSpec:
+    """Load a buildspec file, parsed once and shared as long as the file doesn't change
+
+    Args:
+        specfile (str): buildspec (YAML) file path
+
+    Returns:
+        cb.BuildSpec: shared BuildSpec object
+    """
+    st = os.stat(specfile)
+    return _load_buildspec(os.path.realpath(specfile), st.st_mtime_ns, st.st_size)
+
+def buildspec_batch(specfile) -> typing.Optional[dict]:
+    """Batch configuration (build-list, build-graph or build-matrix) of a buildspec file, if any"""
+    st = os.stat(specfile)
+    return _read_buildspec(os.path.realpath(specfile), st.st_mtime_ns, st.st_size).get('batch')
+
+@functools.lru_cache(maxsize=BUILDSPEC_CACHE_SIZE)
+def _read_buildspec(specfile: str, mtime_ns: int, size: int) -> dict:
     import yaml
+    # libyaml is way faster when available
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
 
     with open(specfile, encoding="utf8") as fp:
-        bsfile = fp.read()
-        bs = yaml.safe_load(bsfile)
-        return cb.BuildSpec.from_object(value=bs)
+        return yaml.load(fp, Loader=loader)
+
+@functools.lru_cache(maxsize=BUILDSPEC_CACHE_SIZE)
+def _load_buildspec(specfile: str, mtime_ns: int, size: int) -> cb.BuildSpec:
+    return cb.BuildSpec.from_object(value=_read_buildspec(specfile, mtime_ns, size))
+
+
+def _project_fingerprint(value, stack: core.Stack):
+    """JSON friendly view of CodeBuild project props, for Pipeline projects pooling"""
+    if isinstance(value, (list, tuple)):
+        return [_project_fingerprint(v, stack) for v in value]
+    if isinstance(value, dict):
+        return dict((k, _project_fingerprint(v, stack)) for k, v in value.items())
+    if isinstance(value, cb.BuildSpec):
+        # Object buildspecs render as a new token on each call: compare their content
+        return stack.resolve(value.to_build_spec())
+    if isinstance(value, core.Duration):
+        return value.to_seconds()
+    if hasattr(value, '_values'):  # jsii struct (BuildEnvironment, SubnetSelection...)
+        return _project_fingerprint(value._values, stack)
+    if hasattr(value, 'image_id'):  # IBuildImage
+        return value.image_id
+    if hasattr(value, 'node'):  # Construct (vpc, security groups, role...)
+        return value.node.path
+    if isinstance(value, (str, int, float, bool, type(None))):
+        return value
+    # Not comparable: never shared
+    return repr(value)
+
+
+def merge_buildspec(artifact_names: typing.List[str]) -> cb.BuildSpec:
+    """Buildspec gathering input artifacts in one output, each one in a folder named after it
+
+    Args:
+        artifact_names (list): input artifact names, the primary one first
+    """
+    commands = ['mkdir -p /tmp/merged/{0} && cp -R ./. /tmp/merged/{0}/'.format(artifact_names[0])]
+    for name in artifact_names[1:]:
+        commands.append('mkdir -p /tmp/merged/{0} && cp -R $CODEBUILD_SRC_DIR_{0}/. /tmp/merged/{0}/'.format(name))
+    commands.append('mv /tmp/merged .merged')
+    return cb.BuildSpec.from_object(value={
+        'version': '0.2',
+        'phases': {'build': {'commands': commands}},
+        'artifacts': {'base-directory': '.merged', 'files': ['**/*']}
+    })
 
 
 class GithubConnection(core.Construct):
     def __init__(self, scope, id, github_config) -> None:
         super().__init__(scope, id)
+        from aws_cdk import aws_codestarconnections as csc
         self.connection = csc.CfnConnection(
             self, 'github-connection',
             connection_name='{}'.format(github_config['owner']),
@@ -54,14 +128,18 @@ class GithubConnection(core.Construct):
 
 
 class Pipeline(cp.Pipeline):
-    bucket: aws_s3.IBucket
+    bucket: 'aws_s3.IBucket'
     connections: typing.Dict[str, str]
 
     named_stages = ['source', 'build', 'publish', 'deploy']
     artifacts: typing.Dict[str, typing.Dict[str, typing.Union[cp.Artifact, typing.List[cp.Artifact]]]]
     actions: typing.Dict[str, typing.Dict[str, cpa.Action]]
-    key: aws_kms.IKey
+    key: 'aws_kms.IKey'
     project: cb.PipelineProject
+    projects: typing.Dict[str, cb.IProject]
+    share_projects: bool = False
+    cache_profile: typing.Union[str, cb.Cache] = None
+    compute_sizer: 'build_sizing.ComputeSizer' = None
     pipe_role: aws_iam.IRole = None
 
     def __init__(
@@ -69,10 +147,14 @@ class Pipeline(cp.Pipeline):
         connections: typing.Dict[str, str]=None,
         *,
         pipe_role: aws_iam.IRole=None,
-        bucket_props: aws_s3.BucketProps=None,
-        artifact_bucket: aws_s3.IBucket=None,
+        share_projects: bool=False,
+        cache_profile: typing.Union[str, cb.Cache]=None,
+        cache_expiration: int=30,
+        compute_sizer: 'build_sizing.ComputeSizer'=None,
+        bucket_props: 'aws_s3.BucketProps'=None,
+        artifact_bucket: 'aws_s3.IBucket'=None,
         cross_account_keys: bool=None,
-        cross_region_replication_buckets: typing.Dict[str, aws_s3.IBucket]=None,
+        cross_region_replication_buckets: typing.Dict[str, 'aws_s3.IBucket']=None,
         pipeline_name: str=None,
         restart_execution_on_update: bool=None,
         role: aws_iam.IRole=None,
@@ -81,6 +163,19 @@ class Pipeline(cp.Pipeline):
         # Aviv Pipeline Pre-Init
         self.artifacts = dict((sname, dict()) for sname in self.named_stages)
         self.actions = dict((sname, dict()) for sname in self.named_stages)
+        # CodeBuild projects created by build(), shared by actions with the same project props when share_projects
+        self.projects = dict()
+        self.share_projects = share_projects
+        self._secrets_granted = set()
+        self._batch_projects = set()
+        # CodeBuildAction props per stage/action, to set the run_order in stage_all()
+        self._action_props = dict((sname, dict()) for sname in self.named_stages)
+        # Build cache, see project_cache()
+        self.cache_profile = cache_profile
+        self.cache_expiration = cache_expiration
+        self._cache = None
+        # Compute types from build durations history (opt-in)
+        self.compute_sizer = compute_sizer
         # Codestar Connections for github and co
         self.connections = connections
 
@@ -98,6 +193,79 @@ class Pipeline(cp.Pipeline):
             role=self.pipe_role,
             stages=stages)
 
+    def project_cache(self) -> typing.Optional[cb.Cache]:
+        """Build cache set on the projects created by this pipeline (build() and create_project())
+
+        cache_profile can be:
+            - 'docker', 'source', 'custom' or 'local' (all three): CodeBuild local cache
+            - 's3': under CACHE_PREFIX in the pipeline artifact bucket, expiring after cache_expiration days
+            - a cb.Cache
+
+        Returns:
+            cb.Cache: one cache object shared by all projects, None without cache_profile
+        """
+        if self._cache or not self.cache_profile:
+            return self._cache
+        if isinstance(self.cache_profile, cb.Cache):
+            self._cache = self.cache_profile
+        elif self.cache_profile not in CACHE_PROFILES:
+            raise ValueError(f"Unknown cache profile: {self.cache_profile} (one of {list(CACHE_PROFILES)})")
+        elif self.cache_profile == 's3':
+            from aws_cdk import aws_s3
+            if isinstance(self.artifact_bucket, aws_s3.Bucket):
+                self.artifact_bucket.add_lifecycle_rule(
+                    id='codebuild-cache-expiration',
+                    prefix=CACHE_PREFIX,
+                    expiration=core.Duration.days(self.cache_expiration)
+                )
+            else:
+                logging.warning(f"Can't add the build cache lifecycle rule to an imported bucket")
+            self._cache = cb.Cache.bucket(self.artifact_bucket, prefix=CACHE_PREFIX)
+        else:
+            self._cache = cb.Cache.local(*CACHE_PROFILES[self.cache_profile])
+        return self._cache
+
+    def sized_environment(self, name: str, environment: cb.BuildEnvironment=None) -> typing.Optional[cb.BuildEnvironment]:
+        """Set the compute type picked by the compute_sizer for this action/project
+
+        An environment with a compute type, no compute_sizer or no history for name: environment is returned as is.
+        """
+        if not self.compute_sizer:
+            return environment
+        if environment is not None and not isinstance(environment, cb.BuildEnvironment):
+            # A build image (create_project default)
+            environment = cb.BuildEnvironment(build_image=environment)
+        if environment is not None and environment.compute_type:
+            return environment
+        compute_type = self.compute_sizer.compute_type(name)
+        if not compute_type:
+            return environment
+        values = dict(environment._values) if environment else dict()
+        values['compute_type'] = compute_type
+        return cb.BuildEnvironment(**values)
+
+    def enable_batch(self, project: cb.IProject):
+        """Enable CodeBuild batch builds (build-list, build-graph or build-matrix) on a project
+
+        The project role is used as the batch service role (projects created in this app only),
+        and the pipeline role gets the batch permissions on this project.
+        """
+        if project.node.path in self._batch_projects:
+            return
+        self._batch_projects.add(project.node.path)
+        if isinstance(project, cb.Project):
+            project.add_to_role_policy(aws_iam.PolicyStatement(
+                actions=['codebuild:StartBuild', 'codebuild:StopBuild', 'codebuild:RetryBuild'],
+                resources=[project.project_arn]
+            ))
+            project.node.default_child.add_property_override('BuildBatchConfig.ServiceRole', project.role.role_arn)
+        if self.pipe_role:
+            self.pipe_role.add_to_principal_policy(aws_iam.PolicyStatement(
+                actions=['codebuild:StartBuildBatch', 'codebuild:BatchGetBuildBatches', 'codebuild:StopBuildBatch'],
+                resources=[project.project_arn]
+            ))
+        logging.info(f"Batch builds enabled on {project.node.path}")
+
     @staticmethod
     def _role(scope: constructs.Construct, id: str='role'):
         """Mimic CDK role for multi-accounts deployment
@@ -147,26 +315,29 @@ class Pipeline(cp.Pipeline):
     def create_project(self, id: str,
         *,  # Optionnal
         build_spec_file: str='buildspec.yml',
+        batch: bool=None,
         # Std PipelineProject args
         allow_all_outbound: bool=None,
         badge: bool=None,
         build_spec: cb.BuildSpec=None,
         cache: cb.Cache=None,
         description: str=None,
-        encryption_key: aws_kms.IKey=None,
+        encryption_key: 'aws_kms.IKey'=None,
         environment: cb.BuildEnvironment=cb.LinuxBuildImage.STANDARD_4_0,
         environment_variables: typing.Dict[str, cb.BuildEnvironmentVariable]=None,
         file_system_locations: typing.List[cb.IFileSystemLocation]=None,
         grant_report_group_permissions: bool=None,
         project_name: str=None,
         role: aws_iam.IRole=None,
-        security_groups: typing.List[aws_ec2.ISecurityGroup]=None,
-        subnet_selection: aws_ec2.SubnetSelection=None,
+        security_groups: typing.List['aws_ec2.ISecurityGroup']=None,
+        subnet_selection: 'aws_ec2.SubnetSelection'=None,
         timeout: core.Duration=None,
-        vpc: aws_ec2.IVpc=None) -> cb.PipelineProject:
+        vpc: 'aws_ec2.IVpc'=None) -> cb.PipelineProject:
         """THIS IS A CODEPIPELINE PROJECT!!!
 
         Args:
+            build_spec_file (str): buildspec file, used without build_spec
+            batch (bool): enable batch builds, defaults to the presence of a 'batch' section in build_spec_file
             see PipelineProjectProps
         Returns:
             cb.PipelineProject: [description]
@@ -174,10 +345,16 @@ class Pipeline(cp.Pipeline):
 
         if not build_spec and build_spec_file:
             build_spec = load_buildspec(build_spec_file)
+            incremental.track_file(self, build_spec_file)
+            if batch is None:
+                batch = bool(buildspec_batch(build_spec_file))
+        if not cache:
+            cache = self.project_cache()
+        environment = self.sized_environment(id, environment)
 
         logging.info("Create project: {}".format(project_name))
 
-        return cb.PipelineProject(
+        project = cb.PipelineProject(
             self, id,
             allow_all_outbound=allow_all_outbound,
             badge=badge,
@@ -196,9 +373,146 @@ class Pipeline(cp.Pipeline):
             timeout=timeout,
             vpc=vpc,
         )
+        if batch:
+            self.enable_batch(project)
+        return project
+
+    def pooled_project(self, action_name: str, project_props: dict) -> typing.Tuple[cb.IProject, typing.Dict[str, cb.BuildEnvironmentVariable]]:
+        """Get or create the CodeBuild project for these props
+
+        With share_projects, projects are shared when their props are the same, except for the environment variables values
+        (only their names and types must match): those are returned to be set on the action.
+        Off by default: a shared project is named after its first action, so enabling it changes logical IDs.
+
+        Args:
+            action_name (str): used to name the project when it's created
+            project_props (dict): cb.ProjectProps as a dict, with a build_spec
+
+        Returns:
+            (cb.IProject, dict): the project and the action level environment variables
+        """
+        props = dict(project_props)
+        envs = props.get('environment_variables') or dict()
+        props['environment_variables'] = sorted((env, str(var.type)) for env, var in envs.items())
+        key = json.dumps(_project_fingerprint(props, core.Stack.of(self)), sort_keys=True)
+
+        if self.share_projects and key in self.projects:
+            logging.info(f"Build: {action_name} shares project {self.projects[key].node.id}")
+            return self.projects[key], envs
+
+        project = cb.Project(self, f"{action_name}-project", **project_props)
+        if self.share_projects:
+            self.projects[key] = project
+        return project, dict()
+
+    def _build_shards(self, action_name: str, shards: int, merge: bool, *, outputs: typing.List[cp.Artifact]=None,
+        environment_variables: typing.Dict[str, cb.BuildEnvironmentVariable]=None, run_order: typing.Union[int, float]=None,
+        variables_namespace: str=None, **action_props):
+        """Shard actions, and the merge action when merge is set
+
+        outputs and variables_namespace are those of the merge action. Without merge,
+        outputs are one artifact per shard and variables_namespace is suffixed with the shard index.
+
+        Raises:
+            ValueError: without merge, when there isn't one output per shard
+        """
+        if not merge and outputs and len(outputs) != shards:
+            raise ValueError(f"{action_name}: {len(outputs)} outputs for {shards} shards, provide one per shard or merge_shards")
+        actions = list()
+        shard_outputs = list()
+        for i in range(shards):
+            envs = dict(environment_variables or dict())
+            envs['SHARD_INDEX'] = cb.BuildEnvironmentVariable(value=str(i))
+            envs['SHARD_COUNT'] = cb.BuildEnvironmentVariable(value=str(shards))
+            if not merge and outputs:
+                output = outputs[i]
+            else:
+                output = cp.Artifact('{}_shard{}'.format(action_name.replace('-', '_'), i))
+            action, _ = self.build(
+                f"{action_name}-{i}", environment_variables=envs, outputs=[output], run_order=run_order,
+                variables_namespace=f"{variables_namespace}{i}" if variables_namespace and not merge else None, **action_props
+            )
+            actions.append(action)
+            shard_outputs.append(output)
+
+        if not merge:
+            self.artifacts['build'][action_name] = shard_outputs
+            return actions, shard_outputs
+
+        outputs = outputs if outputs else [cp.Artifact(action_name)]
+        project, _ = self.pooled_project(f"{action_name}-merge", dict(
+            build_spec=merge_buildspec([output.artifact_name for output in shard_outputs])
+        ))
+        action, outputs = self.build(
+            action_name, input=shard_outputs[0], extra_inputs=shard_outputs[1:], outputs=outputs, project=project,
+            role=action_props.get('role'), run_order=run_order + 1 if run_order is not None else None,
+            variables_namespace=variables_namespace
+        )
+        return actions + [action], outputs
+
+    def schedule(self, sname: str='build') -> typing.Dict[str, int]:
+        """Compute the run_order of the stage actions created without one
+
+        An action depends on the actions producing its input artifacts (see build() depends_on).
+        It runs in the wave after its last dependency, so independent actions run in parallel.
+
+        Args:
+            sname (str, optional): named stage. Defaults to 'build'.
+
+        Raises:
+            ValueError: on dependency cycles
 
-    def stage_all(self):
+        Returns:
+            dict: action name -> run_order, for the actions scheduled
+        """
+        props = self._action_props[sname]
+        producers = dict()
+        for name, aprops in props.items():
+            for artifact in aprops['outputs']:
+                producers[id(artifact)] = name
+        dependencies = dict()
+        for name, aprops in props.items():
+            inputs = [aprops['input']] + list(aprops['extra_inputs'])
+            dependencies[name] = set(producers[id(a)] for a in inputs if id(a) in producers and producers[id(a)] != name)
+
+        orders = dict((name, aprops['run_order']) for name, aprops in props.items() if aprops['run_order'] is not None)
+        visiting = list()
+
+        def order(name):
+            if name in orders:
+                return orders[name]
+            if name in visiting:
+                raise ValueError("Build dependency cycle: {}".format(' -> '.join(visiting[visiting.index(name):] + [name])))
+            visiting.append(name)
+            orders[name] = 1 + max([order(dep) for dep in dependencies[name]], default=0)
+            visiting.pop()
+            return orders[name]
+
+        scheduled = dict()
+        for name, aprops in props.items():
+            if aprops['run_order'] is None:
+                scheduled[name] = order(name)
+                self.actions[sname][name] = cpa.CodeBuildAction(**dict(aprops, run_order=scheduled[name]))
+        if scheduled:
+            logging.info("Stage: {} scheduled in {} wave(s)".format(sname, max(orders.values())))
+        return scheduled
+
+    def stage_all(self, schedule: bool=True):
+        """Add a stage per named stage with actions
+
+        Args:
+            schedule (bool, optional): set the run_order of actions without one (see schedule()). Defaults to True.
+        """
+        if self.compute_sizer and self.compute_sizer.choices:
+            report = self.compute_sizer.report()
+            self.node.add_metadata('aviv:compute-sizing', report)
+            for name, choice in report.items():
+                logging.warning("Compute sizing: {} -> {} (~{}s for a {}s target)".format(
+                    name, choice['compute_type'], choice['estimated_duration'], choice['target']
+                ))
         for sname in self.named_stages:
+            if schedule:
+                self.schedule(sname)
             actions = list(self.actions[sname].values())
             if actions:
                 logging.info("Stage: {} ({} actions)".format(sname, len(actions)))
@@ -245,9 +559,7 @@ class Pipeline(cp.Pipeline):
             if owner in self.connections:
                 connection_arn = self.connections[owner]
                 if connection_arn.startswith('aws:ssm:'):
-                    connection_arn = aws_ssm.StringParameter.value_from_lookup(
-                        self, parameter_name=connection_arn.replace('aws:ssm:', '')
-                    )
+                    connection_arn = ssm_lookup(self, connection_arn.replace('aws:ssm:', ''))
             else:
                 raise SystemError("No credentials for Github (need either a connnection_arn or oauth)")
 
@@ -281,25 +593,60 @@ class Pipeline(cp.Pipeline):
         environment_variables: typing.Dict[str, cb.BuildEnvironmentVariable]=None,
         extra_inputs: typing.List[cp.Artifact]=[],
         outputs: typing.List[cp.Artifact]=[],
+        depends_on: typing.List[str]=None,
+        shards: int=None,
+        merge_shards: bool=False,
+        batch: bool=None,
         type: cpa.CodeBuildActionType=cpa.CodeBuildActionType.BUILD,
         role: aws_iam.IRole=None,
         run_order: typing.Union[int, float]=None,
         variables_namespace: str=None) -> typing.Dict[cpa.Action, typing.List[cp.Artifact]]:
+        """Add a CodeBuild action to the build stage
+
+        Without run_order, the action is scheduled by stage_all() after the actions producing its inputs:
+        the action returned is then replaced in self.actions['build'].
+
+        Args:
+            action_name (str): action name
+            sources (list, optional): source action names, the first one being the input
+            depends_on (list, optional): build action names whose outputs are consumed (added as extra inputs)
+            shards (int, optional): run the build as N parallel actions with SHARD_INDEX/SHARD_COUNT environment variables
+            merge_shards (bool, optional): add an action gathering the shards outputs in one artifact (one folder per shard)
+                outputs and variables_namespace are then those of the merge action, else one output per shard and a namespace suffixed with the shard index
+            batch (bool, optional): run a CodeBuild batch build, defaults to the presence of a 'batch' section in build_spec_file
+            see CodeBuildActionProps for the others
+
+        Returns:
+            (cpa.CodeBuildAction, list): the action and its outputs
+            With shards: the list of actions (shards, then merge) and the outputs (merged or per shard)
+        """
 
         if not project:
             if project_props and isinstance(project_props, cb.PipelineProjectProps):
                 project_props = project_props._values
             else:
                 project_props = project_props if project_props else dict()
-            project = cb.Project(
-                self,
-                f"{action_name}-project",
-                build_spec=load_buildspec(build_spec_file)
-            )
+            if not project_props.get('build_spec'):
+                project_props = dict(project_props, build_spec=load_buildspec(build_spec_file))
+                incremental.track_file(self, build_spec_file)
+                if batch is None:
+                    batch = bool(buildspec_batch(build_spec_file))
+            if not project_props.get('cache') and self.project_cache():
+                project_props = dict(project_props, cache=self.project_cache())
+            if self.compute_sizer:
+                project_props = dict(project_props, environment=self.sized_environment(action_name, project_props.get('environment')))
+            project, project_envs = self.pooled_project(action_name, project_props)
+            if project_envs:
+                environment_variables = dict(project_envs, **(environment_variables or dict()))
+        if batch:
+            self.enable_batch(project)
 
         if not role and self.pipe_role:
             role = self.pipe_role
 
+        if shards and shards > 1:
+            # Outputs of the merge action, or of each shard
+            requested_outputs = outputs
         if not outputs:
             outputs = [cp.Artifact(action_name)]
 
@@ -309,11 +656,21 @@ class Pipeline(cp.Pipeline):
             if len(sources) > 1:
                 extra_inputs=[self.artifacts['source'][extra] for extra in sources[1:]]
 
+        if depends_on:
+            extra_inputs = list(extra_inputs) + [artifact for dep in depends_on for artifact in self.artifacts['build'][dep]]
+
         if not input:
             raise SyntaxError('No input artifact to build')
 
+        if shards and shards > 1:
+            return self._build_shards(
+                action_name, shards, merge_shards,
+                input=input, project=project, environment_variables=environment_variables, extra_inputs=extra_inputs,
+                outputs=requested_outputs, type=type, role=role, run_order=run_order, batch=batch, variables_namespace=variables_namespace
+            )
+
         logging.info("Build: {} ({} extra(s))".format(action_name, len(extra_inputs)))
-        action = cpa.CodeBuildAction(
+        action_props = dict(
             input=input,
             project=project,
             environment_variables=environment_variables,
@@ -325,9 +682,13 @@ class Pipeline(cp.Pipeline):
             run_order=run_order,
             variables_namespace=variables_namespace
         )
+        if batch:
+            action_props['execute_batch_build'] = True
+        action = cpa.CodeBuildAction(**action_props)
+        self._action_props['build'][action_name] = action_props
 
-        if environment_variables:
-            for enval in environment_variables.items():
+        if environment_variables and project.node.path not in self._secrets_granted:
+            for enval in environment_variables.values():
                 if enval.type == cb.BuildEnvironmentVariableType.SECRETS_MANAGER:
                     logging.warning(f"Adding permission to SecretsManager for {action_name}")
                     # Why not generated by CDK? with read only perm on specific params?
@@ -335,7 +696,8 @@ class Pipeline(cp.Pipeline):
                     project.role.add_managed_policy(
                         aws_iam.ManagedPolicy.from_aws_managed_policy_name(managed_policy_name='SecretsManagerReadWrite')
                     )
-                    # Only needed once
+                    # Only needed once (per project)
+                    self._secrets_granted.add(project.node.path)
                     break
 
         self.artifacts['build'][action_name] = outputs
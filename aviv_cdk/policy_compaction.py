@@ -0,0 +1,258 @@
+"""IAM policy documents compaction
+
+compact(document) returns a smaller document granting exactly the same
+permissions:
+
+- Action, Resource and Principal lists are deduplicated and values covered
+  by a wildcard of the same statement dropped (`s3:*` covers `s3:Get*`)
+- statements with the same effect, condition and principal are merged when
+  they share their resources (actions are merged) or their actions
+  (resources are merged), and principals are merged when everything else is
+  the same
+- with a catalog of the service actions, actions are collapsed into
+  `service:*` or `service:<Verb>*` wildcards, only when the wildcard matches
+  nothing else than what was granted
+
+Statements with a Sid, NotAction, NotResource or NotPrincipal are left as is.
+split(document, limit) then cuts a document into several ones under a size
+limit, take(document, limit) keeps its first statements under a limit. The
+aviv_cdk.iam.PolicyCompactor Aspect applies them to the synthesized templates of stacks.
+"""
+import os
+import re
+import json
+import functools
+import typing
+
+
+COMPACT_POLICIES_ENV = 'AVIV_CDK_COMPACT_POLICIES'
+COMPACT_POLICIES_CONTEXT = 'aviv:compact-policies'
+# Sizes without whitespace, see IAM quotas. Inline limits are per role/user/group,
+# for all its inline policies together
+INLINE_LIMIT = 10240
+USER_INLINE_LIMIT = 2048
+GROUP_INLINE_LIMIT = 5120
+MANAGED_LIMIT = 6144
+_NOT = ('NotAction', 'NotResource', 'NotPrincipal')
+
+
+def enabled(scope=None) -> bool:
+    """PolicyCompactor on aviv_cdk.core.App, from the env or context"""
+    value = os.environ.get(COMPACT_POLICIES_ENV)
+    if not value and scope is not None:
+        value = scope.node.try_get_context(COMPACT_POLICIES_CONTEXT)
+    return bool(value) and str(value).lower() not in ('0', 'false', 'no', 'off')
+
+
+def size(document: dict) -> int:
+    return len(json.dumps(document, separators=(',', ':')))
+
+
+def _list(value) -> list:
+    if value is None:
+        return list()
+    return list(value) if isinstance(value, (list, tuple)) else [value]
+
+
+def _one(values: list):
+    return values[0] if len(values) == 1 else values
+
+
+def _key(value) -> str:
+    return json.dumps(value, sort_keys=True)
+
+
+@functools.lru_cache(maxsize=4096)
+def _regex(pattern: str, ignore_case: bool) -> typing.Pattern:
+    regex = ''.join('.*' if c == '*' else '.' if c == '?' else re.escape(c) for c in pattern)
+    return re.compile(regex, re.IGNORECASE | re.DOTALL if ignore_case else re.DOTALL)
+
+
+def match(pattern, value, ignore_case: bool=False) -> bool:
+    """IAM wildcard matching (* and ?) of strings, equality of anything else (CFN intrinsics)"""
+    if not isinstance(pattern, str) or not isinstance(value, str):
+        return _key(pattern) == _key(value)
+    return _regex(pattern, ignore_case).fullmatch(value) is not None
+
+
+def covers(pattern, value, ignore_case: bool=False) -> bool:
+    """True if every value matched by the `value` pattern is matched by `pattern`"""
+    if not isinstance(pattern, str) or not isinstance(value, str):
+        return _key(pattern) == _key(value)
+    # A ? can't stand for a * of the other pattern
+    if '*' in value and '?' in pattern:
+        return pattern == value
+    return match(pattern, value, ignore_case)
+
+
+def _dedupe(values: list, ignore_case: bool=False) -> list:
+    unique = dict()
+    for value in values:
+        k = value.lower() if ignore_case and isinstance(value, str) else _key(value)
+        unique.setdefault(k, value)
+    values = list(unique.values())
+    kept = list()
+    for i, value in enumerate(values):
+        if not any(j != i and covers(other, value, ignore_case) and not (covers(value, other, ignore_case) and j > i) for j, other in enumerate(values)):
+            kept.append(value)
+    return kept
+
+
+def _principal(principal):
+    if not isinstance(principal, dict):
+        return principal
+    return dict((k, _one(_dedupe(_list(v)))) for k, v in sorted(principal.items()))
+
+
+def _merge_principals(principals: list):
+    merged = dict()
+    for principal in principals:
+        for k, v in principal.items():
+            merged.setdefault(k, list()).extend(_list(v))
+    return _principal(merged)
+
+
+def collapse(actions: list, catalog: typing.Dict[str, typing.List[str]]) -> list:
+    """Replace actions by service:* / service:Verb* wildcards matching only granted actions
+
+    Args:
+        actions (list): granted actions (wildcards included)
+        catalog (dict): service prefix -> all its action names (e.g. {'sqs': ['SendMessage', ...]}), must be complete
+    """
+    granted = dict()
+    for action in actions:
+        service = action.split(':', 1)[0].lower() if isinstance(action, str) and ':' in action else None
+        granted.setdefault(service if service in catalog else None, list()).append(action)
+    result = list(granted.pop(None, list()))
+    for service, patterns in granted.items():
+        names = catalog[service]
+        matched = dict((p, set(n for n in names if match(p, f"{service}:{n}", True))) for p in patterns)
+        allowed = set().union(*matched.values())
+        if allowed == set(names):
+            result.append(f"{service}:*")
+            continue
+        covered = set()
+        for verb in sorted(set(re.match(r'[A-Z]?[a-z]*', n).group(0) for n in allowed)):
+            with_verb = set(n for n in names if n.lower().startswith(verb.lower()))
+            if verb and len(with_verb) > 1 and with_verb <= allowed:
+                result.append(f"{service}:{verb}*")
+                covered |= with_verb
+        # Unknown to the catalog, or granting more than the wildcards
+        result.extend(p for p in patterns if not matched[p] or not matched[p] <= covered)
+    return _dedupe(result, True)
+
+
+def _group(statements: list, key: typing.Callable, field: str, ignore_case: bool=False) -> list:
+    groups = dict()
+    for statement in statements:
+        if 'Sid' in statement or any(k in statement for k in _NOT) or field not in statement or \
+                (field == 'Principal' and not isinstance(statement[field], dict)):
+            groups[id(statement)] = [statement]
+        else:
+            groups.setdefault(key(statement), list()).append(statement)
+    merged = list()
+    for group in groups.values():
+        statement = dict(group[0])
+        if len(group) > 1:
+            if field == 'Principal':
+                statement[field] = _merge_principals([s[field] for s in group])
+            else:
+                statement[field] = _dedupe([v for s in group for v in s[field]], ignore_case)
+        merged.append(statement)
+    return merged
+
+
+def compact(document: dict, catalog: typing.Dict[str, typing.List[str]]=None) -> dict:
+    """A smaller policy document with the same permissions
+
+    Args:
+        document (dict): IAM policy document (resolved, may contain CFN intrinsics)
+        catalog (dict, optional): service prefix -> action names, for the wildcards collapse. Defaults to None.
+    """
+    statements = list()
+    for statement in _list(document.get('Statement')):
+        statement = dict(statement)
+        for field in ('Action', 'NotAction'):
+            if field in statement:
+                statement[field] = _dedupe(_list(statement[field]), True)
+        for field in ('Resource', 'NotResource'):
+            if field in statement:
+                statement[field] = _dedupe(_list(statement[field]))
+        if 'Principal' in statement:
+            statement['Principal'] = _principal(statement['Principal'])
+        statements.append(statement)
+
+    condition = lambda s: _key(s.get('Condition'))
+    principal = lambda s: _key(s.get('Principal'))
+    actions = lambda s: _key(sorted(a.lower() if isinstance(a, str) else _key(a) for a in s.get('Action', list())))
+    resources = lambda s: _key(sorted(_key(r) for r in s.get('Resource', list())))
+    statements = _group(statements, lambda s: (s['Effect'], resources(s), condition(s), principal(s)), 'Action', True)
+    if catalog:
+        for statement in statements:
+            if 'Action' in statement and 'Sid' not in statement:
+                statement['Action'] = collapse(statement['Action'], catalog)
+    statements = _group(statements, lambda s: (s['Effect'], actions(s), condition(s), principal(s)), 'Resource')
+    statements = _group(statements, lambda s: (s['Effect'], actions(s), resources(s), condition(s)), 'Principal')
+
+    for statement in statements:
+        for field in ('Action', 'NotAction', 'Resource', 'NotResource'):
+            if field in statement:
+                statement[field] = _one(statement[field])
+    return dict(document, Statement=statements)
+
+
+def _split_statement(statement: dict, limit: int) -> typing.List[dict]:
+    if size(statement) <= limit:
+        return [statement]
+    for field in ('Action', 'Resource'):
+        values = _list(statement.get(field))
+        if len(values) > 1 and 'Sid' not in statement:
+            half = len(values) // 2
+            return _split_statement(dict(statement, **{field: _one(values[:half])}), limit) + \
+                _split_statement(dict(statement, **{field: _one(values[half:])}), limit)
+    return [statement]
+
+
+def split(document: dict, limit: int=MANAGED_LIMIT) -> typing.List[dict]:
+    """Split a document into documents under limit (size without whitespace)
+
+    Statements are spread over the documents, a statement too large on its
+    own is split by actions then resources.
+    """
+    if size(document) <= limit:
+        return [document]
+    empty = size(dict(document, Statement=[]))
+    documents = list()
+    current, current_size = list(), empty
+    for statement in _list(document.get('Statement')):
+        parts = [statement] if size(statement) + empty <= limit else _split_statement(statement, limit - empty)
+        for part in parts:
+            part_size = size(part) + (1 if current else 0)
+            if current and current_size + part_size > limit:
+                documents.append(dict(document, Statement=current))
+                current, current_size = list(), empty
+                part_size = size(part)
+            current.append(part)
+            current_size += part_size
+    if current:
+        documents.append(dict(document, Statement=current))
+    return documents
+
+
+def take(document: dict, limit: int) -> typing.Tuple[dict, typing.Optional[dict]]:
+    """Cut a document in two: its first statements under limit (at least one), and the others (None if none is left)
+
+    A first statement too large on its own is split by actions then resources.
+    """
+    empty = size(dict(document, Statement=[]))
+    statements = _list(document.get('Statement'))
+    if statements and size(statements[0]) + empty > limit:
+        statements = _split_statement(statements[0], limit - empty) + statements[1:]
+    count, current = 0, empty
+    for statement in statements:
+        current += size(statement) + (1 if count else 0)
+        if count and current > limit:
+            break
+        count += 1
+    rest = dict(document, Statement=statements[count:]) if count < len(statements) else None
+    return dict(document, Statement=statements[:count]), rest
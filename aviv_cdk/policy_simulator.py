@@ -0,0 +1,367 @@
+"""Offline IAM policy simulator for synthesized templates
+
+    sim = PolicySimulator.from_cloud_assembly('cdk.out')
+    sim.simulate('stack/role', 's3:GetObject', 'arn:aws:s3:::bucket/key')  # 'Allow', 'Deny' or 'ImplicitDeny'
+
+Roles, users and groups are loaded from the templates with their policies:
+inline ones, AWS::IAM::Policy, AWS::IAM::ManagedPolicy of the templates and
+AWS managed policies given as documents (unknown ones are listed in
+`unknown_policies` and grant nothing), plus permissions boundaries.
+
+Principals are named '<stack>/<logical id>', by their construct path (e.g.
+'stack/role') and by their name when it's a plain string. References to
+resources of the templates and pseudo parameters are substituted where
+possible (see PolicySimulator), the remaining intrinsics only match equal
+values.
+
+Statements are indexed by service prefix, so a query only evaluates the
+statements that can match its action. Resource policies, SCPs and session
+policies aren't evaluated.
+"""
+import os
+import re
+import json
+import logging
+import typing
+from .policy_compaction import match, _list, _key
+
+
+ALLOW = 'Allow'
+DENY = 'Deny'
+IMPLICIT_DENY = 'ImplicitDeny'
+AWS_MANAGED_PREFIX = 'arn:aws:iam::aws:policy/'
+
+
+class _Statement:
+    __slots__ = ('effect', 'actions', 'not_actions', 'resources', 'not_resources', 'condition')
+
+    def __init__(self, statement: dict) -> None:
+        self.effect = statement['Effect']
+        self.actions = _list(statement.get('Action')) if 'Action' in statement else None
+        self.not_actions = _list(statement.get('NotAction')) if 'NotAction' in statement else None
+        self.resources = _list(statement.get('Resource')) if 'Resource' in statement else None
+        self.not_resources = _list(statement.get('NotResource')) if 'NotResource' in statement else None
+        self.condition = statement.get('Condition')
+
+    def services(self) -> typing.List[str]:
+        """Index keys: service prefixes, '*' for statements that can match any service"""
+        if self.actions is None:
+            return ['*']
+        services = set()
+        for action in self.actions:
+            service = action.split(':', 1)[0].lower() if isinstance(action, str) else '*'
+            services.add('*' if '*' in service or '?' in service or ':' not in str(action) else service)
+        return sorted(services)
+
+    def applies(self, action: str, resource, context: dict) -> bool:
+        if self.actions is not None and not any(match(a, action, True) for a in self.actions):
+            return False
+        if self.not_actions is not None and any(match(a, action, True) for a in self.not_actions):
+            return False
+        if self.resources is not None and not any(_resource_match(r, resource) for r in self.resources):
+            return False
+        if self.not_resources is not None and any(_resource_match(r, resource) for r in self.not_resources):
+            return False
+        return not self.condition or conditions_match(self.condition, context)
+
+
+def _resource_match(pattern, resource) -> bool:
+    return pattern == '*' or match(pattern, resource)
+
+
+_OPERATORS = {
+    'StringEquals': lambda v, p: _key(v) == _key(p),
+    'StringEqualsIgnoreCase': lambda v, p: str(v).lower() == str(p).lower(),
+    'StringLike': lambda v, p: match(p, v),
+    'ArnEquals': lambda v, p: _key(v) == _key(p),
+    'ArnLike': lambda v, p: match(p, v),
+    'Bool': lambda v, p: str(v).lower() == str(p).lower(),
+    'NumericEquals': lambda v, p: float(v) == float(p),
+    'NumericLessThan': lambda v, p: float(v) < float(p),
+    'NumericLessThanEquals': lambda v, p: float(v) <= float(p),
+    'NumericGreaterThan': lambda v, p: float(v) > float(p),
+    'NumericGreaterThanEquals': lambda v, p: float(v) >= float(p),
+    'IpAddress': lambda v, p: _ip_match(p, v),
+}
+_NEGATED = {
+    'StringNotEquals': 'StringEquals',
+    'StringNotEqualsIgnoreCase': 'StringEqualsIgnoreCase',
+    'StringNotLike': 'StringLike',
+    'ArnNotEquals': 'ArnEquals',
+    'ArnNotLike': 'ArnLike',
+    'NumericNotEquals': 'NumericEquals',
+    'NotIpAddress': 'IpAddress',
+}
+
+
+def _ip_match(network: str, address: str) -> bool:
+    import ipaddress
+    return ipaddress.ip_address(address) in ipaddress.ip_network(network, strict=False)
+
+
+def conditions_match(condition: dict, context: dict) -> bool:
+    """IAM Condition block evaluation against a request context (condition keys are case insensitive)"""
+    context = dict((k.lower(), v) for k, v in (context or dict()).items())
+    for operator, tests in condition.items():
+        qualifier, _, operator = operator.rpartition(':')
+        if_exists = operator.endswith('IfExists')
+        operator = operator[:-len('IfExists')] if if_exists else operator
+        for key, expected in tests.items():
+            present = key.lower() in context
+            if operator == 'Null':
+                if str(expected).lower() == 'true' and present or str(expected).lower() == 'false' and not present:
+                    return False
+                continue
+            if not present:
+                # ForAllValues holds on an empty set of values, ForAnyValue doesn't
+                if if_exists or qualifier == 'ForAllValues' or (operator in _NEGATED and qualifier != 'ForAnyValue'):
+                    continue
+                return False
+            negated = operator in _NEGATED
+            test = _OPERATORS.get(_NEGATED.get(operator, operator))
+            if test is None:
+                raise ValueError(f"Unsupported condition operator: {operator}")
+            values, patterns = _list(context[key.lower()]), _list(expected)
+            # Negated operators: a value matches when it matches none of the patterns
+            matches = [any(test(v, p) for p in patterns) != negated for v in values]
+            if qualifier == 'ForAllValues':
+                result = all(matches)
+            elif qualifier == 'ForAnyValue' or not negated:
+                result = any(matches)
+            else:
+                result = all(matches)
+            if not result:
+                return False
+    return True
+
+
+class Principal:
+    """A role/user/group with its statements indexed by service"""
+    def __init__(self, name: str, kind: str) -> None:
+        self.name = name
+        self.kind = kind
+        self.aliases = set([name])
+        self.index = dict()
+        self.boundary = None
+        self.groups = list()
+
+    def add(self, document: dict):
+        for statement in _list(document.get('Statement')):
+            compiled = _Statement(statement)
+            for service in compiled.services():
+                self.index.setdefault(service, list()).append(compiled)
+
+    def _statements(self, action: str) -> typing.Iterator[_Statement]:
+        service = action.split(':', 1)[0].lower()
+        for principal in [self] + self.groups:
+            yield from principal.index.get(service, ())
+            yield from principal.index.get('*', ())
+
+    def decision(self, action: str, resource, context: dict) -> str:
+        allowed = False
+        for statement in self._statements(action):
+            if statement.applies(action, resource, context):
+                if statement.effect == DENY:
+                    return DENY
+                allowed = True
+        if self.boundary is not None:
+            # An explicit deny of the boundary wins, allowed or not
+            bounded = self.boundary.decision(action, resource, context)
+            if bounded == DENY or allowed:
+                return bounded
+        return ALLOW if allowed else IMPLICIT_DENY
+
+
+class PolicySimulator:
+    principals: typing.Dict[str, Principal]
+    unknown_policies: typing.Set[str]
+
+    def __init__(self, *, managed_policies: typing.Dict[str, dict]=None, account: str='123456789012', region: str='us-east-1', partition: str='aws', substitutions: typing.Dict[str, str]=None) -> None:
+        """Offline evaluation of the identity policies of templates
+
+        Args:
+            managed_policies (dict, optional): AWS managed policy name or ARN -> policy document. Defaults to None.
+            account (str, optional): AWS::AccountId. Defaults to '123456789012'.
+            region (str, optional): AWS::Region. Defaults to 'us-east-1'.
+            partition (str, optional): AWS::Partition. Defaults to 'aws'.
+            substitutions (dict, optional): values of references: 'LogicalId' (Ref) or 'LogicalId.Attribute' (Fn::GetAtt). Defaults to None.
+        """
+        self.managed_policies = dict()
+        for name, document in (managed_policies or dict()).items():
+            self.managed_policies[name if name.startswith('arn:') else AWS_MANAGED_PREFIX + name] = document
+        self.pseudo = {
+            'AWS::AccountId': account,
+            'AWS::Region': region,
+            'AWS::Partition': partition,
+            'AWS::URLSuffix': 'amazonaws.com',
+        }
+        self.substitutions = dict(substitutions or dict())
+        self.principals = dict()
+        self.unknown_policies = set()
+
+    @classmethod
+    def from_cloud_assembly(cls, outdir: str='cdk.out', **options) -> 'PolicySimulator':
+        """Load all the stack templates of a cloud assembly"""
+        simulator = cls(**options)
+        with open(os.path.join(outdir, 'manifest.json')) as fp:
+            manifest = json.load(fp)
+        for aid, artifact in sorted(manifest.get('artifacts', dict()).items()):
+            if artifact['type'] == 'aws:cloudformation:stack':
+                simulator.load_template(os.path.join(outdir, artifact['properties']['templateFile']), stack=aid)
+        return simulator
+
+    def _resolve(self, value, resources: dict):
+        """Substitute pseudo parameters, references and joins that can be resolved"""
+        if isinstance(value, list):
+            return [self._resolve(v, resources) for v in value]
+        if not isinstance(value, dict):
+            return value
+        if len(value) == 1:
+            (fn, args), = value.items()
+            if fn == 'Ref' and args in self.pseudo:
+                return self.pseudo[args]
+            if fn == 'Ref' and args in self.substitutions:
+                return self.substitutions[args]
+            if fn == 'Ref' and resources.get(args, dict()).get('Type') in ('AWS::IAM::Role', 'AWS::IAM::User', 'AWS::IAM::Group'):
+                name = resources[args].get('Properties', dict()).get(resources[args]['Type'].split('::')[-1] + 'Name')
+                return name if isinstance(name, str) else value
+            attribute = '.'.join(_list(args)) if fn == 'Fn::GetAtt' else None
+            if attribute in self.substitutions:
+                return self.substitutions[attribute]
+            if fn == 'Fn::Join':
+                separator, parts = args
+                parts = self._resolve(parts, resources)
+                if all(isinstance(p, str) for p in parts):
+                    return separator.join(parts)
+                return {fn: [separator, parts]}
+            if fn == 'Fn::Sub' and isinstance(args, str):
+                resolved = re.sub(r'\$\{([^}!]+)\}', lambda m: str(self._resolve({'Ref': m.group(1)}, resources)) if '.' not in m.group(1) else
+                                  str(self._resolve({'Fn::GetAtt': m.group(1).split('.', 1)}, resources)), args)
+                return resolved if '{' not in resolved else value
+        return dict((k, self._resolve(v, resources)) for k, v in value.items())
+
+    def _principal(self, stack: str, logical_id: str, resource: dict) -> Principal:
+        kind = resource['Type'].split('::')[-1]
+        principal = Principal(f"{stack}/{logical_id}", kind)
+        path = resource.get('Metadata', dict()).get('aws:cdk:path')
+        if path:
+            principal.aliases.add(path)
+            if path.endswith('/Resource'):
+                principal.aliases.add(path[:-len('/Resource')])
+        name = resource.get('Properties', dict()).get(f"{kind}Name")
+        if isinstance(name, str):
+            principal.aliases.add(name)
+        for alias in principal.aliases:
+            self.principals[alias] = principal
+        return principal
+
+    def _managed(self, arn, resources: dict, stack: str) -> typing.Optional[dict]:
+        if isinstance(arn, dict) and 'Ref' in arn and resources.get(arn['Ref'], dict()).get('Type') == 'AWS::IAM::ManagedPolicy':
+            return self._resolve(resources[arn['Ref']]['Properties']['PolicyDocument'], resources)
+        arn = self._resolve(arn, resources)
+        if isinstance(arn, str):
+            # arn:<partition>:iam::aws:policy/...
+            arn = re.sub(r'^arn:[^:]+:', 'arn:aws:', arn)
+        if isinstance(arn, str) and arn in self.managed_policies:
+            return self.managed_policies[arn]
+        self.unknown_policies.add(arn if isinstance(arn, str) else f"{stack}:{_key(arn)}")
+        return None
+
+    def load_template(self, filename: str, stack: str=None) -> typing.List[Principal]:
+        """Load the roles, users and groups of a template and their policies
+
+        Returns:
+            list: loaded principals
+        """
+        stack = stack or os.path.basename(filename).replace('.template.json', '')
+        with open(filename) as fp:
+            resources = json.load(fp).get('Resources', dict())
+        principals = dict()
+        for logical_id, resource in resources.items():
+            if resource['Type'] in ('AWS::IAM::Role', 'AWS::IAM::User', 'AWS::IAM::Group'):
+                principals[logical_id] = self._principal(stack, logical_id, resource)
+
+        def attached(names) -> typing.List[Principal]:
+            found = list()
+            for name in _list(names):
+                if isinstance(name, dict) and name.get('Ref') in principals:
+                    found.append(principals[name['Ref']])
+                elif isinstance(name, str) and name in self.principals:
+                    found.append(self.principals[name])
+            return found
+
+        for logical_id, principal in principals.items():
+            properties = resources[logical_id].get('Properties', dict())
+            for policy in properties.get('Policies', list()):
+                principal.add(self._resolve(policy['PolicyDocument'], resources))
+            for arn in properties.get('ManagedPolicyArns', list()):
+                document = self._managed(arn, resources, stack)
+                if document:
+                    principal.add(document)
+            if properties.get('PermissionsBoundary'):
+                boundary = Principal(f"{principal.name}#boundary", 'Boundary')
+                document = self._managed(properties['PermissionsBoundary'], resources, stack)
+                boundary.add(document or dict())
+                principal.boundary = boundary
+        for logical_id, resource in resources.items():
+            properties = resource.get('Properties', dict())
+            if resource['Type'] == 'AWS::IAM::Policy':
+                document = self._resolve(properties['PolicyDocument'], resources)
+                for principal in attached(properties.get('Roles')) + attached(properties.get('Users')) + attached(properties.get('Groups')):
+                    principal.add(document)
+            elif resource['Type'] == 'AWS::IAM::UserToGroupAddition':
+                for user in attached(properties.get('Users')):
+                    user.groups.extend(attached(properties.get('GroupName')))
+            elif resource['Type'] == 'AWS::IAM::User':
+                principals[logical_id].groups.extend(attached(properties.get('Groups')))
+        # Managed policies attached from their side
+        for logical_id, resource in resources.items():
+            if resource['Type'] == 'AWS::IAM::ManagedPolicy':
+                properties = resource['Properties']
+                document = self._resolve(properties['PolicyDocument'], resources)
+                for principal in attached(properties.get('Roles')) + attached(properties.get('Users')) + attached(properties.get('Groups')):
+                    principal.add(document)
+        if self.unknown_policies:
+            logging.info(f"Policy simulator: managed policies without document: {sorted(self.unknown_policies)}")
+        return list(principals.values())
+
+    def simulate(self, principal: str, action: str, resource='*', context: dict=None) -> str:
+        """Decision for a request: 'Allow', 'Deny' (explicit) or 'ImplicitDeny'"""
+        if principal not in self.principals:
+            raise KeyError(f"Unknown principal {principal}")
+        return self.principals[principal].decision(action, resource, context or dict())
+
+    def allowed(self, principal: str, action: str, resource='*', context: dict=None) -> bool:
+        return self.simulate(principal, action, resource, context) == ALLOW
+
+    def simulate_many(self, queries: typing.Iterable[typing.Union[tuple, dict]]) -> typing.List[str]:
+        """simulate() of (principal, action, resource, context) tuples or dicts"""
+        decisions = list()
+        for query in queries:
+            if isinstance(query, dict):
+                query = (query['principal'], query['action'], query.get('resource', '*'), query.get('context'))
+            decisions.append(self.simulate(*query))
+        return decisions
+
+    def check(self, expectations: typing.Union[str, typing.List[dict]]) -> typing.List[dict]:
+        """Permission regression suite
+
+        Args:
+            expectations (str|list): JSON/YAML file or list of {principal, action, resource, context, expect} (expect: Allow, Deny or ImplicitDeny, 'Denied' for either deny)
+
+        Returns:
+            list: failed expectations with the actual 'decision'
+        """
+        if isinstance(expectations, str):
+            with open(expectations, encoding="utf8") as fp:
+                if expectations.endswith('.json'):
+                    expectations = json.load(fp)
+                else:
+                    import yaml
+                    expectations = yaml.safe_load(fp)
+        failures = list()
+        for expectation, decision in zip(expectations, self.simulate_many(expectations)):
+            expect = expectation['expect']
+            if decision != expect and not (expect == 'Denied' and decision != ALLOW):
+                failures.append(dict(expectation, decision=decision))
+        return failures
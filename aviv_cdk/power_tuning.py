@@ -0,0 +1,249 @@
+"""Lambda memory (power) tuning
+
+    aviv-aws tune cdk.out/stack.template.json MyFunction -e event.json
+
+invokes a function of a synthesized template at several memory sizes, with
+either:
+
+- InProcessInvoker: the handler imported and called in this process. Lambda
+  gives CPU in proportion to memory (one vCPU at 1769 MB), so the CPU time
+  measured at full speed is scaled by the CPU share of each memory size
+  (time spent waiting, on I/O or network calls, isn't), and sizes below the
+  peak memory used by the handler are left out. An estimate: SamInvoker
+  measures the real thing.
+- SamInvoker: `sam local invoke` with the template MemorySize overridden,
+  durations taken from the REPORT line.
+
+tune() collects the duration percentiles and costs per memory size and
+recommends one ('cost', 'speed' or 'balanced'). The recommendation is saved
+in POWER_TUNING_FILE by construct path, where CDKLambda reads it at synth
+(memory_size of the function) when enabled with the 'aviv:power-tuning'
+context, e.g. `cdk synth -c aviv:power-tuning=true`. An explicit memory_size
+in the lambda_attrs is kept.
+"""
+import os
+import re
+import sys
+import json
+import math
+import time
+import shlex
+import logging
+import tempfile
+import functools
+import importlib
+import subprocess
+import tracemalloc
+import typing
+
+
+POWER_TUNING_FILE = 'power-tuning.json'
+POWER_TUNING_CONTEXT = 'aviv:power-tuning'
+MEMORY_SIZES = (128, 256, 512, 1024, 1769, 3008)
+# Memory size with one full vCPU
+FULL_VCPU_MB = 1769
+# Lambda python runtime baseline (MB)
+RUNTIME_MB = 40
+# USD per GB-second, per request
+PRICES = {
+    'x86_64': (0.0000166667, 0.0000002),
+    'arm64': (0.0000133334, 0.0000002),
+}
+
+
+def load_function(template: str, function: str) -> dict:
+    """A lambda function of a synthesized template
+
+    Args:
+        template (str): template file (in cdk.out)
+        function (str): logical id or construct path (e.g. 'stack/fn' for a CDKLambda)
+    """
+    with open(template) as fp:
+        resources = json.load(fp)['Resources']
+    for logical_id, resource in resources.items():
+        if resource['Type'] != 'AWS::Lambda::Function':
+            continue
+        cdk_path = resource.get('Metadata', dict()).get('aws:cdk:path', '')
+        # CDKLambda: <construct path>/lambda/Resource
+        construct_path = cdk_path[:-len('/lambda/Resource')] if cdk_path.endswith('/lambda/Resource') else cdk_path
+        if function not in (logical_id, cdk_path, construct_path):
+            continue
+        properties = resource['Properties']
+        asset = resource.get('Metadata', dict()).get('aws:asset:path')
+        return dict(
+            logical_id=logical_id,
+            path=construct_path,
+            template=template,
+            handler=properties['Handler'],
+            code=os.path.join(os.path.dirname(template), asset) if asset else None,
+            environment=dict((k, v) for k, v in properties.get('Environment', dict()).get('Variables', dict()).items() if isinstance(v, str)),
+            memory_size=properties.get('MemorySize', 128),
+            architecture=properties.get('Architectures', ['x86_64'])[0]
+        )
+    raise KeyError(f"No lambda function {function} in {template}")
+
+
+class _Context:
+    def __init__(self, function: dict, memory_size: int) -> None:
+        self.function_name = function['logical_id']
+        self.memory_limit_in_mb = memory_size
+        self.aws_request_id = 'power-tuning'
+        self._deadline = time.time() + 900
+
+    def get_remaining_time_in_millis(self) -> int:
+        return int((self._deadline - time.time()) * 1000)
+
+
+class InProcessInvoker:
+    def __init__(self, function: dict, event: dict=None) -> None:
+        """Call the handler of function (see load_function) in this process"""
+        if not function['code'] or not os.path.isdir(function['code']):
+            raise ValueError(f"{function['logical_id']}: in process invocation needs an asset directory")
+        self.function = function
+        self.event = event or dict()
+        self.peak_mb = None
+        self._handler = None
+
+    def _load(self):
+        module_name, handler_name = self.function['handler'].rsplit('.', 1)
+        for path in (os.path.join(self.function['code'], 'python'), self.function['code']):
+            if path not in sys.path:
+                sys.path.insert(0, path)
+        os.environ.update(self.function['environment'])
+        self._handler = getattr(importlib.import_module(module_name), handler_name)
+
+    def _invoke(self):
+        self._handler(self.event, _Context(self.function, FULL_VCPU_MB))
+
+    def _peak(self) -> float:
+        """Peak memory (MB) allocated by an invocation, tracemalloc slows it down: not timed"""
+        tracemalloc.start()
+        try:
+            self._invoke()
+            return tracemalloc.get_traced_memory()[1] / 2 ** 20
+        finally:
+            tracemalloc.stop()
+
+    def _duration(self) -> typing.Tuple[float, float]:
+        """Wall clock and CPU time (ms) of an invocation"""
+        start, cpu_start = time.perf_counter(), time.process_time()
+        self._invoke()
+        return (time.perf_counter() - start) * 1000, (time.process_time() - cpu_start) * 1000
+
+    def __call__(self, memory_size: int) -> typing.Optional[float]:
+        """Duration (ms) at memory_size, None if the handler doesn't fit in it"""
+        if not self._handler:
+            self._load()
+            # Warm up: imports, lazy initialisations (not a cold start benchmark)
+            self.peak_mb = self._peak()
+        if RUNTIME_MB + self.peak_mb > memory_size:
+            return None
+        wall, cpu = self._duration()
+        cpu = min(cpu, wall)
+        # Only the CPU bound part slows down with a smaller CPU share
+        return wall - cpu + cpu * max(1, FULL_VCPU_MB / memory_size)
+
+
+class SamInvoker:
+    def __init__(self, function: dict, event_file: str=None, *, options: str='') -> None:
+        """`sam local invoke` function (see load_function) with MemorySize overridden"""
+        self.function = function
+        self.event_file = event_file
+        self.options = options
+
+    def __call__(self, memory_size: int) -> typing.Optional[float]:
+        with open(self.function['template']) as fp:
+            template = json.load(fp)
+        template['Resources'][self.function['logical_id']]['Properties']['MemorySize'] = memory_size
+        # Next to the original, asset paths are relative
+        fd, filename = tempfile.mkstemp(suffix='.template.json', dir=os.path.dirname(self.function['template']) or '.')
+        try:
+            with os.fdopen(fd, 'w') as fp:
+                json.dump(template, fp)
+            cmd = 'sam local invoke -t {} {} {}'.format(filename, self.function['logical_id'], self.options)
+            if self.event_file:
+                cmd += ' -e {}'.format(self.event_file)
+            result = subprocess.run(shlex.split(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        finally:
+            os.remove(filename)
+        match = re.search(r'REPORT .*?Duration: ([0-9.]+) ms', result.stderr)
+        if result.returncode or not match:
+            logging.warning(f"sam local invoke failed at {memory_size} MB:\n{result.stderr[-2000:]}")
+            return None
+        return float(match.group(1))
+
+
+def _percentile(values: typing.List[float], percentile: int) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round((len(values) - 1) * percentile / 100)))]
+
+
+def tune(invoke: typing.Callable[[int], typing.Optional[float]], *, memory_sizes: typing.Iterable[int]=MEMORY_SIZES, runs: int=10, strategy: str='cost', architecture: str='x86_64') -> dict:
+    """Invoke at each memory size and recommend one
+
+    Args:
+        invoke (callable): memory size -> duration (ms), None when it fails
+        memory_sizes (list, optional): memory sizes (MB). Defaults to MEMORY_SIZES.
+        runs (int, optional): invocations per memory size. Defaults to 10.
+        strategy (str, optional): 'cost' (cheapest), 'speed' (fastest) or 'balanced' (cost x duration). Defaults to 'cost'.
+        architecture (str, optional): for the prices. Defaults to 'x86_64'.
+
+    Returns:
+        dict: recommended memory_size, strategy and results per memory size (p50, p90 ms, cost per million invocations)
+    """
+    gb_second, request = PRICES[architecture]
+    results = dict()
+    for memory_size in memory_sizes:
+        durations = [invoke(memory_size) for _ in range(runs)]
+        if None in durations:
+            logging.info(f"Power tuning: {memory_size} MB failed")
+            continue
+        p90 = _percentile(durations, 90)
+        # Billed by the millisecond
+        cost = (math.ceil(p90) / 1000 * memory_size / 1024 * gb_second + request) * 1e6
+        results[memory_size] = dict(p50=round(_percentile(durations, 50), 2), p90=round(p90, 2), cost=round(cost, 4))
+    if not results:
+        raise RuntimeError('Power tuning: no successful invocation')
+    keys = {
+        'cost': lambda m: (results[m]['cost'], results[m]['p90']),
+        'speed': lambda m: (results[m]['p90'], results[m]['cost']),
+        'balanced': lambda m: (results[m]['cost'] * results[m]['p90'], m),
+    }
+    memory_size = min(results, key=keys[strategy])
+    logging.info(f"Power tuning: {memory_size} MB ({strategy}) {results[memory_size]}")
+    return dict(memory_size=memory_size, strategy=strategy, results=results)
+
+
+def save(path: str, recommendation: dict, filename: str=POWER_TUNING_FILE):
+    """Store a tune() recommendation for the construct path"""
+    config = dict()
+    if os.path.exists(filename):
+        with open(filename) as fp:
+            config = json.load(fp)
+    config[path] = recommendation
+    with open(filename, 'w') as fp:
+        json.dump(config, fp, indent=2, sort_keys=True)
+
+
+@functools.lru_cache(maxsize=8)
+def _load(filename: str, mtime_ns: int) -> dict:
+    with open(filename) as fp:
+        return json.load(fp)
+
+
+def enabled(scope=None) -> typing.Optional[str]:
+    """The tuning file CDKLambda applies, from the 'aviv:power-tuning' context (true or a filename), None if not set"""
+    value = scope.node.try_get_context(POWER_TUNING_CONTEXT) if scope is not None else None
+    if not value or str(value).lower() in ('0', 'false', 'no', 'off'):
+        return None
+    if str(value).lower() in ('1', 'true', 'yes', 'on'):
+        return POWER_TUNING_FILE
+    return str(value)
+
+
+def memory_size(path: str, filename: str=POWER_TUNING_FILE) -> typing.Optional[int]:
+    """Tuned memory size of a construct path, None if not tuned"""
+    if not os.path.exists(filename):
+        return None
+    entry = _load(os.path.realpath(filename), os.stat(filename).st_mtime_ns).get(path)
+    return entry['memory_size'] if entry else None
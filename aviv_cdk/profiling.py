@@ -0,0 +1,184 @@
+"""Opt-in synth profiling for aviv_cdk.core.App
+
+Enable it with the 'aviv:profile' context flag (cdk synth -c aviv:profile=1)
+or the AVIV_CDK_PROFILE environment variable. On synth, the App writes next
+to its output directory:
+
+- cdk.profile.json: per-construct construction time, per-stack synth time,
+  jsii kernel calls and asset timings
+- cdk.profile.folded: construction time as folded stacks (flamegraph.pl, speedscope...)
+"""
+import os
+import sys
+import json
+import time
+import logging
+import typing
+import collections
+import jsii
+import constructs
+from aws_cdk import core
+
+
+PROFILE_ENV = 'AVIV_CDK_PROFILE'
+PROFILE_CONTEXT = 'aviv:profile'
+JSII_CALLS = ('create', 'invoke', 'sinvoke', 'ainvoke', 'get', 'set', 'sget', 'sset')
+
+
+def enabled(scope: constructs.Construct=None) -> bool:
+    """Profiling is on if either AVIV_CDK_PROFILE or the 'aviv:profile' context is truthy"""
+    value = os.environ.get(PROFILE_ENV)
+    if not value and scope is not None:
+        value = scope.node.try_get_context(PROFILE_CONTEXT)
+    return str(value).lower() in ('1', 'true', 'yes', 'on')
+
+
+def _ms(seconds: float) -> float:
+    return round(seconds * 1000, 3)
+
+
+class SynthProfiler:
+    """Collect construction/synth timings while an App is being built
+
+    Construction time is measured on the outermost __init__ of every construct
+    (Python subclasses included). Asset staging triggered from within jsii (e.g.
+    a lambda Code.from_asset bound by its Function) is accounted in the owning
+    construct time, only assets created from Python are reported as staging.
+    """
+    def __init__(self) -> None:
+        self.started = None
+        self.constructs = list()
+        self.stacks = dict()
+        self.jsii_calls = collections.Counter()
+        self.jsii_time = collections.defaultdict(float)
+        self.jsii_types = collections.defaultdict(lambda: [0, 0.])
+        self.assets = dict(staging=0., registration=0., count=0)
+        self._active = list()
+        self._patched = dict()
+        self._previous_profile = None
+
+    def start(self):
+        self.started = time.perf_counter()
+        for call in JSII_CALLS:
+            if hasattr(jsii, call):
+                self._patched[call] = getattr(jsii, call)
+                setattr(jsii, call, self._jsii_wrapper(call, self._patched[call]))
+        self._previous_profile = sys.getprofile()
+        sys.setprofile(self._profile)
+
+    def stop(self):
+        sys.setprofile(self._previous_profile)
+        for call, func in self._patched.items():
+            setattr(jsii, call, func)
+        self._patched = dict()
+
+    def _jsii_wrapper(self, call: str, func: typing.Callable):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                self.jsii_calls[call] += 1
+                self.jsii_time[call] += elapsed
+                if call == 'create' and args:
+                    fqn = getattr(args[0], '__jsii_type__', None) or args[0].__name__
+                    self.jsii_types[fqn][0] += 1
+                    self.jsii_types[fqn][1] += elapsed
+                    if 'Asset' in fqn:
+                        self.assets['staging'] += elapsed
+                        self.assets['count'] += 1
+        return wrapper
+
+    def _profile(self, frame, event, arg):
+        if frame.f_code.co_name != '__init__' or event not in ('call', 'return'):
+            return
+        if event == 'call':
+            obj = frame.f_locals.get('self')
+            if isinstance(obj, constructs.Construct) and not any(obj is active[0] for active in self._active):
+                self._active.append([obj, frame, time.perf_counter(), 0.])
+        elif self._active and self._active[-1][1] is frame:
+            obj, _, start, children = self._active.pop()
+            elapsed = time.perf_counter() - start
+            if self._active:
+                self._active[-1][3] += elapsed
+            self.constructs.append((obj, elapsed, elapsed - children))
+
+    def synthesizer(self, stack_id: str, synthesizer: core.IStackSynthesizer) -> core.IStackSynthesizer:
+        return ProfilingSynthesizer(self, stack_id, synthesizer)
+
+    def report(self, synth_time: float=None) -> dict:
+        records = list()
+        for obj, elapsed, self_time in self.constructs:
+            try:
+                path = obj.node.path
+            except Exception:  # construct failed to initialize
+                path = '<{}>'.format(type(obj).__name__)
+            records.append(dict(path=path or '<app>', type=type(obj).__name__, wall_ms=_ms(elapsed), self_ms=_ms(self_time)))
+        return dict(
+            total_ms=_ms(time.perf_counter() - self.started),
+            synth_ms=_ms(synth_time) if synth_time is not None else None,
+            constructs=sorted(records, key=lambda r: r['wall_ms'], reverse=True),
+            stacks=dict((sid, _ms(elapsed)) for sid, elapsed in self.stacks.items()),
+            jsii=dict(
+                calls=sum(self.jsii_calls.values()),
+                by_call=dict((call, dict(calls=count, ms=_ms(self.jsii_time[call]))) for call, count in self.jsii_calls.items()),
+                create_by_type=dict((fqn, dict(calls=count, ms=_ms(elapsed))) for fqn, (count, elapsed) in self.jsii_types.items())
+            ),
+            assets=dict(
+                count=self.assets['count'],
+                staging_ms=_ms(self.assets['staging']),
+                registration_ms=_ms(self.assets['registration'])
+            )
+        )
+
+    def write(self, outdir: str, synth_time: float=None) -> str:
+        """Write cdk.profile.json and cdk.profile.folded next to outdir
+
+        Returns:
+            str: JSON report path
+        """
+        report = self.report(synth_time)
+        basedir = os.path.dirname(os.path.abspath(outdir))
+        filename = os.path.join(basedir, 'cdk.profile.json')
+        with open(filename, 'w') as fp:
+            json.dump(report, fp, indent=2)
+        with open(os.path.join(basedir, 'cdk.profile.folded'), 'w') as fp:
+            for record in report['constructs']:
+                micros = int(record['self_ms'] * 1000)
+                if micros > 0:
+                    fp.write('{} {}\n'.format(record['path'].replace('/', ';'), micros))
+        logging.warning(f"Synth profile: {filename}")
+        return filename
+
+
+@jsii.implements(core.IStackSynthesizer)
+class ProfilingSynthesizer:
+    """Stack synthesizer wrapper timing the stack synth and its asset registrations"""
+    def __init__(self, profiler: SynthProfiler, stack_id: str, synthesizer: core.IStackSynthesizer) -> None:
+        self._profiler = profiler
+        self._stack_id = stack_id
+        self._synthesizer = synthesizer
+
+    def bind(self, stack: core.Stack) -> None:
+        self._synthesizer.bind(stack)
+
+    def add_file_asset(self, asset: core.FileAssetSource) -> core.FileAssetLocation:
+        return self._timed_asset(self._synthesizer.add_file_asset, asset)
+
+    def add_docker_image_asset(self, asset: core.DockerImageAssetSource) -> core.DockerImageAssetLocation:
+        return self._timed_asset(self._synthesizer.add_docker_image_asset, asset)
+
+    def synthesize(self, session: core.ISynthesisSession) -> None:
+        start = time.perf_counter()
+        try:
+            self._synthesizer.synthesize(session)
+        finally:
+            self._profiler.stacks[self._stack_id] = time.perf_counter() - start
+
+    def _timed_asset(self, func, asset):
+        start = time.perf_counter()
+        try:
+            return func(asset)
+        finally:
+            self._profiler.assets['registration'] += time.perf_counter() - start
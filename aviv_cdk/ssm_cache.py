@@ -0,0 +1,166 @@
+"""Batched SSM parameter lookups with a persistent, TTL based, local cache
+
+StringParameter.value_from_lookup makes the cdk cli run a context provider
+and synth a second time whenever cdk.context.json doesn't know the parameter.
+With the cache enabled on aviv_cdk.core.App ('aviv:ssm-cache' context or
+AVIV_CDK_SSM_CACHE env var, set to 1 or to the cache file path),
+aviv_cdk.core.ssm_lookup returns:
+
+- the cdk.context.json value when there is one (same as value_from_lookup)
+- the cached value when it is still fresh
+- a lazy token otherwise, all pending parameters are then fetched in one
+  bulk pass (per account/region) before synth and written to the cache file
+"""
+import os
+import json
+import time
+import logging
+import typing
+import jsii
+from aws_cdk import core
+
+
+CACHE_ENV = 'AVIV_CDK_SSM_CACHE'
+CACHE_CONTEXT = 'aviv:ssm-cache'
+CACHE_FILE = '.aviv-cdk/ssm-cache.json'
+# A resolver gets a list of parameter names and returns {name: value} for the ones found
+Resolver = typing.Callable[[typing.List[str], str, str], typing.Dict[str, str]]
+
+
+def context_key(account: str, region: str, parameter_name: str) -> str:
+    """Same key as the cdk 'ssm' context provider (cdk.context.json)"""
+    return f"ssm:account={account}:parameterName={parameter_name}:region={region}"
+
+
+def boto3_resolver(names: typing.List[str], account: str, region: str) -> typing.Dict[str, str]:
+    """Fetch parameters with ssm:GetParameters (10 names per call)
+
+    SecureString values aren't decrypted (same as value_from_lookup), so no
+    secret ends up in the cache file.
+
+    Raises:
+        ValueError: the credentials aren't those of account (the values would be cached as its own)
+    """
+    import boto3
+    session = boto3.session.Session(region_name=region)
+    caller = session.client('sts').get_caller_identity()['Account']
+    if caller != account:
+        raise ValueError(f"SSM lookup in {account}/{region} with credentials of account {caller}, "
+                         f"use credentials of {account} or set the parameters in cdk.context.json")
+    client = session.client('ssm')
+    values = dict()
+    for i in range(0, len(names), 10):
+        response = client.get_parameters(Names=names[i:i + 10])
+        for param in response['Parameters']:
+            values[param['Name']] = param['Value']
+        if response['InvalidParameters']:
+            logging.warning(f"SSM parameters not found: {response['InvalidParameters']}")
+    return values
+
+
+def enabled(scope: core.Construct=None) -> typing.Optional[str]:
+    """Returns the cache file path if the SSM cache is enabled"""
+    value = os.environ.get(CACHE_ENV)
+    if not value and scope is not None:
+        value = scope.node.try_get_context(CACHE_CONTEXT)
+    if not value or str(value).lower() in ('0', 'false', 'no', 'off'):
+        return None
+    if str(value).lower() in ('1', 'true', 'yes', 'on'):
+        return CACHE_FILE
+    return str(value)
+
+
+class SSMCache:
+    filename: str
+    ttl: int
+    entries: typing.Dict[str, typing.Dict[str, typing.Any]]
+    pending: typing.Dict[typing.Tuple[str, str], typing.Set[str]]
+
+    def __init__(self, filename: str=CACHE_FILE, *, ttl: int=86400, resolver: Resolver=None) -> None:
+        """Persistent SSM parameters cache
+
+        Args:
+            filename (str, optional): JSON cache file. Defaults to CACHE_FILE.
+            ttl (int, optional): Entries older than ttl seconds are evicted. Defaults to 1 day.
+            resolver (Resolver, optional): Bulk parameter fetcher. Defaults to boto3_resolver.
+        """
+        self.filename = filename
+        self.ttl = ttl
+        self.resolver = resolver if resolver else boto3_resolver
+        self.pending = dict()
+        self.entries = dict()
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename) as fp:
+            entries = json.load(fp)
+        now = time.time()
+        self.entries = dict((key, entry) for key, entry in entries.items() if now - entry['timestamp'] < self.ttl)
+
+    def save(self):
+        dirname = os.path.dirname(self.filename)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with open(self.filename, 'w') as fp:
+            json.dump(self.entries, fp, indent=2, sort_keys=True)
+
+    def get(self, key: str) -> typing.Optional[str]:
+        entry = self.entries.get(key)
+        if entry and time.time() - entry['timestamp'] < self.ttl:
+            return entry['value']
+        return None
+
+    def lookup(self, scope: core.Construct, parameter_name: str) -> str:
+        """Lookup an SSM parameter (value or lazy token)
+
+        Args:
+            scope (core.Construct): Construct within a stack with an explicit env (account/region)
+            parameter_name (str): SSM parameter name
+
+        Returns:
+            str: parameter value
+
+        Raises:
+            ValueError: the stack is environment agnostic
+        """
+        stack = core.Stack.of(scope)
+        if core.Token.is_unresolved(stack.account) or core.Token.is_unresolved(stack.region):
+            raise ValueError(f"Cannot retrieve value from context provider ssm since account/region are not specified at the stack level. "
+                             f"Configure \"env\" with an account and region when you define your stack ({stack.node.path}).")
+        key = context_key(stack.account, stack.region, parameter_name)
+        value = scope.node.try_get_context(key)
+        if value is None:
+            value = self.get(key)
+        if value is not None:
+            return value
+        self.pending.setdefault((stack.account, stack.region), set()).add(parameter_name)
+        return core.Lazy.string_value(_LookupProducer(self, key, parameter_name))
+
+    def resolve(self):
+        """Fetch all pending parameters, one bulk pass per account/region, then save the cache"""
+        if not self.pending:
+            return
+        now = time.time()
+        for (account, region), names in self.pending.items():
+            logging.info(f"SSM lookup: {len(names)} parameter(s) in {account}/{region}")
+            for name, value in self.resolver(sorted(names), account, region).items():
+                self.entries[context_key(account, region, name)] = dict(value=value, timestamp=now)
+        self.pending = dict()
+        self.save()
+
+
+@jsii.implements(core.IStringProducer)
+class _LookupProducer:
+    def __init__(self, cache: SSMCache, key: str, parameter_name: str) -> None:
+        self._cache = cache
+        self._key = key
+        self._parameter_name = parameter_name
+
+    def produce(self, context: core.IResolveContext) -> str:
+        self._cache.resolve()
+        value = self._cache.get(self._key)
+        if value is None:
+            raise KeyError(f"SSM parameter not found: {self._parameter_name}")
+        return value
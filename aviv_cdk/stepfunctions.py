@@ -1,7 +1,5 @@
 from aws_cdk import (
-    aws_lambda,
     aws_stepfunctions as sfn,
-    aws_stepfunctions_tasks as sfn_tasks,
     core
 )
 
@@ -41,7 +39,13 @@ class Stepfunctions(core.Construct):
             time=sfn.WaitTime.seconds_path(path=path)
         )
 
-    def _invoke_lambda(self, name: str, fx: aws_lambda.IFunction=None, code: aws_lambda.Code=None, handler: str=None, runtime=aws_lambda.Runtime.PYTHON_3_7):
+    def _invoke_lambda(self, name: str, fx: 'aws_lambda.IFunction'=None, code: 'aws_lambda.Code'=None, handler: str=None, runtime=None):
+        from aws_cdk import (
+            aws_lambda,
+            aws_stepfunctions_tasks as sfn_tasks
+        )
+        if not runtime:
+            runtime = aws_lambda.Runtime.PYTHON_3_7
         if not fx:
             fx = aws_lambda.Function(
                 self, "fxi_{}".format(name),
@@ -0,0 +1,135 @@
+"""Parallel synth: split an app's independent stacks across several processes
+
+The driver (aviv-cdk-synth, see bin/parallel_synth.py) runs the app N times,
+each with AVIV_CDK_SYNTH_PARTITION=<index>/<count> and its own CDK_OUTDIR.
+In each process aviv_cdk.core.App groups the top level stacks that depend on
+each other, keeps the groups of its partition and synthesizes only those.
+The partial cloud assemblies are then merged into one cdk.out.
+
+Every process still builds the whole construct tree, only the synthesis
+(templates, assets staging) is split.
+"""
+import os
+import json
+import shutil
+import logging
+import typing
+from aws_cdk import core
+
+
+PARTITION_ENV = 'AVIV_CDK_SYNTH_PARTITION'
+
+
+def partition_from_env() -> typing.Optional[typing.Tuple[int, int]]:
+    value = os.environ.get(PARTITION_ENV)
+    if not value:
+        return None
+    index, count = value.split('/')
+    return int(index), int(count)
+
+
+def stack_groups(app: core.App) -> typing.List[typing.List[core.Stack]]:
+    """Group top level stacks linked by a dependency (explicit or cross-stack reference)
+
+    Returns:
+        list: groups of stacks, sorted by stack id
+    """
+    # Resolves cross-stack references into stack dependencies
+    core.ConstructNode.prepare(app.node)
+    stacks = dict((child.node.id, child) for child in app.node.children if isinstance(child, core.Stack))
+    parents = dict((sid, sid) for sid in stacks)
+
+    def find(sid):
+        while parents[sid] != sid:
+            parents[sid] = parents[parents[sid]]
+            sid = parents[sid]
+        return sid
+
+    for sid, stack in stacks.items():
+        for dependency in stack.dependencies:
+            if dependency.node.id in parents:
+                parents[find(dependency.node.id)] = find(sid)
+    groups = dict()
+    for sid in sorted(stacks):
+        groups.setdefault(find(sid), list()).append(stacks[sid])
+    return list(groups.values())
+
+
+def assign(groups: typing.List[typing.List[core.Stack]], count: int) -> typing.List[typing.List[core.Stack]]:
+    """Spread stack groups over count partitions (largest first, to the least loaded one)"""
+    weighted = sorted(
+        ((sum(len(stack.node.find_all()) for stack in group), group) for group in groups),
+        key=lambda wg: (-wg[0], wg[1][0].node.id)
+    )
+    partitions = [[0, list()] for _ in range(count)]
+    for weight, group in weighted:
+        lightest = min(partitions, key=lambda p: p[0])
+        lightest[0] += weight
+        lightest[1].extend(group)
+    return [stacks for _, stacks in partitions]
+
+
+def select_partition(app: core.App, index: int, count: int) -> typing.List[str]:
+    """Remove the stacks that aren't part of this partition from the app
+
+    Returns:
+        list: ids of the stacks kept
+    """
+    partitions = assign(stack_groups(app), count)
+    keep = [stack.node.id for stack in partitions[index]]
+    for stacks in partitions:
+        for stack in stacks:
+            if stack.node.id not in keep:
+                app.node.try_remove_child(stack.node.id)
+    logging.info(f"Synth partition {index + 1}/{count}: {keep}")
+    return keep
+
+
+def merge(partition_dirs: typing.List[str], outdir: str) -> dict:
+    """Merge partial cloud assemblies into outdir
+
+    Returns:
+        dict: merged manifest
+    """
+    os.makedirs(outdir, exist_ok=True)
+    manifest = None
+    tree = None
+    for pdir in partition_dirs:
+        with open(os.path.join(pdir, 'manifest.json')) as fp:
+            pmanifest = json.load(fp)
+        if manifest is None:
+            manifest = pmanifest
+            manifest.setdefault('artifacts', dict())
+        else:
+            manifest['artifacts'].update(pmanifest.get('artifacts', dict()))
+            for missing in pmanifest.get('missing', list()):
+                if missing not in manifest.setdefault('missing', list()):
+                    manifest['missing'].append(missing)
+
+        treefile = os.path.join(pdir, 'tree.json')
+        if os.path.exists(treefile):
+            with open(treefile) as fp:
+                ptree = json.load(fp)
+            if tree is None:
+                tree = ptree
+            else:
+                tree['tree'].setdefault('children', dict()).update(ptree['tree'].get('children', dict()))
+
+        for name in os.listdir(pdir):
+            if name in ('manifest.json', 'tree.json'):
+                continue
+            src, dst = os.path.join(pdir, name), os.path.join(outdir, name)
+            # Assets are content hashed: same name, same content
+            if os.path.exists(dst):
+                continue
+            if os.path.isdir(src):
+                shutil.copytree(src, dst)
+            else:
+                shutil.copy2(src, dst)
+
+    if tree is not None:
+        with open(os.path.join(outdir, 'tree.json'), 'w') as fp:
+            json.dump(tree, fp, indent=2)
+    with open(os.path.join(outdir, 'manifest.json'), 'w') as fp:
+        json.dump(manifest, fp, indent=2)
+    return manifest
@@ -7,6 +7,7 @@ import shlex
 import subprocess
 import logging
 import click
+from aviv_cdk import power_tuning
 
 # ~/.aws-sam/layers-pkg
 # AWS_STEPFUNCTIONS_JAR_DL = os.environ.get("AWS_STEPFUNCTIONS_JAR_DL", "https://docs.aws.amazon.com/step-functions/latest/dg/samples/StepFunctionsLocal.tar.gz")
@@ -202,6 +203,42 @@ def sm(template, profile, debug):
     click.secho("\nAll gone byebye!", dim=True)
 
 
+@click.argument('function', type=click.types.STRING, required=True)
+@click.argument('template', type=click.types.STRING, required=True)
+@click.option('--event', '-e', type=click.types.STRING, help='Event JSON file', default=None)
+@click.option('--memory', '-m', type=click.types.STRING, help='Memory sizes (MB)', default=','.join(str(m) for m in power_tuning.MEMORY_SIZES))
+@click.option('--runs', '-n', type=click.types.INT, help='Invocations per memory size', default=10)
+@click.option('--invoker', '-i', type=click.Choice(['inprocess', 'sam']), default='inprocess')
+@click.option('--strategy', '-s', type=click.Choice(['cost', 'speed', 'balanced']), default='cost')
+@click.option('--profile', '-p', type=click.types.STRING, help='SAM profile', default='local')
+@click.option('--config', '-c', type=click.types.STRING, help='File read by CDKLambda', default=power_tuning.POWER_TUNING_FILE)
+@cli.command(short_help='Lambda memory tuning')
+def tune(function, template, event, memory, runs, invoker, strategy, profile, config):
+    """Tune the memory of FUNCTION (logical id or CDKLambda path) of TEMPLATE (synthesized)"""
+    fn = power_tuning.load_function(template, function)
+    if invoker == 'sam':
+        invoke = power_tuning.SamInvoker(fn, event, options='--profile {}'.format(profile))
+    else:
+        payload = dict()
+        if event:
+            with open(event) as f:
+                payload = json.load(f)
+        invoke = power_tuning.InProcessInvoker(fn, payload)
+    click.secho("Tuning {} ({}) with {} invocations per memory size".format(fn['path'], fn['logical_id'], runs), bold=True)
+    recommendation = power_tuning.tune(
+        invoke,
+        memory_sizes=[int(m) for m in memory.split(',')],
+        runs=runs,
+        strategy=strategy,
+        architecture=fn['architecture']
+    )
+    for memory_size, result in recommendation['results'].items():
+        click.secho(" {:>5} MB  p50 {:>9.2f} ms  p90 {:>9.2f} ms  ${:.4f}/M".format(memory_size, result['p50'], result['p90'], result['cost']),
+            bold=memory_size == recommendation['memory_size'])
+    power_tuning.save(fn['path'], recommendation, config)
+    click.secho("{} MB ({}) saved in {} (was {} MB)".format(recommendation['memory_size'], strategy, config, fn['memory_size']))
+
+
 def _help_run(lambdas: list):
     print("Run Lambda:")
     for i, l in enumerate(lambdas):
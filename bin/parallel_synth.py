@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+import os
+import json
+import shlex
+import shutil
+import subprocess
+import concurrent.futures
+import click
+from aviv_cdk import synth
+
+
+def _context(context: tuple) -> dict:
+    """Same context as the cdk cli: cdk.json, cdk.context.json then -c key=value"""
+    ctx = dict()
+    if os.path.exists('cdk.json'):
+        with open('cdk.json') as f:
+            ctx.update(json.load(f).get('context', dict()))
+    if os.path.exists('cdk.context.json'):
+        with open('cdk.context.json') as f:
+            ctx.update(json.load(f))
+    for kv in context:
+        key, value = kv.split('=', 1)
+        ctx[key] = value
+    return ctx
+
+
+def _synth_partition(app: str, index: int, count: int, outdir: str, context: dict):
+    env = dict(os.environ)
+    env.update({
+        'CDK_OUTDIR': outdir,
+        'CDK_CONTEXT_JSON': json.dumps(context),
+        synth.PARTITION_ENV: '{}/{}'.format(index, count)
+    })
+    return subprocess.run(shlex.split(app), env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+
+
+@click.option('--app', '-a', type=click.types.STRING, help="CDK app command (defaults to cdk.json 'app')", default=None)
+@click.option('--output', '-o', type=click.types.STRING, default='cdk.out')
+@click.option('--jobs', '-j', type=click.types.INT, help='Number of synth processes', default=os.cpu_count())
+@click.option('--context', '-c', multiple=True, help='key=value context, same as cdk -c')
+@click.command(short_help='Synth the independent stacks of a CDK app in parallel')
+def cli(app: str, output: str, jobs: int, context: tuple):
+    if not app:
+        with open('cdk.json') as f:
+            app = json.load(f)['app']
+    ctx = _context(context)
+    partdir = output.rstrip('/') + '.partitions'
+    outdirs = [os.path.join(partdir, str(i)) for i in range(jobs)]
+
+    click.secho("Synth '{}' in {} process(es)".format(app, jobs), bold=True)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        results = list(pool.map(lambda i: _synth_partition(app, i, jobs, outdirs[i], ctx), range(jobs)))
+
+    failed = [i for i, result in enumerate(results) if result.returncode]
+    for i in failed:
+        click.secho("Partition {} failed:\n{}".format(i, results[i].stdout), fg='red')
+    if failed:
+        exit(1)
+
+    if os.path.exists(output):
+        shutil.rmtree(output)
+    manifest = synth.merge(outdirs, output)
+    shutil.rmtree(partdir)
+
+    stacks = [aid for aid, artifact in manifest['artifacts'].items() if artifact['type'] == 'aws:cloudformation:stack']
+    click.secho("{} stack(s) synthesized in {}".format(len(stacks), output))
+    if manifest.get('missing'):
+        click.secho("Missing context, run 'cdk synth' once to resolve it: {}".format(
+            [missing['key'] for missing in manifest['missing']]
+        ), fg='yellow')
+        exit(2)
+
+
+if __name__ == "__main__":
+    cli()
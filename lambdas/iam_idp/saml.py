@@ -1,94 +1,356 @@
 import sys
 sys.path.append('/opt')  # nopep8
+import re
+import time
+import gzip
+import random
+import hashlib
 import logging
+import http.client
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from botocore.exceptions import ClientError
+from cfn_resource_provider import ResourceProvider
 
-def handler(request, context):
-  logging.warning(request)
+# Seconds, the custom resource lambda times out after 20
+CONNECT_TIMEOUT = 3
+READ_TIMEOUT = 5
+RETRIES = 3
+BACKOFF = 0.5
+MAX_REDIRECTS = 5
+# Concurrent metadata fetches of Custom::SAMLProviders
+MAX_WORKERS = 8
+# Tag of the providers created by a Custom::SAMLProviders, only those are deleted with it
+OWNER_TAG = 'aviv:cfn-resource'
+# Kept by warm containers: url -> etag, last-modified and metadata
+_metadata_cache = dict()
+_iam = None
+_s3 = None
+
+
+class FetchError(Exception):
+  pass
+
+
+def digest(metadata):
+  return hashlib.sha256(metadata.encode('utf8')).hexdigest()
+
+
+def _get(url, headers):
+  """GET url following redirects: status, headers, body"""
+  for _ in range(MAX_REDIRECTS + 1):
+    parts = urllib.parse.urlsplit(url)
+    connection = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+    conn = connection(parts.netloc, timeout=CONNECT_TIMEOUT)
+    try:
+      conn.connect()
+      conn.sock.settimeout(READ_TIMEOUT)
+      path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+      conn.request('GET', path, headers=headers)
+      response = conn.getresponse()
+      body = response.read()
+    finally:
+      conn.close()
+    if response.status in (301, 302, 303, 307, 308) and response.headers.get('Location'):
+      url = urllib.parse.urljoin(url, response.headers['Location'])
+      continue
+    return response.status, response.headers, body.decode(response.headers.get_content_charset() or 'utf-8', errors='replace')
+  raise FetchError(f"{url}: too many redirects")
+
+
+def fetch_metadata(url, deadline=None):
+  """SAML metadata document of url
+
+  Conditional request (ETag, Last-Modified) against the metadata cached by the
+  container, retried with exponential backoff on network errors, 429 and 5xx
+  until deadline (epoch seconds).
+  """
+  cached = _metadata_cache.get(url)
+  headers = {'Accept': 'application/samlmetadata+xml, application/xml, text/xml, */*'}
+  if cached and cached['etag']:
+    headers['If-None-Match'] = cached['etag']
+  if cached and cached['last_modified']:
+    headers['If-Modified-Since'] = cached['last_modified']
+  error = None
+  for attempt in range(RETRIES):
+    if attempt:
+      delay = BACKOFF * 2 ** (attempt - 1) * (1 + random.random())
+      if deadline and time.time() + delay + CONNECT_TIMEOUT > deadline:
+        break
+      time.sleep(delay)
+    try:
+      status, response_headers, body = _get(url, headers)
+    except (OSError, http.client.HTTPException) as e:
+      error = f"{url}: {e.__class__.__name__} {e}"
+      logging.warning(f"Metadata fetch attempt {attempt + 1}: {error}")
+      continue
+    if status == 304 and cached:
+      logging.info(f"{url}: metadata not modified")
+      return cached['metadata']
+    if status == 200:
+      _metadata_cache[url] = dict(etag=response_headers.get('ETag'), last_modified=response_headers.get('Last-Modified'), metadata=body)
+      return body
+    error = f"url {url} returned status code {status}, {body[:500]}"
+    if status != 429 and status < 500:
+      break
+    logging.warning(f"Metadata fetch attempt {attempt + 1}: {error}")
+  raise FetchError(error or f"{url}: no time left to retry")
+
+
+def update_provider(iam, arn, metadata):
+  """update_saml_provider unless the provider already has this metadata (same digest), True when updated"""
+  current = iam.get_saml_provider(SAMLProviderArn=arn)['SAMLMetadataDocument']
+  if digest(current) == digest(metadata):
+    logging.info(f"{arn}: metadata unchanged, not updated")
+    return False
+  iam.update_saml_provider(SAMLProviderArn=arn, SAMLMetadataDocument=metadata)
+  return True
 
-  import requests
-  import boto3
-  from botocore.exceptions import ClientError
-  from cfn_resource_provider import ResourceProvider
-
-  class SAMLProvider(ResourceProvider):
-    """
-    Generic Cloudformation custom resource provider for Auth0 resources.
-    from https://github.com/binxio/cfn-saml-provider
-    """
-    def __init__(self):
-      super(SAMLProvider, self).__init__()
-      self.request_schema = {
-        "type": "object",
-        "oneOf": [
-          {
-          "properties": {
-            "Name": {"type": "string","description": "of the saml provider"},
-            "Metadata": {"type": "string", "description": "of the saml provider"}
-          },
-          "required": ["Name", "Metadata"]
-          },
-          {
-          "properties": {
-            "Name": {"type": "string", "description": "of the saml provider"},
-            "URL": { "type": "string", "description": "pointing to the SAML Metadata Document"}
-          },
-          "required": ["Name", "URL"]
+
+def s3_client():
+  """S3 client, created once per container"""
+  global _s3
+  if _s3 is None:
+    _s3 = boto3.client('s3')
+  return _s3
+
+
+def resolve_metadata(properties, deadline=None):
+  """Metadata document of a provider: Metadata, MetadataS3 (gzip object) or fetched from URL
+
+  MetadataHash, when set, is the sha256 the document must have.
+  """
+  if 'Metadata' in properties:
+    metadata = properties['Metadata']
+  elif 'MetadataS3' in properties:
+    location = properties['MetadataS3']
+    body = s3_client().get_object(Bucket=location['Bucket'], Key=location['Key'])['Body'].read()
+    metadata = gzip.decompress(body).decode('utf8')
+  else:
+    return fetch_metadata(properties['URL'], deadline)
+  if properties.get('MetadataHash') and digest(metadata) != properties['MetadataHash']:
+    raise FetchError('{}: metadata digest mismatch'.format(properties['Name']))
+  return metadata
+
+
+def iam_client():
+  """IAM client, created once per container"""
+  global _iam
+  if _iam is None:
+    _iam = boto3.client('iam')
+  return _iam
+
+
+class SAMLProvider(ResourceProvider):
+  """
+  Generic Cloudformation custom resource provider for Auth0 resources.
+  from https://github.com/binxio/cfn-saml-provider
+  """
+  def __init__(self, deadline=None):
+    super(SAMLProvider, self).__init__()
+    self.request_schema = {
+      "type": "object",
+      "oneOf": [
+        {
+        "properties": {
+          "Name": {"type": "string","description": "of the saml provider"},
+          "Metadata": {"type": "string", "description": "of the saml provider"}
+        },
+        "required": ["Name", "Metadata"]
+        },
+        {
+        "properties": {
+          "Name": {"type": "string", "description": "of the saml provider"},
+          "URL": { "type": "string", "description": "pointing to the SAML Metadata Document"}
+        },
+        "required": ["Name", "URL"]
+        },
+        {
+        "properties": {
+          "Name": {"type": "string", "description": "of the saml provider"},
+          "MetadataS3": {
+            "type": "object",
+            "properties": {"Bucket": {"type": "string"}, "Key": {"type": "string"}},
+            "required": ["Bucket", "Key"],
+            "description": "gzip SAML Metadata Document object"
           }
-        ]
-      }
-      self.iam = boto3.client('iam')
-
-    @property
-    def custom_cfn_resource_name(self):
-      return 'Custom::SAMLProvider'
-
-    def get_metadata(self):
-      logging.warning("RP: {}".format(self.properties))
-      metadata = self.get('Metadata', None)
-      if metadata != None:
-        return None, metadata
-      try:
-        response = requests.get(self.get('URL'))
-        metadata = response.text
-        if response.status_code == 200:
-          return None, metadata
-      except requests.exceptions.RequestException as e:
-        return '{}'.format(e), None
-
-      return 'url %s returned status code %d, %s'.format(self.get('URL'), response.status_code, response.text), None
-
-    def create(self):
-      err, metadata = self.get_metadata()
-      if err:
-        self.physical_resource_id = 'could-not-create'
-        self.fail(err)
-        return
-      try:
-        response = self.iam.create_saml_provider(Name=self.get('Name'), SAMLMetadataDocument=metadata)
-        self.physical_resource_id = response['SAMLProviderArn']
-      except ClientError as e:
-        self.physical_resource_id = 'could-not-create'
-        self.fail('{}'.format(e))
+        },
+        "required": ["Name", "MetadataS3"]
+        }
+      ]
+    }
+    self.iam = iam_client()
+    self.deadline = deadline
+
+  @property
+  def custom_cfn_resource_name(self):
+    return 'Custom::SAMLProvider'
+
+  def get_metadata(self):
+    logging.warning("RP: {}".format(self.properties))
+    try:
+      return None, resolve_metadata(self.properties, self.deadline)
+    except (FetchError, ClientError) as e:
+      return '{}'.format(e), None
 
-    def update(self):
-      err, metadata = self.get_metadata()
-      if err:
-        self.fail(err)
-        return
+  def create(self):
+    err, metadata = self.get_metadata()
+    if err:
+      self.physical_resource_id = 'could-not-create'
+      self.fail(err)
+      return
+    try:
+      response = self.iam.create_saml_provider(Name=self.get('Name'), SAMLMetadataDocument=metadata)
+      self.physical_resource_id = response['SAMLProviderArn']
+    except ClientError as e:
+      self.physical_resource_id = 'could-not-create'
+      self.fail('{}'.format(e))
+
+  def update(self):
+    err, metadata = self.get_metadata()
+    if err:
+      self.fail(err)
+      return
+    try:
+      update_provider(self.iam, self.physical_resource_id, metadata)
+    except ClientError as e:
+      self.fail('{}'.format(e))
+
+  def delete(self):
+    if re.match(r'arn:aws[-a-z]*:iam::[0-9]*:saml-provider/.*$', self.physical_resource_id):
       try:
-        response = self.iam.update_saml_provider(SAMLProviderArn=self.physical_resource_id, SAMLMetadataDocument=metadata)
+        response = self.iam.delete_saml_provider(SAMLProviderArn=self.physical_resource_id)
         self.physical_resource_id = response['SAMLProviderArn']
       except ClientError as e:
         self.fail('{}'.format(e))
 
-    def delete(self):
-      import re
-      if re.match(r'arn:aws[-a-z]*:iam::[0-9]*:saml-provider/.*$', self.physical_resource_id):
-        try:
-          response = self.iam.delete_saml_provider(SAMLProviderArn=self.physical_resource_id)
-          self.physical_resource_id = response['SAMLProviderArn']
-        except ClientError as e:
-          self.fail('{}'.format(e))
 
-  provider = SAMLProvider()
+class SAMLProviders(SAMLProvider):
+  """
+  Custom::SAMLProviders: the SAML providers of a list, metadata fetched concurrently.
+  Fn::GetAtt <provider name> returns the provider ARN.
+  Providers that already exist are updated, and left in place on delete: only the
+  ones created by the resource (OWNER_TAG) are deleted.
+  """
+  def __init__(self, deadline=None):
+    super(SAMLProviders, self).__init__(deadline)
+    self.request_schema = {
+      "type": "object",
+      "properties": {
+        "Providers": {
+          "type": "array",
+          "items": {
+            "type": "object",
+            "properties": {
+              "Name": {"type": "string", "description": "of the saml provider"},
+              "Metadata": {"type": "string", "description": "of the saml provider"},
+              "URL": {"type": "string", "description": "pointing to the SAML Metadata Document"},
+              "MetadataS3": {"type": "object", "description": "gzip SAML Metadata Document object"}
+            },
+            "oneOf": [{"required": ["Name", "Metadata"]}, {"required": ["Name", "URL"]}, {"required": ["Name", "MetadataS3"]}]
+          }
+        }
+      },
+      "required": ["Providers"]
+    }
+
+  @property
+  def custom_cfn_resource_name(self):
+    return 'Custom::SAMLProviders'
+
+  def providers(self, old=False):
+    properties = (self.old_properties if old else self.properties) or dict()
+    return dict((p['Name'], p) for p in properties.get('Providers', list()))
+
+  def arn(self, name):
+    # arn:<partition>:cloudformation:<region>:<account>:stack/...
+    _, partition, _, _, account = self.stack_id.split(':')[:5]
+    return 'arn:{}:iam::{}:saml-provider/{}'.format(partition, account, name)
+
+  def fetch_all(self, providers):
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_WORKERS, len(providers)))) as executor:
+      return dict(zip(providers, executor.map(lambda provider: resolve_metadata(provider, self.deadline), providers.values())))
+
+  def owner(self):
+    """OWNER_TAG value of this resource"""
+    return hashlib.sha256('{}/{}'.format(self.stack_id, self.logical_resource_id).encode('utf8')).hexdigest()
+
+  def owned(self, name):
+    """True if the provider was created by this resource"""
+    try:
+      tags = self.iam.list_saml_provider_tags(SAMLProviderArn=self.arn(name))['Tags']
+    except ClientError as e:
+      if e.response['Error']['Code'] == 'NoSuchEntity':
+        return False
+      raise
+    return dict((tag['Key'], tag['Value']) for tag in tags).get(OWNER_TAG) == self.owner()
+
+  def create_provider(self, name, metadata):
+    """Create a provider owned by this resource, or update the one that already exists (not owned)"""
+    try:
+      self.iam.create_saml_provider(Name=name, SAMLMetadataDocument=metadata, Tags=[dict(Key=OWNER_TAG, Value=self.owner())])
+    except ClientError as e:
+      if e.response['Error']['Code'] != 'EntityAlreadyExists':
+        raise
+      logging.warning(f"{name}: already exists, updated but not deleted with {self.logical_resource_id}")
+      update_provider(self.iam, self.arn(name), metadata)
+
+  def apply(self, providers, existing):
+    """Create the providers missing from existing, update the others"""
+    for name, metadata in self.fetch_all(providers).items():
+      if name in existing:
+        update_provider(self.iam, self.arn(name), metadata)
+      else:
+        self.create_provider(name, metadata)
+      self.set_attribute(name, self.arn(name))
+
+  def delete_provider(self, name):
+    """Delete a provider created by this resource, leave the others"""
+    if not self.owned(name):
+      logging.warning(f"{name}: not created by {self.logical_resource_id}, not deleted")
+      return
+    try:
+      self.iam.delete_saml_provider(SAMLProviderArn=self.arn(name))
+    except ClientError as e:
+      if e.response['Error']['Code'] != 'NoSuchEntity':
+        raise
+
+  def create(self):
+    # Set first: a failed create is rolled back by a delete, of the providers it created only (see owned)
+    self.physical_resource_id = 'saml-providers-{}'.format(self.logical_resource_id)
+    try:
+      self.apply(self.providers(), set())
+    except (FetchError, ClientError) as e:
+      self.fail('{}'.format(e))
+
+  def update(self):
+    providers, old = self.providers(), self.providers(old=True)
+    try:
+      self.apply(providers, set(old))
+      for name in set(old) - set(providers):
+        self.delete_provider(name)
+    except (FetchError, ClientError) as e:
+      self.fail('{}'.format(e))
+
+  def delete(self):
+    if not self.physical_resource_id.startswith('saml-providers-'):
+      return
+    try:
+      for name in self.providers():
+        self.delete_provider(name)
+    except ClientError as e:
+      self.fail('{}'.format(e))
+
+
+PROVIDERS = {
+  'Custom::SAMLProvider': SAMLProvider,
+  'Custom::SAMLProviders': SAMLProviders,
+}
+
+
+def handler(request, context):
+  logging.warning(request)
+  # Leave time for the IAM calls and the response to CloudFormation
+  provider = PROVIDERS.get(request.get('ResourceType'), SAMLProvider)(time.time() + context.get_remaining_time_in_millis() / 1000 - 5)
   return provider.handle(request, context)
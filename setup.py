@@ -21,6 +21,7 @@ setuptools.setup(
     packages=setuptools.find_packages(include=['aviv_cdk']),
     py_modules=[
         'bin.aws_local',
+        'bin.parallel_synth',
         'bin.sfn_extract'
     ],
     data_files=[
@@ -35,6 +36,7 @@ setuptools.setup(
     entry_points={
         'console_scripts': [
             'aviv-aws=bin.aws_local:cli',
+            'aviv-cdk-synth=bin.parallel_synth:cli',
             'aviv-cdk-sfn-extract=bin.sfn_extract:cli'
         ],
     },
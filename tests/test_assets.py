@@ -0,0 +1,109 @@
+import os
+import time
+import shutil
+import pytest
+
+pytest.importorskip('aws_cdk.core')
+from aws_cdk import aws_lambda
+from aviv_cdk import assets, core
+from aviv_cdk.cdk_lambda import CDKLambda
+
+# Wall-clock timings are machine dependent, only measured with AVIV_CDK_BENCHMARKS=1 (on a larger tree)
+BENCHMARKS = os.environ.get('AVIV_CDK_BENCHMARKS', '') not in ('', '0')
+FILES = 10000 if BENCHMARKS else 200
+
+
+@pytest.fixture(scope='module')
+def tree(tmpdir_factory):
+    root = tmpdir_factory.mktemp('tree')
+    for i in range(FILES):
+        d = root.join(f"pkg{i % 100}")
+        d.ensure(dir=True)
+        d.join(f"module{i}.py").write(f"VALUE = {i}\n")
+    return str(root)
+
+
+class TestAssets:
+    def test_link_tree(self, tree, tmpdir):
+        assert assets.link_tree(tree, str(tmpdir.join('link'))) == 0
+        src = os.path.join(tree, 'pkg1', 'module1.py')
+        assert os.stat(src).st_ino == os.stat(str(tmpdir.join('link', 'pkg1', 'module1.py'))).st_ino
+
+    def test_link_symlinks(self, tmpdir):
+        src = tmpdir.join('src')
+        src.join('index.py').write('A = 1\n', ensure=True)
+        shared = tmpdir.join('shared')
+        shared.join('lib.py').write('B = 2\n', ensure=True)
+        os.symlink(str(shared), str(src.join('lib')))
+        os.symlink(str(src.join('index.py')), str(src.join('main.py')))
+
+        assert assets.link_tree(str(src), str(tmpdir.join('link'))) == 0
+        assert tmpdir.join('link', 'lib', 'lib.py').read() == 'B = 2\n'
+        assert tmpdir.join('link', 'main.py').read() == 'A = 1\n'
+
+        # Content behind a symlinked directory is part of the hash
+        digest = assets.tree_hash(str(src))
+        shared.join('lib.py').write('B = 22\n')
+        assert assets.tree_hash(str(src)) != digest
+
+    @pytest.mark.skipif(not BENCHMARKS, reason='set AVIV_CDK_BENCHMARKS=1 to run the benchmarks')
+    def test_bench_link_tree(self, tree, tmpdir, record_property):
+        start = time.perf_counter()
+        shutil.copytree(tree, str(tmpdir.join('copy')))
+        copy = time.perf_counter() - start
+        start = time.perf_counter()
+        assets.link_tree(tree, str(tmpdir.join('link')))
+        link = time.perf_counter() - start
+        record_property('copytree_ms', round(copy * 1000, 1))
+        record_property('link_tree_ms', round(link * 1000, 1))
+        print(f"\n{FILES} files - copytree: {copy:.2f}s, link_tree: {link:.2f}s")
+
+    @pytest.mark.skipif(not BENCHMARKS, reason='set AVIV_CDK_BENCHMARKS=1 to run the benchmarks')
+    def test_bench_tree_hash(self, tree, record_property):
+        assets._hashes.clear()
+        start = time.perf_counter()
+        cold = assets.tree_hash(tree)
+        cold_time = time.perf_counter() - start
+        start = time.perf_counter()
+        assets.tree_hash(tree)
+        warm_time = time.perf_counter() - start
+        record_property('tree_hash_cold_ms', round(cold_time * 1000, 1))
+        record_property('tree_hash_cached_ms', round(warm_time * 1000, 1))
+        print(f"\n{FILES} files - tree_hash cold: {cold_time:.2f}s, cached: {warm_time:.2f}s")
+
+    def test_tree_hash(self, tree, tmpdir, monkeypatch):
+        assets._hashes.clear()
+        cold = assets.tree_hash(tree)
+        # Unchanged tree: the cached digest, not hashed again
+        monkeypatch.setattr(assets, 'hash_path', None)
+        assert assets.tree_hash(tree) == cold
+        monkeypatch.undo()
+
+        small = tmpdir.join('small')
+        small.join('index.py').write('A = 1\n', ensure=True)
+        digest = assets.tree_hash(str(small))
+        small.join('index.py').write('A = 22\n')
+        assert assets.tree_hash(str(small)) != digest
+
+    def test_shared_layer(self, tmpdir):
+        code = tmpdir.join('layer')
+        code.join('python', 'lib.py').write('A = 1\n', ensure=True)
+        app = core.App(outdir=str(tmpdir.join('cdk.out')))
+        stack = core.Stack(app, 'stack')
+        for name in ('one', 'two'):
+            CDKLambda(stack, name, layer_attrs=dict(code=str(code), description='lib'), remote_account_grant=True)
+        CDKLambda(stack, 'three', layer_attrs=dict(code=str(code), description='other'))
+        template = app.synth().get_stack_by_name('stack').template
+        types = [r['Type'] for r in template['Resources'].values()]
+        assert types.count('AWS::Lambda::LayerVersion') == 2
+        assert types.count('AWS::Lambda::LayerVersionPermission') == 1
+        assert types.count('AWS::SSM::Parameter') == 3
+
+    def test_inline_code(self, tmpdir, monkeypatch):
+        monkeypatch.chdir(tmpdir)
+        small = tmpdir.join('small.py')
+        small.write('"""' + 'doc\n' * 2000 + '"""\ndef handler(event, context):\n    return event\n')
+        assert isinstance(CDKLambda.inline_code(str(small)), aws_lambda.InlineCode)
+        large = tmpdir.join('large.py')
+        large.write(''.join(f"VALUE{i} = {i}\n" for i in range(1000)))
+        assert isinstance(CDKLambda.inline_code(str(large)), aws_lambda.AssetCode)
@@ -0,0 +1,34 @@
+import os
+import pytest
+from aviv_cdk import build_sizing
+
+HISTORY = os.path.join(os.path.dirname(__file__), 'fixtures', 'build-history.json')
+
+
+class TestComputeSizer:
+    def test_history(self):
+        history = build_sizing.load_history(HISTORY)
+        assert history['tests'] == {'SMALL': [1500, 1380], 'MEDIUM': [900]}
+        assert history['e2e'] == {'MEDIUM': [3000]}
+
+    def test_choices(self):
+        sizer = build_sizing.ComputeSizer(HISTORY, target=600)
+        assert sizer.choose('lint') == 'SMALL'
+        # SMALL (~1490s), MEDIUM (900s) and LARGE (~675s) miss the target: the fastest
+        assert sizer.choose('tests') == 'LARGE'
+        assert sizer.choose('e2e') == 'LARGE'
+        assert sizer.choose('unknown') is None
+        assert set(sizer.report()) == {'lint', 'tests', 'e2e'}
+
+    def test_cheapest(self):
+        assert build_sizing.ComputeSizer(HISTORY, target=1800).choose('tests') == 'SMALL'
+        assert build_sizing.ComputeSizer(HISTORY, target=700).choose('tests') == 'LARGE'
+
+    def test_unsupported(self):
+        with pytest.raises(ValueError):
+            build_sizing._size('BUILD_GENERAL1_2XLARGE')
+
+    def test_timestamp(self):
+        assert build_sizing._timestamp('2021-01-20T10:00:00Z') == build_sizing._timestamp('2021-01-20T10:00:00+00:00')
+        assert build_sizing._timestamp('2021-01-20T12:00:00.500000+02:00') == build_sizing._timestamp('2021-01-20T10:00:00Z') + 0.5
+        assert build_sizing._timestamp(1611136800) == build_sizing._timestamp('2021-01-20T10:00:00Z')
@@ -0,0 +1,53 @@
+import os
+import time
+import pytest
+
+pytest.importorskip('aws_cdk.core')
+from aws_cdk import core, aws_codepipeline as cp
+from aviv_cdk import pipelines
+
+# Wall-clock timings are machine dependent, only measured with AVIV_CDK_BENCHMARKS=1
+BENCHMARKS = os.environ.get('AVIV_CDK_BENCHMARKS', '') not in ('', '0')
+
+
+@pytest.fixture
+def buildspec(tmpdir):
+    spec = tmpdir.join('buildspec.yml')
+    spec.write("version: 0.2\nphases:\n  build:\n    commands:\n      - echo build\n")
+    return str(spec)
+
+
+class TestBuildspec:
+    def test_shared(self, buildspec):
+        assert pipelines.load_buildspec(buildspec) is pipelines.load_buildspec(buildspec)
+
+    def test_file_change(self, buildspec):
+        first = pipelines.load_buildspec(buildspec)
+        with open(buildspec, 'a') as fp:
+            fp.write("      - echo more\n")
+        assert pipelines.load_buildspec(buildspec) is not first
+
+    @pytest.mark.parametrize('actions', [1, 10, 100])
+    def test_build_actions(self, buildspec, actions):
+        pipelines._load_buildspec.cache_clear()
+        stack = core.Stack(core.App(), 'stack')
+        pipe = pipelines.Pipeline(stack, 'pipe', connections=dict())
+        source = cp.Artifact('source')
+        for i in range(actions):
+            pipe.build(f"build{i}", input=source, build_spec_file=buildspec)
+        assert pipelines._load_buildspec.cache_info().misses == 1
+
+    @pytest.mark.skipif(not BENCHMARKS, reason='set AVIV_CDK_BENCHMARKS=1 to run the benchmarks')
+    @pytest.mark.parametrize('actions', [1, 10, 100])
+    def test_bench_build_actions(self, buildspec, actions, record_property):
+        pipelines._load_buildspec.cache_clear()
+        stack = core.Stack(core.App(), 'stack')
+        pipe = pipelines.Pipeline(stack, 'pipe', connections=dict())
+        source = cp.Artifact('source')
+
+        start = time.perf_counter()
+        for i in range(actions):
+            pipe.build(f"build{i}", input=source, build_spec_file=buildspec)
+        elapsed = time.perf_counter() - start
+        record_property('build_actions_ms', round(elapsed * 1000, 1))
+        print(f"\n{actions} build action(s): {elapsed * 1000:.1f}ms")
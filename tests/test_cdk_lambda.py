@@ -0,0 +1,68 @@
+import json
+import pytest
+
+pytest.importorskip('aws_cdk.core')
+from aws_cdk import aws_lambda
+from aviv_cdk import core
+from aviv_cdk.cdk_lambda import CDKLambda, WARMER_EVENT
+
+
+def function(tmpdir, native: bool=False, runtime: aws_lambda.Runtime=aws_lambda.Runtime.PYTHON_3_8, context: dict=None, lambda_attrs: dict=None, **performance) -> dict:
+    code = tmpdir.join('code')
+    code.join('index.py').write('def handler(event, context):\n    return event\n', ensure=True)
+    if native:
+        code.join('lib.cpython-38-x86_64-linux-gnu.so').write('')
+    app = core.App(outdir=str(tmpdir.join('cdk.out')), context=context)
+    stack = core.Stack(app, 'stack')
+    fn = CDKLambda(stack, 'fn', lambda_attrs=dict(code=str(code), handler='index.handler', runtime=runtime, **(lambda_attrs or dict())))
+    fn.performance(**performance)
+    return app.synth().get_stack_by_name('stack').template['Resources']
+
+
+def of_type(resources: dict, cfn_type: str) -> list:
+    return [r for r in resources.values() if r['Type'] == cfn_type]
+
+
+class TestPerformance:
+    def test_arm64(self, tmpdir):
+        [fn] = of_type(function(tmpdir, arm64='auto', memory_size=512), 'AWS::Lambda::Function')
+        assert fn['Properties']['Architectures'] == ['arm64']
+        assert fn['Properties']['MemorySize'] == 512
+
+    def test_x86_64_default(self, tmpdir):
+        [fn] = of_type(function(tmpdir, memory_size=512), 'AWS::Lambda::Function')
+        assert 'Architectures' not in fn['Properties']
+
+    def test_native_code(self, tmpdir):
+        [fn] = of_type(function(tmpdir, native=True, profile='cost'), 'AWS::Lambda::Function')
+        assert 'Architectures' not in fn['Properties']
+
+    def test_runtime(self, tmpdir):
+        [fn] = of_type(function(tmpdir.join('auto'), runtime=aws_lambda.Runtime.PYTHON_3_7, profile='cost'), 'AWS::Lambda::Function')
+        assert 'Architectures' not in fn['Properties']
+        with pytest.raises(ValueError):
+            function(tmpdir.join('arm64'), runtime=aws_lambda.Runtime.PYTHON_3_7, arm64=True)
+
+    def test_provisioned_schedule(self, tmpdir):
+        resources = function(tmpdir, profile='office-hours')
+        assert len(of_type(resources, 'AWS::Lambda::Alias')) == 1
+        [target] = of_type(resources, 'AWS::ApplicationAutoScaling::ScalableTarget')
+        assert [a['ScalableTargetAction']['MinCapacity'] for a in target['Properties']['ScheduledActions']] == [2, 0]
+        assert [a['ScalableTargetAction']['MaxCapacity'] for a in target['Properties']['ScheduledActions']] == [2, 0]
+
+    def test_warmer(self, tmpdir):
+        [rule] = of_type(function(tmpdir, profile='latency'), 'AWS::Events::Rule')
+        assert rule['Properties']['ScheduleExpression'] == 'rate(5 minutes)'
+        assert json.loads(rule['Properties']['Targets'][0]['Input']) == WARMER_EVENT
+
+
+class TestPowerTuning:
+    def test_tuned_memory(self, tmpdir, monkeypatch):
+        monkeypatch.chdir(tmpdir)
+        tmpdir.join('power-tuning.json').write(json.dumps({'stack/fn': {'memory_size': 768}}))
+        [fn] = of_type(function(tmpdir.join('off')), 'AWS::Lambda::Function')
+        assert 'MemorySize' not in fn['Properties']
+        [fn] = of_type(function(tmpdir.join('on'), context={'aviv:power-tuning': 'true'}), 'AWS::Lambda::Function')
+        assert fn['Properties']['MemorySize'] == 768
+        [fn] = of_type(function(tmpdir.join('explicit'), context={'aviv:power-tuning': 'true'}, lambda_attrs=dict(memory_size=256)), 'AWS::Lambda::Function')
+        assert fn['Properties']['MemorySize'] == 256
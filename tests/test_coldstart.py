@@ -0,0 +1,84 @@
+import os
+import sys
+import pytest
+from aviv_cdk import coldstart
+
+MODULES = 200
+RUNTIME = '{}.{}'.format(*sys.version_info[:2])
+# strip_docstrings() needs the python 3.8 ast end positions
+strips_docstrings = pytest.mark.skipif(sys.version_info < (3, 8), reason='python < 3.8 keeps docstrings')
+
+
+def lambda_code(root) -> str:
+    doc = '"""' + 'Some documentation.\n' * 50 + '"""\n'
+    root.join('index.py').write(doc + 'import lib\n\ndef handler(event, context):\n    """Handler"""\n    return lib.total()\n', ensure=True)
+    lib = root.join('lib')
+    imports = ''.join(f"from . import mod{i}\n" for i in range(MODULES))
+    lib.join('__init__.py').write(doc + imports + 'def total():\n    return mod1.VALUE\n', ensure=True)
+    for i in range(MODULES):
+        lib.join(f"mod{i}.py").write(doc + f"class C{i}:\n    {doc}\n\ndef f():\n    'doc'\n\nVALUE = {i}\n")
+    lib.join('tests', 'test_lib.py').write('def test(): pass\n', ensure=True)
+    root.join('boto3', '__init__.py').write('x = 1\n', ensure=True)
+    root.join('botocore', 'data', 's3', '2006-03-01', 'service-2.json').write('{}', ensure=True)
+    root.join('botocore', 'data', 'ec2', '2016-11-15', 'service-2.json').write('{}', ensure=True)
+    return str(root)
+
+
+class TestColdStart:
+    @strips_docstrings
+    def test_strip_docstrings(self):
+        source = '"""Module"""\nfrom __future__ import annotations\n\ndef f():\n    """Doc\n    string"""\n    return 1  # one\n\nclass A: "doc"; B = 1\n'
+        stripped = coldstart.strip_docstrings(source)
+        assert 'Doc' not in stripped and 'Module' not in stripped
+        # Same lines (tracebacks), statements after a docstring are kept
+        assert len(stripped.splitlines()) == len(source.splitlines())
+        assert '"doc"; B = 1' in stripped
+        scope = dict()
+        exec(compile(stripped, 'x.py', 'exec'), scope)
+        assert scope['f']() == 1
+
+    @strips_docstrings
+    def test_pack(self, tmpdir):
+        src = lambda_code(tmpdir.join('src'))
+        dst = str(tmpdir.join('packed'))
+        report = coldstart.pack(src, dst, runtime=RUNTIME)
+        assert report['after'] < report['before']
+        assert list(report['packages'])[0] == 'lib'
+        assert not os.path.exists(os.path.join(dst, 'lib', 'tests'))
+        assert not os.path.exists(os.path.join(dst, 'boto3'))
+        assert os.listdir(os.path.join(dst, 'lib', '__pycache__'))
+        with open(os.path.join(dst, 'lib', 'mod1.py')) as fp:
+            assert 'documentation' not in fp.read()
+
+        kept = coldstart.pack(src, str(tmpdir.join('boto')), runtime=RUNTIME, boto_services=['s3'])
+        assert 'boto3' in kept['packages']
+        assert os.path.exists(str(tmpdir.join('boto', 'botocore', 'data', 's3')))
+        assert not os.path.exists(str(tmpdir.join('boto', 'botocore', 'data', 'ec2')))
+
+    def test_import_time(self, tmpdir, record_property):
+        src = lambda_code(tmpdir.join('src'))
+        dst = str(tmpdir.join('packed'))
+        report = coldstart.pack(src, dst, runtime=RUNTIME)
+        assert report['after'] < report['before']
+        # Both import (check=True raises otherwise), timings reported as test properties (junitxml)
+        record_property('raw_import_ms', round(coldstart.import_time(src, 'index') * 1000, 1))
+        record_property('packed_import_ms', round(coldstart.import_time(dst, 'index') * 1000, 1))
+
+
+class TestMinify:
+    def test_minify(self):
+        import ast
+        path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lambdas', 'iam_idp', 'saml.py')
+        with open(path, encoding='utf8') as fp:
+            source = fp.read()
+        minified = coldstart.minify(source)
+        assert len(minified.encode('utf8')) < len(source.encode('utf8'))
+        assert ast.dump(ast.parse(minified)) == ast.dump(ast.parse(coldstart.strip_docstrings(source)))
+
+    def test_tokens(self):
+        source = 'def f(x):  # comment\n    if x:\n        return 1 .real + x.real\n    return [\n        x,\n        f"{x!r:>{4}}",\n    ]\n'
+        minified = coldstart.minify(source)
+        assert minified == 'def f(x):\n if x:\n  return 1 .real+x.real\n return[x,f"{x!r:>{4}}",]\n'
+        scope = dict()
+        exec(minified, scope)
+        assert scope['f'](0) == [0, '   0']
@@ -0,0 +1,102 @@
+import pytest
+
+pytest.importorskip('aws_cdk.core')
+from aws_cdk.core import Aspects
+from aviv_cdk import core, iam, policy_compaction
+
+ROLES = 200
+IDP = 'arn:aws:iam::123456789012:saml-provider/idp'
+
+
+class TestManagedPolicies:
+    def test_shared_imports(self):
+        app = core.App()
+        stack = core.Stack(app, 'stack')
+        for i in range(ROLES):
+            iam.SAMLRole(stack, f"role{i}", IDP, policies=['ReadOnlyAccess'])
+        imports = [c for c in stack.node.children if c.node.id.startswith('ManagedPolicy-')]
+        assert len(imports) == 1
+
+        template = app.synth().get_stack_by_name('stack').template
+        arns = [r['Properties']['ManagedPolicyArns'] for r in template['Resources'].values() if r['Type'] == 'AWS::IAM::Role']
+        assert len(arns) == ROLES
+        assert all(arn == ['arn:aws:iam::aws:policy/ReadOnlyAccess'] for arn in arns)
+
+    def test_roles_spec(self):
+        app = core.App()
+        stack = core.Stack(app, 'stack')
+        created = iam.roles(stack, {
+            'defaults': {'federated': IDP, 'policies': ['ReadOnlyAccess'], 'max_session_duration': 3600},
+            'roles': {
+                'admin': {'policies': ['AdministratorAccess']},
+                'viewer': None,
+                'deploy': {'federated': None, 'assumed_by': 'codebuild.amazonaws.com'},
+            }
+        })
+        assert sorted(created) == ['admin', 'deploy', 'viewer']
+        assert isinstance(created['admin'], iam.SAMLRole)
+        assert not isinstance(created['deploy'], iam.SAMLRole)
+        template = app.synth().get_stack_by_name('stack').template
+        admin = [r for r in template['Resources'].values() if r['Type'] == 'AWS::IAM::Role' and r['Properties']['RoleName'] == 'admin'][0]
+        assert admin['Properties']['ManagedPolicyArns'] == ['arn:aws:iam::aws:policy/ReadOnlyAccess', 'arn:aws:iam::aws:policy/AdministratorAccess']
+        assert admin['Properties']['MaxSessionDuration'] == 3600
+
+
+class TestPolicyCompactor:
+    def test_aspect(self):
+        from aws_cdk import aws_iam
+        app = core.App()
+        stack = core.Stack(app, 'stack')
+        role = iam.Role(stack, 'role', assumed_by=aws_iam.ServicePrincipal('lambda.amazonaws.com'))
+        for i in range(300):
+            role.add_to_policy(aws_iam.PolicyStatement(actions=['s3:GetObject', 's3:PutObject'], resources=[f"arn:aws:s3:::bucket-with-a-long-name-{i}/*"]))
+            role.add_to_policy(aws_iam.PolicyStatement(actions=['sqs:SendMessage'], resources=[f"arn:aws:sqs:eu-west-1:123456789012:queue-{i}"]))
+        compactor = iam.PolicyCompactor()
+        Aspects.of(stack).add(compactor)
+        template = app.synth().get_stack_by_name('stack').template
+        [policy] = [r for r in template['Resources'].values() if r['Type'] == 'AWS::IAM::Policy']
+        assert len(policy['Properties']['PolicyDocument']['Statement']) <= 2
+        managed = [r for r in template['Resources'].values() if r['Type'] == 'AWS::IAM::ManagedPolicy']
+        assert managed and all(m['Properties']['Roles'] == policy['Properties']['Roles'] for m in managed)
+        before, after = list(compactor.report.values())[0]
+        assert after < before
+
+    def test_inline_total(self):
+        from aws_cdk import aws_iam
+        app = core.App()
+        stack = core.Stack(app, 'stack')
+        statement = lambda i: aws_iam.PolicyStatement(actions=['s3:GetObject'], resources=[f"arn:aws:s3:::bucket-with-a-long-name-{i}/*"])
+        # Each under the inline limit, not together
+        role = iam.Role(stack, 'role', assumed_by=aws_iam.ServicePrincipal('lambda.amazonaws.com'), inline_policies={
+            'inline': aws_iam.PolicyDocument(statements=[statement(i) for i in range(150)])
+        })
+        for i in range(150, 300):
+            role.add_to_policy(statement(i))
+        # Never split
+        role.add_managed_policy(aws_iam.ManagedPolicy(stack, 'managed', statements=[statement(i) for i in range(300, 500)]))
+        Aspects.of(stack).add(iam.PolicyCompactor())
+        resources = app.synth().get_stack_by_name('stack').template['Resources']
+
+        [cfn_role] = [r['Properties'] for r in resources.values() if r['Type'] == 'AWS::IAM::Role']
+        [policy] = [r['Properties'] for r in resources.values() if r['Type'] == 'AWS::IAM::Policy']
+        documents = [p['PolicyDocument'] for p in cfn_role.get('Policies', list())] + [policy['PolicyDocument']]
+        assert sum(policy_compaction.size(d) for d in documents) <= policy_compaction.INLINE_LIMIT
+        managed = [r['Properties'] for r in resources.values() if r['Type'] == 'AWS::IAM::ManagedPolicy']
+        parts = [m for m in managed if 'Roles' in m]
+        assert len(parts) == len(managed) - 1
+        granted = set(r for d in documents + [m['PolicyDocument'] for m in parts] for s in d['Statement'] for r in policy_compaction._list(s['Resource']))
+        assert granted == set(f"arn:aws:s3:::bucket-with-a-long-name-{i}/*" for i in range(300))
+
+    def test_depends_on(self):
+        statements = [dict(Effect='Allow', Action="sqs:SendMessage", Resource=f"arn:aws:sqs:eu-west-1:123456789012:queue-with-a-long-name-{i}") for i in range(300)]
+        template = {'Resources': {
+            'role': {'Type': 'AWS::IAM::Role', 'Properties': dict()},
+            'policy': {'Type': 'AWS::IAM::Policy', 'Properties': dict(PolicyName='policy', Roles=[{'Ref': 'role'}], PolicyDocument=dict(Version='2012-10-17', Statement=statements))},
+            'fn': {'Type': 'AWS::Lambda::Function', 'DependsOn': ['role', 'policy']},
+        }}
+        # Merged into one statement, over the limit: split by resources
+        resources = iam.PolicyCompactor().compact_template(template, 'stack')['Resources']
+        parts = [lid for lid, r in resources.items() if r['Type'] == 'AWS::IAM::ManagedPolicy']
+        assert parts and all(resources[p]['Properties']['Roles'] == [{'Ref': 'role'}] for p in parts)
+        assert resources['fn']['DependsOn'] == ['role', 'policy'] + parts
+        assert policy_compaction.size(resources['policy']['Properties']['PolicyDocument']) <= policy_compaction.INLINE_LIMIT
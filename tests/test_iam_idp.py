@@ -0,0 +1,73 @@
+import os
+import gzip
+import hashlib
+import pytest
+
+pytest.importorskip('aws_cdk.core')
+from aviv_cdk import core, iam_idp
+
+SAML = os.path.join(os.path.dirname(__file__), '..', 'lambdas', 'iam_idp', 'saml.py')
+METADATA = '<?xml version="1.0"?><EntityDescriptor xmlns="urn:oasis:names:tc:SAML:2.0:metadata" entityID="https://idp.example.com">' \
+    '<IDPSSODescriptor><KeyDescriptor use="signing">{}</KeyDescriptor></IDPSSODescriptor></EntityDescriptor>'
+
+
+def of_type(resources: dict, cfn_type: str) -> list:
+    return [r for r in resources.values() if r['Type'] == cfn_type]
+
+
+def layer(tmpdir) -> str:
+    path = tmpdir.join('layer')
+    path.join('python', 'cfn_resource_provider.py').write('', ensure=True)
+    return str(path)
+
+
+class TestSharedFunction:
+    def test_singleton(self, tmpdir):
+        options = dict(cfn_lambda=SAML, cfn_resources_path=layer(tmpdir))
+        app = core.App(outdir=str(tmpdir.join('cdk.out')))
+        stack = core.Stack(app, 'stack')
+        iam_idp.IAMIdpSAML(stack, 'idp-a', 'a', 'https://a.example.com/metadata', shared_function=True, **options)
+        iam_idp.IAMIdpSAML(stack, 'idp-b', 'b', 'https://b.example.com/metadata', shared_function=True, **options)
+        idps = iam_idp.IAMIdpSAMLProviders(stack, 'idps', dict(d='https://d.example.com/metadata', c='https://c.example.com/metadata'), **options)
+        assert stack.resolve(idps.arn('c'))['Fn::GetAtt'][1] == 'c'
+        resources = app.synth().get_stack_by_name('stack').template['Resources']
+
+        assert len(of_type(resources, 'AWS::Lambda::Function')) == 1
+        assert len(of_type(resources, 'AWS::Lambda::LayerVersion')) == 1
+        assert len(of_type(resources, 'AWS::CloudFormation::CustomResource') + of_type(resources, 'Custom::SAMLProvider')) == 2
+        [providers] = of_type(resources, 'Custom::SAMLProviders')
+        assert [p['Name'] for p in providers['Properties']['Providers']] == ['c', 'd']
+        # Only the providers SSM parameters, the shared function has the same name in every stack
+        parameters = [p['Properties']['Name'] for p in of_type(resources, 'AWS::SSM::Parameter')]
+        assert sorted(parameters) == ['/idp/a', '/idp/b', '/idps/c', '/idps/d']
+
+
+class TestMetadataFile:
+    def test_load_metadata(self, tmpdir):
+        valid = tmpdir.join('idp.xml')
+        valid.write(METADATA.format('MIIC' * 250))
+        assert iam_idp.load_metadata(str(valid)).startswith('<?xml')
+        for content in ('<not xml', METADATA.format(''), METADATA.format('MIIC' * 250).replace('IDPSSODescriptor', 'SPSSODescriptor')):
+            tmpdir.join('invalid.xml').write(content)
+            with pytest.raises(ValueError):
+                iam_idp.load_metadata(str(tmpdir.join('invalid.xml')))
+
+    def test_properties(self, tmpdir, monkeypatch):
+        monkeypatch.chdir(tmpdir)
+        tmpdir.join('small.xml').write(METADATA.format('MIIC' * 250))
+        tmpdir.join('large.xml').write(METADATA.format('MIIC' * 2000))
+        app = core.App(outdir=str(tmpdir.join('cdk.out')))
+        stack = core.Stack(app, 'stack')
+        options = dict(cfn_lambda=SAML, cfn_resources_path=layer(tmpdir), shared_function=True)
+        iam_idp.IAMIdpSAML(stack, 'idp-small', 'small', idp_metadata='small.xml', **options)
+        iam_idp.IAMIdpSAML(stack, 'idp-large', 'large', idp_metadata='large.xml', **options)
+        with pytest.raises(ValueError):
+            iam_idp.IAMIdpSAML(stack, 'idp-none', 'none', **options)
+        resources = app.synth().get_stack_by_name('stack').template['Resources']
+
+        small, large = sorted((r['Properties'] for r in resources.values() if r['Type'] in ('Custom::SAMLProvider', 'AWS::CloudFormation::CustomResource')), key=lambda p: p['Name'], reverse=True)
+        assert small['Metadata'] == tmpdir.join('small.xml').read()
+        assert small['MetadataHash'] == hashlib.sha256(small['Metadata'].encode('utf8')).hexdigest()
+        assert 'Metadata' not in large and set(large['MetadataS3']) == {'Bucket', 'Key'}
+        [asset] = tmpdir.join(iam_idp.METADATA_DIR).listdir()
+        assert gzip.decompress(asset.read_binary()).decode('utf8') == tmpdir.join('large.xml').read()
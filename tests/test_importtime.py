@@ -0,0 +1,71 @@
+import os
+import sys
+import subprocess
+import pytest
+
+# Import budgets (cumulative, in ms), machine dependent so only checked with AVIV_CDK_IMPORT_BUDGETS=1
+# or AVIV_CDK_IMPORT_BUDGET_MS (one budget for all modules)
+BUDGET_MS = float(os.environ.get('AVIV_CDK_IMPORT_BUDGET_MS', 0)) or None
+CHECK_BUDGETS = bool(BUDGET_MS) or os.environ.get('AVIV_CDK_IMPORT_BUDGETS', '') not in ('', '0')
+BUDGETS = {
+    'aviv_cdk': 50,
+    'aviv_cdk.core': 3000,
+    'aviv_cdk.secretsmanager': 4000,
+    'aviv_cdk.iam': 4000,
+    'aviv_cdk.cdk_lambda': 5000,
+    'aviv_cdk.pipelines': 8000,
+}
+# CDK service packages a module must NOT load at import time
+# (aws_codepipeline_actions, imported by pipelines, imports aws_cloudformation itself)
+FORBIDDEN = {
+    'aviv_cdk.core': ['aws_cdk.aws_ssm'],
+    'aviv_cdk.secretsmanager': ['aws_cdk.aws_codebuild', 'aws_cdk.aws_codepipeline'],
+    'aviv_cdk.iam': ['aws_cdk.aws_secretsmanager', 'aws_cdk.aws_codebuild'],
+    'aviv_cdk.cdk_lambda': ['aws_cdk.aws_events_targets', 'aws_cdk.aws_codebuild'],
+    'aviv_cdk.pipelines': ['aws_cdk.aws_codestarconnections'],
+}
+
+
+def importtime(module: str) -> dict:
+    """Run `python -X importtime -c 'import <module>'` in a fresh interpreter
+
+    Returns:
+        dict: imported module name -> cumulative import time (us)
+    """
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f"import {module}"],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    )
+    if proc.returncode:
+        pytest.skip(f"Can't import {module}: {proc.stderr.splitlines()[-1]}")
+    timings = dict()
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        timings[name.strip()] = int(cumulative)
+    return timings
+
+
+class TestImportTime:
+    def test_package_is_lazy(self):
+        timings = importtime('aviv_cdk')
+        assert not [mod for mod in timings if mod.startswith('aws_cdk')]
+        if CHECK_BUDGETS:
+            assert timings['aviv_cdk'] / 1000 < (BUDGET_MS or BUDGETS['aviv_cdk'])
+
+    @pytest.mark.parametrize('module', sorted(FORBIDDEN))
+    def test_submodule_imports(self, module):
+        pytest.importorskip('aws_cdk.core')
+        timings = importtime(module)
+        for forbidden in FORBIDDEN[module]:
+            assert forbidden not in timings, f"{module} eagerly imports {forbidden}"
+        if CHECK_BUDGETS:
+            assert timings[module] / 1000 < (BUDGET_MS or BUDGETS[module])
+
+    def test_lazy_attribute(self):
+        import aviv_cdk
+        assert 'pipelines' in dir(aviv_cdk)
+        with pytest.raises(AttributeError):
+            aviv_cdk.nope
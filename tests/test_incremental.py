@@ -0,0 +1,84 @@
+import os
+import json
+import pytest
+
+pytest.importorskip('aws_cdk.core')
+from aws_cdk import aws_lambda, aws_ssm
+from aviv_cdk import core, incremental
+from aviv_cdk.cdk_lambda import CDKLambda
+
+STACKS = 50
+
+
+def synthesized(app: core.App) -> list:
+    """Stacks left in the app by the synth cache"""
+    return [c.node.id for c in app.node.children if isinstance(c, core.Stack)]
+
+
+def synth(outdir: str, cache_dir: str, value: str='value') -> core.App:
+    app = core.App(outdir=outdir, context={incremental.INCREMENTAL_CONTEXT: cache_dir})
+    for i in range(STACKS):
+        stack = core.Stack(app, f"stack{i}")
+        for j in range(10):
+            aws_ssm.StringParameter(stack, f"param{j}", string_value=value if i == 0 else f"{i}-{j}")
+        incremental.track(stack, value if i == 0 else None)
+    app.synth()
+    return app
+
+
+class TestIncremental:
+    def test_cold_warm(self, tmpdir):
+        cache_dir = str(tmpdir.join('cache'))
+        assert len(synthesized(synth(str(tmpdir.join('cold')), cache_dir))) == STACKS
+        assert synthesized(synth(str(tmpdir.join('warm')), cache_dir)) == []
+
+        for name in ('cold', 'warm'):
+            with open(tmpdir.join(name, 'manifest.json')) as fp:
+                manifest = json.load(fp)
+            assert len([a for a in manifest['artifacts'].values() if a['type'] == 'aws:cloudformation:stack']) == STACKS
+        with open(tmpdir.join('cold', 'stack1.template.json')) as cold, open(tmpdir.join('warm', 'stack1.template.json')) as warm:
+            assert json.load(cold) == json.load(warm)
+
+    def test_stack_name(self, tmpdir):
+        cache_dir = str(tmpdir.join('cache'))
+
+        def named_app(name: str) -> core.App:
+            app = core.App(outdir=str(tmpdir.join(name)), context={incremental.INCREMENTAL_CONTEXT: cache_dir})
+            stack = core.Stack(app, 'stack', stack_name='named-stack')
+            aws_ssm.StringParameter(stack, 'param', string_value='value')
+            incremental.track(stack)
+            app.synth()
+            return app
+
+        named_app('cold')
+        assert synthesized(named_app('warm')) == []
+        with open(tmpdir.join('warm', 'manifest.json')) as fp:
+            assert 'named-stack' in json.load(fp)['artifacts']
+        with open(tmpdir.join('cold', 'named-stack.template.json')) as cold, open(tmpdir.join('warm', 'named-stack.template.json')) as warm:
+            assert json.load(cold) == json.load(warm)
+
+    def test_invalidation(self, tmpdir):
+        cache_dir = str(tmpdir.join('cache'))
+        synth(str(tmpdir.join('v1')), cache_dir, value='v1')
+        synth(str(tmpdir.join('v2')), cache_dir, value='v2')
+        with open(tmpdir.join('v2', 'stack0.template.json')) as fp:
+            assert 'v2' in json.dumps(json.load(fp))
+
+    def test_assets(self, tmpdir):
+        cache_dir = str(tmpdir.join('cache'))
+        code = tmpdir.join('code')
+        code.join('index.py').write('def handler(event, context):\n    return 1\n', ensure=True)
+
+        def lambda_app(name: str) -> core.App:
+            app = core.App(outdir=str(tmpdir.join(name)), context={incremental.INCREMENTAL_CONTEXT: cache_dir})
+            for kind in ('path', 'asset'):
+                stack = core.Stack(app, kind)
+                # Code given as a path (tracked) or as an AssetCode (hashed from its staging)
+                CDKLambda(stack, 'fn', lambda_attrs=dict(code=str(code) if kind == 'path' else aws_lambda.Code.from_asset(str(code)), handler='index.handler', runtime=aws_lambda.Runtime.PYTHON_3_8))
+            app.synth()
+            return app
+
+        lambda_app('v1')
+        assert synthesized(lambda_app('v1-again')) == []
+        code.join('index.py').write('def handler(event, context):\n    return 2\n')
+        assert sorted(synthesized(lambda_app('v2'))) == ['asset', 'path']
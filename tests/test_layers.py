@@ -0,0 +1,68 @@
+import os
+import zipfile
+from aviv_cdk import layers
+
+
+def fake_pip(calls):
+    def pip(*args):
+        calls.append(args)
+        if args[0] == 'install':
+            target = args[args.index('-t') + 1]
+            for name in ('pkg/__init__.py', 'pkg/__pycache__/x.cpython-38.pyc', 'pkg/tests/test_x.py', 'pkg-1.0.dist-info/METADATA', 'pkg-1.0.dist-info/RECORD'):
+                os.makedirs(os.path.dirname(os.path.join(target, name)), exist_ok=True)
+                with open(os.path.join(target, name), 'w') as fp:
+                    fp.write(name)
+
+        class Result:
+            returncode = 0
+            stdout = ''
+        return Result
+    return pip
+
+
+class TestLayers:
+    def test_lock_hash(self, tmpdir):
+        req = tmpdir.join('requirements.txt')
+        req.write('requests==2.25\n# comment\n\nboto3==1.17\n')
+        digest = layers.lock_hash(str(req))
+        req.write('boto3==1.17  # client\nrequests==2.25\n')
+        assert layers.lock_hash(str(req)) == digest
+        assert layers.lock_hash(str(req), python_version='3.7') != digest
+        req.write('boto3==1.18\nrequests==2.25\n')
+        assert layers.lock_hash(str(req)) != digest
+
+    def test_build_layer(self, tmpdir, monkeypatch):
+        calls = list()
+        monkeypatch.setattr(layers, '_pip', fake_pip(calls))
+        req = tmpdir.join('deps', 'requirements.txt')
+        req.write('requests==2.25\n', ensure=True)
+        options = dict(outdir=str(tmpdir.join('layers')), wheel_cache=str(tmpdir.join('wheels')))
+
+        filename = layers.build_layer(str(req), **options)
+        assert os.path.basename(filename).startswith('deps-')
+        with zipfile.ZipFile(filename) as zf:
+            assert zf.namelist() == ['python/pkg-1.0.dist-info/METADATA', 'python/pkg/__init__.py']
+            assert {info.date_time for info in zf.infolist()} == {layers.ZIP_DATE}
+        with open(filename, 'rb') as fp:
+            content = fp.read()
+        assert len(calls) == 1
+
+        # Unchanged lock hash: not built again
+        assert layers.build_layer(str(req), **options) == filename
+        assert len(calls) == 1
+
+        # Reproducible
+        os.remove(filename)
+        assert layers.build_layer(str(req), **options) == filename
+        with open(filename, 'rb') as fp:
+            assert fp.read() == content
+
+        req.write('requests==2.26\n')
+        assert layers.build_layer(str(req), **options) != filename
+        assert not os.path.exists(filename)
+
+        # Absolute, jsii resolves relative asset paths against the cwd of its node process
+        monkeypatch.chdir(tmpdir)
+        filename = layers.build_layer(str(req), outdir='layers', wheel_cache=options['wheel_cache'])
+        assert os.path.isabs(filename) and os.path.exists(filename)
+        assert len(calls) == 3
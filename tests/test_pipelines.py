@@ -0,0 +1,184 @@
+import os
+import json
+import pytest
+
+pytest.importorskip('aws_cdk.core')
+from aws_cdk import core, aws_codebuild as cb, aws_codepipeline as cp
+from aviv_cdk import pipelines
+
+
+def pipeline(**kwargs):
+    stack = core.Stack(core.App(), 'stack')
+    return stack, pipelines.Pipeline(stack, 'pipe', connections=dict(), **kwargs)
+
+
+def projects(stack):
+    return [c for c in stack.node.find_all() if isinstance(c, cb.Project)]
+
+
+class TestProjectPool:
+    def test_shared_project(self):
+        stack, pipe = pipeline(share_projects=True)
+        source = cp.Artifact('source')
+        for i in range(3):
+            pipe.build(f"build{i}", input=source, project_props=dict(
+                environment_variables=dict(TARGET=cb.BuildEnvironmentVariable(value=f"t{i}"))
+            ))
+        assert len(projects(stack)) == 1
+        assert len(pipe.actions['build']) == 3
+
+    def test_different_environment(self):
+        stack, pipe = pipeline(share_projects=True)
+        source = cp.Artifact('source')
+        pipe.build('small', input=source, project_props=dict(environment=cb.BuildEnvironment(compute_type=cb.ComputeType.SMALL)))
+        pipe.build('large', input=source, project_props=dict(environment=cb.BuildEnvironment(compute_type=cb.ComputeType.LARGE)))
+        assert len(projects(stack)) == 2
+
+    def test_different_buildspec(self, tmpdir):
+        stack, pipe = pipeline(share_projects=True)
+        source = cp.Artifact('source')
+        for name in ('a', 'b', 'c'):
+            spec = tmpdir.join(f"{name}.yml")
+            spec.write(f"version: 0.2\nphases:\n  build:\n    commands:\n      - echo {'a' if name == 'c' else name}\n")
+            pipe.build(name, input=source, build_spec_file=str(spec))
+        # c has the same content as a
+        assert len(projects(stack)) == 2
+
+    def test_no_sharing(self):
+        stack, pipe = pipeline()
+        source = cp.Artifact('source')
+        pipe.build('a', input=source)
+        pipe.build('b', input=source)
+        assert len(projects(stack)) == 2
+
+
+class TestBuildCache:
+    def synth_projects(self, **kwargs):
+        app = core.App()
+        stack = core.Stack(app, 'stack')
+        pipe = pipelines.Pipeline(stack, 'pipe', connections=dict(), **kwargs)
+        _, source = pipe.github_source('aviv-group', 'repo', connection_arn='arn:aws:codestar-connections:eu-west-1:123456789012:connection/x')
+        pipe.build('build', input=source)
+        pipe.build('test', input=source, project_props=dict(environment=cb.BuildEnvironment(privileged=True)))
+        pipe.create_project('project')
+        pipe.stage_all()
+        template = app.synth().get_stack_by_name('stack').template
+        return template, [r for r in template['Resources'].values() if r['Type'] == 'AWS::CodeBuild::Project']
+
+    def test_local(self):
+        _, projects = self.synth_projects(cache_profile='local')
+        assert len(projects) == 3
+        for project in projects:
+            assert project['Properties']['Cache']['Type'] == 'LOCAL'
+            assert sorted(project['Properties']['Cache']['Modes']) == ['LOCAL_CUSTOM_CACHE', 'LOCAL_DOCKER_LAYER_CACHE', 'LOCAL_SOURCE_CACHE']
+
+    def test_s3(self):
+        template, projects = self.synth_projects(cache_profile='s3', cache_expiration=7)
+        for project in projects:
+            assert project['Properties']['Cache']['Type'] == 'S3'
+        bucket = [r for r in template['Resources'].values() if r['Type'] == 'AWS::S3::Bucket'][0]
+        rule = bucket['Properties']['LifecycleConfiguration']['Rules'][0]
+        assert rule['Prefix'] == pipelines.CACHE_PREFIX and rule['ExpirationInDays'] == 7
+
+    def test_unknown(self):
+        with pytest.raises(ValueError):
+            self.synth_projects(cache_profile='nope')
+
+
+class TestSchedule:
+    def test_waves(self):
+        stack, pipe = pipeline()
+        source = cp.Artifact('source')
+        pipe.build('lib', input=source)
+        pipe.build('docs', input=source)
+        pipe.build('app', input=source, depends_on=['lib'])
+        pipe.build('e2e', input=source, depends_on=['app', 'docs'])
+        pipe.build('manual', input=source, run_order=5)
+        assert pipe.schedule() == dict(lib=1, docs=1, app=2, e2e=3)
+        assert pipe.actions['build']['e2e'].action_properties.run_order == 3
+        assert pipe.actions['build']['manual'].action_properties.run_order == 5
+
+    def test_cycle(self):
+        stack, pipe = pipeline()
+        source, a, b = cp.Artifact('source'), cp.Artifact('a'), cp.Artifact('b')
+        pipe.build('a', input=source, extra_inputs=[b], outputs=[a])
+        pipe.build('b', input=a, outputs=[b])
+        with pytest.raises(ValueError):
+            pipe.schedule()
+
+
+class TestShards:
+    def test_shards(self):
+        stack, pipe = pipeline(share_projects=True)
+        source = cp.Artifact('source')
+        actions, outputs = pipe.build('tests', input=source, shards=4, merge_shards=True)
+        assert len(actions) == 5
+        assert [a.action_properties.action_name for a in actions] == ['tests-0', 'tests-1', 'tests-2', 'tests-3', 'tests']
+        assert len(projects(stack)) == 2
+        assert pipe.schedule() == {'tests-0': 1, 'tests-1': 1, 'tests-2': 1, 'tests-3': 1, 'tests': 2}
+        assert pipe.artifacts['build']['tests'] == outputs
+
+    def test_shards_no_merge(self):
+        stack, pipe = pipeline()
+        actions, outputs = pipe.build('tests', input=cp.Artifact('source'), shards=3)
+        assert len(actions) == 3 and len(outputs) == 3
+
+    def test_shards_outputs(self):
+        app = core.App()
+        stack = core.Stack(app, 'stack')
+        pipe = pipelines.Pipeline(stack, 'pipe', connections=dict())
+        _, source = pipe.github_source('aviv-group', 'repo', connection_arn='arn:aws:codestar-connections:eu-west-1:123456789012:connection/x')
+        merged = cp.Artifact('merged')
+        actions, outputs = pipe.build('tests', input=source, shards=2, merge_shards=True, outputs=[merged], variables_namespace='tests')
+        assert outputs == [merged]
+
+        reports = [cp.Artifact('report0'), cp.Artifact('report1')]
+        actions, outputs = pipe.build('lint', input=source, shards=2, outputs=reports, variables_namespace='lint')
+        assert outputs == reports
+        with pytest.raises(ValueError):
+            pipe.build('docs', input=source, shards=2, outputs=[merged])
+
+        pipe.stage_all()
+        template = app.synth().get_stack_by_name('stack').template
+        pipeline_props = [r['Properties'] for r in template['Resources'].values() if r['Type'] == 'AWS::CodePipeline::Pipeline'][0]
+        namespaces = dict((a['Name'], a.get('Namespace')) for stage in pipeline_props['Stages'] for a in stage['Actions'])
+        assert namespaces['tests-0'] is None and namespaces['tests-1'] is None
+        assert namespaces['tests'] == 'tests'
+        assert namespaces['lint-0'] == 'lint0' and namespaces['lint-1'] == 'lint1'
+
+
+class TestBatch:
+    def test_batch_buildspec(self, tmpdir):
+        spec = tmpdir.join('buildspec.yml')
+        spec.write("version: 0.2\nbatch:\n  build-matrix:\n    dynamic:\n      env:\n        variables:\n          PYTHON: ['3.7', '3.8']\nphases:\n  build:\n    commands:\n      - tox\n")
+        app = core.App()
+        stack = core.Stack(app, 'stack')
+        pipe = pipelines.Pipeline(stack, 'pipe', connections=dict())
+        _, source = pipe.github_source('aviv-group', 'repo', connection_arn='arn:aws:codestar-connections:eu-west-1:123456789012:connection/x')
+        pipe.build('matrix', input=source, build_spec_file=str(spec))
+        pipe.build('single', input=source)
+        pipe.stage_all()
+        template = app.synth().get_stack_by_name('stack').template
+
+        projects = [r['Properties'] for r in template['Resources'].values() if r['Type'] == 'AWS::CodeBuild::Project']
+        assert len([p for p in projects if 'BuildBatchConfig' in p]) == 1
+        policies = json.dumps([r for r in template['Resources'].values() if r['Type'] == 'AWS::IAM::Policy'])
+        assert 'codebuild:StartBuildBatch' in policies
+
+    def test_no_batch(self):
+        stack, pipe = pipeline()
+        pipe.build('single', input=cp.Artifact('source'))
+        assert not pipe._batch_projects
+
+
+class TestComputeSizing:
+    def test_sized_projects(self):
+        from aviv_cdk import build_sizing
+        history = os.path.join(os.path.dirname(__file__), 'fixtures', 'build-history.json')
+        stack, pipe = pipeline(compute_sizer=build_sizing.ComputeSizer(history, target=600))
+        source = cp.Artifact('source')
+        pipe.build('lint', input=source)
+        pipe.build('tests', input=source)
+        pipe.build('other', input=source)
+        assert len(projects(stack)) == 3
+        assert set(pipe.compute_sizer.report()) == {'lint', 'tests'}
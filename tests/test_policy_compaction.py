@@ -0,0 +1,120 @@
+import random
+import itertools
+from aviv_cdk import policy_compaction as pc
+
+# Property checks: random policies over a small universe, every request of the
+# universe must get the same decision from the original and compacted policies
+CATALOG = {
+    's3': ['GetObject', 'GetObjectAcl', 'GetBucketPolicy', 'PutObject', 'PutBucketPolicy', 'ListBucket', 'DeleteObject'],
+    'sqs': ['SendMessage', 'ReceiveMessage', 'DeleteMessage', 'GetQueueUrl', 'GetQueueAttributes'],
+}
+ACTIONS = [f"{service}:{name}" for service, names in CATALOG.items() for name in names]
+ACTION_PATTERNS = ACTIONS + ['s3:Get*', 's3:*Object', 'sqs:*', 's3:Get?bject', 'S3:getobject', 's3:Put*', '*']
+QUEUE = {'Fn::GetAtt': ['Queue', 'Arn']}
+RESOURCES = ['arn:aws:s3:::b1', 'arn:aws:s3:::b1/k1', 'arn:aws:s3:::b2/k2', 'arn:aws:sqs:eu-west-1:1:q1', QUEUE]
+RESOURCE_PATTERNS = RESOURCES + ['arn:aws:s3:::b1*', 'arn:aws:s3:::*/k?', '*']
+CONDITIONS = [None, {'Bool': {'aws:SecureTransport': 'true'}}, {'StringEquals': {'aws:RequestedRegion': 'eu-west-1'}}]
+PRINCIPALS = [{'AWS': 'arn:aws:iam::1:root'}, {'AWS': ['arn:aws:iam::2:root', 'arn:aws:iam::1:root']}, {'Service': 'lambda.amazonaws.com'}, '*']
+CALLERS = [('AWS', 'arn:aws:iam::1:root'), ('AWS', 'arn:aws:iam::2:root'), ('Service', 'lambda.amazonaws.com')]
+
+
+def _matches(patterns, value, ignore_case=False) -> bool:
+    return any(p == '*' or pc.match(p, value, ignore_case) for p in pc._list(patterns))
+
+
+def applies(statement: dict, action: str, resource, context: set, caller: tuple) -> bool:
+    if 'Action' in statement and not _matches(statement['Action'], action, True):
+        return False
+    if 'NotAction' in statement and _matches(statement['NotAction'], action, True):
+        return False
+    if 'Resource' in statement and not _matches(statement['Resource'], resource):
+        return False
+    if statement.get('Condition') and pc._key(statement['Condition']) not in context:
+        return False
+    principal = statement.get('Principal')
+    if principal is not None and principal != '*' and caller[1] not in pc._list(principal.get(caller[0])):
+        return False
+    return True
+
+
+def decision(statements: list, *request) -> str:
+    matched = [s['Effect'] for s in statements if applies(s, *request)]
+    return 'Deny' if 'Deny' in matched else 'Allow' if matched else 'ImplicitDeny'
+
+
+def random_document(rnd: random.Random, principals: bool=False) -> dict:
+    statements = list()
+    for _ in range(rnd.randint(1, 8)):
+        statement = {'Effect': 'Deny' if rnd.random() < 0.2 else 'Allow'}
+        actions = rnd.sample(ACTION_PATTERNS, rnd.randint(1, 4))
+        statement['NotAction' if rnd.random() < 0.1 else 'Action'] = actions[0] if len(actions) == 1 else actions
+        statement['Resource'] = rnd.sample(RESOURCE_PATTERNS, rnd.randint(1, 3))
+        condition = rnd.choice(CONDITIONS)
+        if condition:
+            statement['Condition'] = condition
+        if principals:
+            statement['Principal'] = rnd.choice(PRINCIPALS)
+        if rnd.random() < 0.1:
+            statement['Sid'] = f"S{len(statements)}"
+        statements.append(statement)
+    return {'Version': '2012-10-17', 'Statement': statements}
+
+
+def requests(principals: bool=False):
+    contexts = [set()] + [{pc._key(c)} for c in CONDITIONS if c] + [set(pc._key(c) for c in CONDITIONS if c)]
+    return itertools.product(ACTIONS, RESOURCES, contexts, CALLERS if principals else [None])
+
+
+def assert_same_permissions(original: dict, statements: list, principals: bool=False):
+    for request in requests(principals):
+        assert decision(original['Statement'], *request) == decision(statements, *request), (request, original, statements)
+
+
+class TestPolicyCompaction:
+    def test_compact(self):
+        doc = {'Version': '2012-10-17', 'Statement': [
+            {'Effect': 'Allow', 'Action': ['s3:GetObject', 's3:getobject'], 'Resource': 'arn:aws:s3:::b1/*'},
+            {'Effect': 'Allow', 'Action': 's3:PutObject', 'Resource': ['arn:aws:s3:::b1/*', 'arn:aws:s3:::b1/k1']},
+            {'Effect': 'Allow', 'Action': ['s3:PutObject', 's3:GetObject'], 'Resource': 'arn:aws:s3:::b2/*'},
+        ]}
+        assert pc.compact(doc)['Statement'] == [
+            {'Effect': 'Allow', 'Action': ['s3:GetObject', 's3:PutObject'], 'Resource': ['arn:aws:s3:::b1/*', 'arn:aws:s3:::b2/*']}
+        ]
+        assert pc.compact(doc, CATALOG)['Statement'][0]['Action'] == ['s3:GetObject', 's3:PutObject']
+        catalog = dict(s3=['GetObject', 'GetObjectAcl', 'PutObject'])
+        assert pc.compact(doc, catalog)['Statement'][0]['Action'] == ['s3:GetObject', 's3:PutObject']
+        doc['Statement'][0]['Action'].append('s3:GetObjectAcl')
+        assert pc.compact(doc, catalog)['Statement'][0]['Action'] == 's3:*'
+
+    def test_same_permissions(self):
+        rnd = random.Random(42)
+        for _ in range(150):
+            doc = random_document(rnd)
+            assert_same_permissions(doc, pc.compact(doc)['Statement'])
+            compacted = pc.compact(doc, CATALOG)
+            assert_same_permissions(doc, compacted['Statement'])
+            assert pc.size(compacted) <= pc.size(doc)
+
+    def test_same_principals(self):
+        rnd = random.Random(7)
+        for _ in range(100):
+            doc = random_document(rnd, principals=True)
+            assert_same_permissions(doc, pc.compact(doc)['Statement'], principals=True)
+
+    def test_split(self):
+        rnd = random.Random(1)
+        for _ in range(100):
+            doc = random_document(rnd)
+            limit = rnd.randint(300, 800)
+            parts = pc.split(doc, limit)
+            assert all(pc.size(part) <= limit for part in parts)
+            assert_same_permissions(doc, [s for part in parts for s in part['Statement']])
+
+    def test_take(self):
+        rnd = random.Random(3)
+        for _ in range(100):
+            doc = random_document(rnd)
+            limit = rnd.randint(300, 800)
+            head, rest = pc.take(doc, limit)
+            assert head['Statement'] and (pc.size(head) <= limit or len(head['Statement']) == 1)
+            assert_same_permissions(doc, head['Statement'] + (rest['Statement'] if rest else []))
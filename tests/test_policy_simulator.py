@@ -0,0 +1,134 @@
+import os
+import json
+import time
+import pytest
+from aviv_cdk.policy_simulator import PolicySimulator, conditions_match, ALLOW, DENY, IMPLICIT_DENY
+
+ROLES = 300
+# Wall-clock timings are machine dependent, only measured with AVIV_CDK_BENCHMARKS=1
+BENCHMARKS = os.environ.get('AVIV_CDK_BENCHMARKS', '') not in ('', '0')
+PARTITION_ARN = {'Fn::Join': ['', ['arn:', {'Ref': 'AWS::Partition'}, ':s3:::assets/*']]}
+
+
+def template(roles: int=1) -> dict:
+    resources = {
+        'Bucket': {'Type': 'AWS::S3::Bucket'},
+        'Boundary': {'Type': 'AWS::IAM::ManagedPolicy', 'Properties': {'PolicyDocument': {'Statement': [
+            {'Effect': 'Allow', 'NotAction': 'iam:*', 'Resource': '*'}
+        ]}}},
+    }
+    for i in range(roles):
+        resources[f"role{i}"] = {
+            'Type': 'AWS::IAM::Role',
+            'Properties': {
+                'RoleName': f"role-{i}",
+                'ManagedPolicyArns': [{'Fn::Join': ['', ['arn:', {'Ref': 'AWS::Partition'}, ':iam::aws:policy/ReadOnlyAccess']]}],
+                'PermissionsBoundary': {'Ref': 'Boundary'},
+                'Policies': [{'PolicyName': 'inline', 'PolicyDocument': {'Statement': [
+                    {'Effect': 'Allow', 'Action': ['sqs:Send*', 'iam:PassRole'], 'Resource': '*'}
+                ]}}]
+            },
+            'Metadata': {'aws:cdk:path': f"stack/role{i}/Resource"}
+        }
+        resources[f"role{i}Policy"] = {
+            'Type': 'AWS::IAM::Policy',
+            'Properties': {
+                'Roles': [{'Ref': f"role{i}"}],
+                'PolicyDocument': {'Statement': [
+                    {'Effect': 'Allow', 'Action': ['s3:GetObject', 's3:PutObject'], 'Resource': [PARTITION_ARN, {'Fn::Join': ['', [{'Fn::GetAtt': ['Bucket', 'Arn']}, '/*']]}]},
+                    {'Effect': 'Deny', 'Action': 's3:PutObject', 'Resource': 'arn:aws:s3:::assets/locked/*'},
+                    {'Effect': 'Allow', 'Action': 'kms:Decrypt', 'Resource': '*', 'Condition': {'StringEquals': {'kms:ViaService': 's3.us-east-1.amazonaws.com'}}},
+                ] + [{'Effect': 'Allow', 'Action': 'dynamodb:Query', 'Resource': f"arn:aws:dynamodb:us-east-1:123456789012:table/t{j}"} for j in range(20)]}
+            }
+        }
+    return {'Resources': resources}
+
+
+def cloud_assembly(tmpdir, roles: int=1) -> str:
+    outdir = tmpdir.join('cdk.out')
+    outdir.join('stack.template.json').write(json.dumps(template(roles)), ensure=True)
+    outdir.join('manifest.json').write(json.dumps({'artifacts': {
+        'stack': {'type': 'aws:cloudformation:stack', 'properties': {'templateFile': 'stack.template.json'}}
+    }}))
+    return str(outdir)
+
+
+class TestPolicySimulator:
+    def test_simulate(self, tmpdir):
+        sim = PolicySimulator.from_cloud_assembly(cloud_assembly(tmpdir), substitutions={'Bucket.Arn': 'arn:aws:s3:::data'})
+        assert sim.principals['stack/role0'] is sim.principals['role-0']
+        assert sim.simulate('role-0', 's3:GetObject', 'arn:aws:s3:::assets/a') == ALLOW
+        assert sim.simulate('role-0', 's3:GetObject', 'arn:aws:s3:::data/a') == ALLOW
+        assert sim.simulate('role-0', 'S3:getobject', 'arn:aws:s3:::other/a') == IMPLICIT_DENY
+        assert sim.simulate('role-0', 's3:PutObject', 'arn:aws:s3:::assets/locked/a') == DENY
+        assert sim.simulate('role-0', 'sqs:SendMessage') == ALLOW
+        # Permissions boundary
+        assert sim.simulate('role-0', 'iam:PassRole') == IMPLICIT_DENY
+        # Conditions
+        assert sim.simulate('role-0', 'kms:Decrypt', context={'kms:ViaService': 's3.us-east-1.amazonaws.com'}) == ALLOW
+        assert sim.simulate('role-0', 'kms:Decrypt') == IMPLICIT_DENY
+        # AWS managed policies need their document
+        assert sim.unknown_policies == {'arn:aws:iam::aws:policy/ReadOnlyAccess'}
+        assert sim.simulate('role-0', 'ec2:DescribeInstances') == IMPLICIT_DENY
+        readonly = {'Statement': [{'Effect': 'Allow', 'Action': ['ec2:Describe*'], 'Resource': '*'}]}
+        sim = PolicySimulator.from_cloud_assembly(cloud_assembly(tmpdir), managed_policies={'ReadOnlyAccess': readonly})
+        assert sim.simulate('role-0', 'ec2:DescribeInstances') == ALLOW
+
+    def test_check(self, tmpdir):
+        sim = PolicySimulator.from_cloud_assembly(cloud_assembly(tmpdir))
+        expectations = [
+            {'principal': 'role-0', 'action': 'sqs:SendMessage', 'expect': 'Allow'},
+            {'principal': 'role-0', 'action': 'iam:PassRole', 'expect': 'Denied'},
+            {'principal': 'role-0', 'action': 'iam:CreateUser', 'expect': 'Allow'},
+        ]
+        assert sim.check(expectations) == [dict(expectations[2], decision=IMPLICIT_DENY)]
+
+    def test_throughput(self, tmpdir):
+        sim = PolicySimulator.from_cloud_assembly(cloud_assembly(tmpdir, ROLES))
+        queries = [(f"role-{i % ROLES}", 'dynamodb:Query', f"arn:aws:dynamodb:us-east-1:123456789012:table/t{i % 30}") for i in range(10000)] + \
+                  [(f"role-{i % ROLES}", 's3:PutObject', f"arn:aws:s3:::assets/{'locked/' if i % 2 else ''}k{i}") for i in range(10000)]
+        decisions = sim.simulate_many(queries)
+        assert decisions.count(ALLOW) == sum(1 for i in range(10000) if i % 30 < 20) + 5000
+
+    @pytest.mark.skipif(not BENCHMARKS, reason='set AVIV_CDK_BENCHMARKS=1 to run the benchmarks')
+    def test_bench_throughput(self, tmpdir, record_property):
+        outdir = cloud_assembly(tmpdir, ROLES)
+        start = time.perf_counter()
+        sim = PolicySimulator.from_cloud_assembly(outdir)
+        load = time.perf_counter() - start
+        queries = [(f"role-{i % ROLES}", 'dynamodb:Query', f"arn:aws:dynamodb:us-east-1:123456789012:table/t{i % 30}") for i in range(10000)] + \
+                  [(f"role-{i % ROLES}", 's3:PutObject', f"arn:aws:s3:::assets/{'locked/' if i % 2 else ''}k{i}") for i in range(10000)]
+        start = time.perf_counter()
+        sim.simulate_many(queries)
+        elapsed = time.perf_counter() - start
+        record_property('load_ms', round(load * 1000, 1))
+        record_property('queries_per_s', round(len(queries) / elapsed))
+        print(f"\n{ROLES} roles loaded in {load:.2f}s, {len(queries) / elapsed:.0f} queries/s")
+        assert len(queries) / elapsed > 1000
+
+    def test_conditions(self):
+        assert conditions_match({'ForAllValues:StringNotEquals': {'aws:TagKeys': ['secret', 'admin']}}, {'aws:TagKeys': ['env', 'team']})
+        assert not conditions_match({'ForAllValues:StringNotEquals': {'aws:TagKeys': ['secret', 'admin']}}, {'aws:TagKeys': ['env', 'secret']})
+        assert conditions_match({'ForAnyValue:StringNotEquals': {'aws:TagKeys': ['secret']}}, {'aws:TagKeys': ['env', 'secret']})
+        assert not conditions_match({'ForAnyValue:StringNotEquals': {'aws:TagKeys': ['secret']}}, {'aws:TagKeys': ['secret']})
+        assert conditions_match({'StringNotEquals': {'aws:RequestedRegion': ['eu-west-1', 'eu-west-3']}}, {'aws:RequestedRegion': 'us-east-1'})
+        assert not conditions_match({'StringNotEquals': {'aws:RequestedRegion': ['eu-west-1', 'eu-west-3']}}, {'aws:RequestedRegion': 'eu-west-1'})
+        # Missing key: ForAllValues holds whatever the operator, ForAnyValue doesn't
+        assert conditions_match({'ForAllValues:StringEquals': {'aws:TagKeys': ['env', 'team']}}, dict())
+        assert conditions_match({'ForAllValues:StringNotEquals': {'aws:TagKeys': ['secret']}}, dict())
+        assert not conditions_match({'ForAnyValue:StringEquals': {'aws:TagKeys': ['env']}}, dict())
+        assert not conditions_match({'ForAnyValue:StringNotEquals': {'aws:TagKeys': ['secret']}}, dict())
+        assert conditions_match({'StringNotEquals': {'aws:RequestedRegion': 'eu-west-1'}}, dict())
+
+    def test_boundary_deny(self, tmpdir):
+        outdir = cloud_assembly(tmpdir)
+        filename = os.path.join(outdir, 'stack.template.json')
+        with open(filename) as fp:
+            stack = json.load(fp)
+        stack['Resources']['Boundary']['Properties']['PolicyDocument']['Statement'].append({'Effect': 'Deny', 'Action': 'ec2:*', 'Resource': '*'})
+        with open(filename, 'w') as fp:
+            json.dump(stack, fp)
+        sim = PolicySimulator.from_cloud_assembly(outdir)
+        # Nothing allows it, the boundary explicitly denies it
+        assert sim.simulate('role-0', 'ec2:RunInstances') == DENY
+        assert sim.simulate('role-0', 'lambda:InvokeFunction') == IMPLICIT_DENY
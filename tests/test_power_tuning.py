@@ -0,0 +1,58 @@
+import sys
+import json
+from aviv_cdk import power_tuning
+
+
+HANDLER = 'import os\n\ndef handler(event, context):\n    return sum(range(event["n"])), os.environ["STAGE"]\n'
+
+
+def synthesized(tmpdir, handler: str=HANDLER) -> str:
+    asset = tmpdir.join('cdk.out', 'asset.1234')
+    asset.join('index.py').write(handler, ensure=True)
+    template = tmpdir.join('cdk.out', 'stack.template.json')
+    template.write(json.dumps({'Resources': {
+        'fnlambda1234': {
+            'Type': 'AWS::Lambda::Function',
+            'Properties': {'Handler': 'index.handler', 'Environment': {'Variables': {'STAGE': 'test', 'ARN': {'Ref': 'x'}}}},
+            'Metadata': {'aws:cdk:path': 'stack/fn/lambda/Resource', 'aws:asset:path': 'asset.1234'}
+        }
+    }}))
+    return str(template)
+
+
+class TestPowerTuning:
+    def test_load_function(self, tmpdir):
+        fn = power_tuning.load_function(synthesized(tmpdir), 'stack/fn')
+        assert fn['logical_id'] == 'fnlambda1234'
+        assert fn['environment'] == {'STAGE': 'test'}
+        assert fn['memory_size'] == 128
+        assert power_tuning.load_function(fn['template'], 'fnlambda1234')['path'] == 'stack/fn'
+
+    def test_tune(self):
+        durations = {128: 1500, 256: 800, 512: 450, 1024: 280, 1769: 200, 3008: 190}
+        assert power_tuning.tune(lambda m: durations[m], runs=3)['memory_size'] == 128
+        assert power_tuning.tune(lambda m: durations[m], runs=3, strategy='speed')['memory_size'] == 3008
+        # Out of memory below 512
+        fits = lambda m: durations[m] if m >= 512 else None
+        recommendation = power_tuning.tune(fits, runs=3)
+        assert recommendation['memory_size'] == 512
+        assert list(recommendation['results']) == [512, 1024, 1769, 3008]
+
+    def test_in_process(self, tmpdir, monkeypatch):
+        monkeypatch.chdir(tmpdir)
+        fn = power_tuning.load_function(synthesized(tmpdir), 'stack/fn')
+        invoke = power_tuning.InProcessInvoker(fn, {'n': 100000})
+        recommendation = power_tuning.tune(invoke, runs=3, strategy='balanced')
+        assert recommendation['memory_size'] in power_tuning.MEMORY_SIZES
+        power_tuning.save(fn['path'], recommendation)
+        assert power_tuning.memory_size('stack/fn') == recommendation['memory_size']
+        assert power_tuning.memory_size('stack/other') is None
+
+    def test_in_process_io_bound(self, tmpdir, monkeypatch):
+        monkeypatch.chdir(tmpdir)
+        # Waiting doesn't get faster with more CPU: the smallest size is the cheapest
+        handler = 'import time\n\ndef handler(event, context):\n    time.sleep(0.02)\n'
+        fn = power_tuning.load_function(synthesized(tmpdir, handler), 'stack/fn')
+        monkeypatch.delitem(sys.modules, 'index', raising=False)
+        recommendation = power_tuning.tune(power_tuning.InProcessInvoker(fn), runs=3)
+        assert recommendation['memory_size'] == 128
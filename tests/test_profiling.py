@@ -0,0 +1,26 @@
+import os
+import json
+import pytest
+
+pytest.importorskip('aws_cdk.core')
+from aws_cdk import aws_ssm
+from aviv_cdk import core, profiling
+
+
+class TestProfiling:
+    def test_disabled(self, monkeypatch):
+        monkeypatch.delenv(profiling.PROFILE_ENV, raising=False)
+        assert not core.App().profiler
+
+    def test_report(self, tmpdir):
+        app = core.App(context={profiling.PROFILE_CONTEXT: 'true'}, outdir=str(tmpdir.join('cdk.out')))
+        stack = core.Stack(app, 'stack')
+        aws_ssm.StringParameter(stack, 'param', string_value='value')
+        app.synth()
+
+        with open(tmpdir.join('cdk.profile.json')) as fp:
+            report = json.load(fp)
+        assert 'stack' in report['stacks']
+        assert [c for c in report['constructs'] if c['path'] == 'stack/param']
+        assert report['jsii']['calls'] > 0
+        assert os.path.exists(tmpdir.join('cdk.profile.folded'))
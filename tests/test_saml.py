@@ -0,0 +1,325 @@
+import os
+import sys
+import gzip
+import json
+import time
+import subprocess
+import threading
+import importlib.util
+import http.server
+import urllib.parse
+import pytest
+
+pytest.importorskip('boto3')
+pytest.importorskip('cfn_resource_provider')
+SAML = os.path.join(os.path.dirname(__file__), '..', 'lambdas', 'iam_idp', 'saml.py')
+spec = importlib.util.spec_from_file_location('saml', SAML)
+saml = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(saml)
+
+# IAM requires 1000 characters at least
+METADATA = '<EntityDescriptor entityID="https://idp.example.com"><IDPSSODescriptor><KeyDescriptor use="signing">' \
+    '<X509Certificate>{}</X509Certificate></KeyDescriptor></IDPSSODescriptor></EntityDescriptor>'.format('MIIC' * 250)
+
+
+IAM_RESPONSE = '<{action}Response xmlns="https://iam.amazonaws.com/doc/2010-05-08/"><{action}Result>{result}</{action}Result>' \
+    '<ResponseMetadata><RequestId>bench</RequestId></ResponseMetadata></{action}Response>'
+IAM_ERROR = '<ErrorResponse xmlns="https://iam.amazonaws.com/doc/2010-05-08/"><Error><Type>Sender</Type><Code>{code}</Code>' \
+    '<Message>{code}</Message></Error><RequestId>bench</RequestId></ErrorResponse>'
+
+
+class IdP(http.server.BaseHTTPRequestHandler):
+    """SAML metadata endpoint (ETag support, scripted failures), stub IAM endpoint and CloudFormation response URL"""
+    metadata = METADATA
+    # Statuses answered before the metadata, 'slow' sleeps past the read timeout
+    failures = list()
+    requests = list()
+    responses = list()
+    iam = list()
+    # IAM stub providers: name -> tags
+    providers = dict()
+
+    def do_GET(self):
+        if self.path.startswith('/bucket/'):
+            # S3 object (path style)
+            body = gzip.compress(IdP.metadata.encode('utf8'))
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        IdP.requests.append(dict(self.headers))
+        if self.path == '/redirect':
+            self.send_response(302)
+            self.send_header('Location', '/metadata')
+            self.end_headers()
+            return
+        if IdP.failures:
+            failure = IdP.failures.pop(0)
+            if failure == 'slow':
+                time.sleep(0.5)
+            else:
+                self.send_response(failure)
+                self.end_headers()
+                return
+        etag = '"{}"'.format(saml.digest(IdP.metadata)[:16])
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = IdP.metadata.encode('utf8')
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'application/samlmetadata+xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        query = urllib.parse.parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode('utf8'))
+        action = query['Action'][0]
+        IdP.iam.append((action, query.get('Name', query.get('SAMLProviderArn'))[0]))
+        name = query['Name'][0] if 'Name' in query else query['SAMLProviderArn'][0].split('/')[-1]
+        status, result = 200, ''
+        if action == 'GetSAMLProvider':
+            result = f"<SAMLMetadataDocument>{IdP.metadata.replace('<', '&lt;')}</SAMLMetadataDocument>"
+        elif action == 'CreateSAMLProvider' and name in IdP.providers:
+            status = 409
+        elif action == 'CreateSAMLProvider':
+            IdP.providers[name] = dict((query[key][0], query[key.replace('.Key', '.Value')][0]) for key in query if key.startswith('Tags.member.') and key.endswith('.Key'))
+            result = f"<SAMLProviderArn>arn:aws:iam::123456789012:saml-provider/{name}</SAMLProviderArn>"
+        elif action == 'ListSAMLProviderTags' and name not in IdP.providers:
+            status = 404
+        elif action == 'ListSAMLProviderTags':
+            result = '<Tags>{}</Tags><IsTruncated>false</IsTruncated>'.format(''.join(f"<member><Key>{k}</Key><Value>{v}</Value></member>" for k, v in IdP.providers[name].items()))
+        elif action == 'DeleteSAMLProvider':
+            IdP.providers.pop(name, None)
+        else:
+            result = f"<SAMLProviderArn>{query['SAMLProviderArn'][0]}</SAMLProviderArn>"
+        if status == 200:
+            body = IAM_RESPONSE.format(action=action, result=result).encode('utf8')
+        else:
+            body = IAM_ERROR.format(code='EntityAlreadyExists' if status == 409 else 'NoSuchEntity').encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_PUT(self):
+        IdP.responses.append(json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def idp(monkeypatch):
+    IdP.metadata, IdP.failures, IdP.requests, IdP.responses, IdP.iam, IdP.providers = METADATA, list(), list(), list(), list(), dict()
+    monkeypatch.setattr(saml, '_metadata_cache', dict())
+    monkeypatch.setattr(saml, 'BACKOFF', 0.01)
+    monkeypatch.setattr(saml, 'READ_TIMEOUT', 0.2)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), IdP)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+class FakeIAM:
+    def __init__(self, metadata) -> None:
+        self.metadata = metadata
+        self.updates = 0
+
+    def get_saml_provider(self, SAMLProviderArn):
+        return dict(SAMLMetadataDocument=self.metadata)
+
+    def update_saml_provider(self, SAMLProviderArn, SAMLMetadataDocument):
+        self.metadata = SAMLMetadataDocument
+        self.updates += 1
+        return dict(SAMLProviderArn=SAMLProviderArn)
+
+
+class TestFetchMetadata:
+    def test_conditional_request(self, idp):
+        assert saml.fetch_metadata(idp + '/metadata') == METADATA
+        assert 'If-None-Match' not in IdP.requests[-1]
+        # Cached: 304 answered with the cached document
+        assert saml.fetch_metadata(idp + '/metadata') == METADATA
+        assert IdP.requests[-1]['If-None-Match']
+
+        IdP.metadata = METADATA.replace('idp.example.com', 'idp2.example.com')
+        assert saml.fetch_metadata(idp + '/metadata') == IdP.metadata
+        assert len(IdP.requests) == 3
+
+    def test_retries(self, idp):
+        IdP.failures = [503, 'slow']
+        assert saml.fetch_metadata(idp + '/metadata') == METADATA
+        assert len(IdP.requests) == 3
+
+    def test_errors(self, idp):
+        IdP.failures = [404]
+        with pytest.raises(saml.FetchError, match='404'):
+            saml.fetch_metadata(idp + '/metadata')
+        assert len(IdP.requests) == 1
+
+        IdP.failures = [500] * saml.RETRIES
+        with pytest.raises(saml.FetchError, match='500'):
+            saml.fetch_metadata(idp + '/metadata')
+
+        # No time left for a retry
+        IdP.failures = [500]
+        with pytest.raises(saml.FetchError):
+            saml.fetch_metadata(idp + '/metadata', deadline=time.time())
+
+    def test_redirect(self, idp):
+        assert saml.fetch_metadata(idp + '/redirect') == METADATA
+
+
+class TestUpdateProvider:
+    def test_unchanged(self, idp):
+        iam = FakeIAM(METADATA)
+        arn = 'arn:aws:iam::123456789012:saml-provider/idp'
+        assert not saml.update_provider(iam, arn, saml.fetch_metadata(idp + '/metadata'))
+        assert not saml.update_provider(iam, arn, saml.fetch_metadata(idp + '/metadata'))
+        assert iam.updates == 0
+
+        IdP.metadata = METADATA.replace('idp.example.com', 'idp2.example.com')
+        assert saml.update_provider(iam, arn, saml.fetch_metadata(idp + '/metadata'))
+        assert iam.updates == 1 and iam.metadata == IdP.metadata
+
+
+class TestResolveMetadata:
+    def test_inline(self):
+        assert saml.resolve_metadata(dict(Name='idp', Metadata=METADATA, MetadataHash=saml.digest(METADATA))) == METADATA
+        with pytest.raises(saml.FetchError, match='digest'):
+            saml.resolve_metadata(dict(Name='idp', Metadata=METADATA, MetadataHash=saml.digest('other')))
+
+    def test_s3(self, idp, monkeypatch):
+        import boto3
+        from botocore.config import Config
+        monkeypatch.setattr(saml, '_s3', boto3.client('s3', endpoint_url=idp, region_name='us-east-1', aws_access_key_id='test', aws_secret_access_key='test', config=Config(s3=dict(addressing_style='path'))))
+        properties = dict(Name='idp', MetadataS3=dict(Bucket='bucket', Key='metadata.xml.gz'), MetadataHash=saml.digest(METADATA))
+        assert saml.resolve_metadata(properties) == METADATA
+        # Nothing fetched from the IdP
+        assert IdP.requests == []
+
+
+class Context:
+    def get_remaining_time_in_millis(self):
+        return 20000
+
+
+def request(idp: str, request_type: str, properties: dict, old_properties: dict=None, **kwargs) -> dict:
+    request = dict(
+        RequestType=request_type, ResponseURL=idp + '/response', StackId='arn:aws:cloudformation:us-east-1:123456789012:stack/idp/1',
+        RequestId='test', LogicalResourceId='identityProviders', ResourceProperties=dict(ServiceToken='arn:aws:lambda:us-east-1:123456789012:function:saml', **properties), **kwargs
+    )
+    if old_properties is not None:
+        request['OldResourceProperties'] = dict(ServiceToken=request['ResourceProperties']['ServiceToken'], **old_properties)
+    return request
+
+
+class TestSAMLProviders:
+    def test_lifecycle(self, idp, monkeypatch):
+        import boto3
+        monkeypatch.setattr(saml, '_iam', boto3.client('iam', endpoint_url=idp, region_name='us-east-1', aws_access_key_id='test', aws_secret_access_key='test'))
+        providers = dict(Providers=[dict(Name='a', URL=idp + '/metadata?a'), dict(Name='b', URL=idp + '/metadata?b'), dict(Name='c', Metadata=METADATA)])
+        saml.handler(request(idp, 'Create', providers, ResourceType='Custom::SAMLProviders'), Context())
+        response = IdP.responses[-1]
+        assert response['Status'] == 'SUCCESS', response['Reason']
+        assert response['Data'] == dict((name, f"arn:aws:iam::123456789012:saml-provider/{name}") for name in 'abc')
+        assert sorted(IdP.iam) == [('CreateSAMLProvider', name) for name in 'abc']
+        assert len(IdP.requests) == 2
+
+        # a and b unchanged, c replaced by d
+        IdP.iam.clear()
+        updated = dict(Providers=providers['Providers'][:2] + [dict(Name='d', URL=idp + '/metadata?d')])
+        saml.handler(request(idp, 'Update', updated, providers, ResourceType='Custom::SAMLProviders', PhysicalResourceId=response['PhysicalResourceId']), Context())
+        assert IdP.responses[-1]['Status'] == 'SUCCESS', IdP.responses[-1]['Reason']
+        assert sorted(IdP.iam) == [
+            ('CreateSAMLProvider', 'd'),
+            ('DeleteSAMLProvider', 'arn:aws:iam::123456789012:saml-provider/c'),
+            ('GetSAMLProvider', 'arn:aws:iam::123456789012:saml-provider/a'),
+            ('GetSAMLProvider', 'arn:aws:iam::123456789012:saml-provider/b'),
+            ('ListSAMLProviderTags', 'arn:aws:iam::123456789012:saml-provider/c'),
+        ]
+
+        IdP.iam.clear()
+        saml.handler(request(idp, 'Delete', updated, ResourceType='Custom::SAMLProviders', PhysicalResourceId=response['PhysicalResourceId']), Context())
+        assert IdP.responses[-1]['Status'] == 'SUCCESS'
+        assert sorted(name for action, name in IdP.iam if action == 'DeleteSAMLProvider') == [f"arn:aws:iam::123456789012:saml-provider/{name}" for name in 'abd']
+
+    def test_existing_providers(self, idp, monkeypatch):
+        import boto3
+        monkeypatch.setattr(saml, '_iam', boto3.client('iam', endpoint_url=idp, region_name='us-east-1', aws_access_key_id='test', aws_secret_access_key='test'))
+        # Created out of the stack, or by another resource
+        IdP.providers = dict(a=dict(), b={saml.OWNER_TAG: 'other'})
+        providers = dict(Providers=[dict(Name=name, Metadata=METADATA) for name in 'abc'])
+        saml.handler(request(idp, 'Create', providers, ResourceType='Custom::SAMLProviders'), Context())
+        response = IdP.responses[-1]
+        assert response['Status'] == 'SUCCESS', response['Reason']
+        assert ('GetSAMLProvider', 'arn:aws:iam::123456789012:saml-provider/a') in IdP.iam
+        assert sorted(IdP.providers) == ['a', 'b', 'c']
+
+        # A rollback or a stack delete only deletes c
+        saml.handler(request(idp, 'Delete', providers, ResourceType='Custom::SAMLProviders', PhysicalResourceId=response['PhysicalResourceId']), Context())
+        assert IdP.responses[-1]['Status'] == 'SUCCESS'
+        assert sorted(IdP.providers) == ['a', 'b']
+
+    def test_fetch_error(self, idp, monkeypatch):
+        monkeypatch.setattr(saml, '_iam', object())
+        IdP.failures = [404]
+        providers = dict(Providers=[dict(Name='a', URL=idp + '/metadata')])
+        saml.handler(request(idp, 'Create', providers, ResourceType='Custom::SAMLProviders'), Context())
+        assert IdP.responses[-1]['Status'] == 'FAILED' and '404' in IdP.responses[-1]['Reason']
+
+
+BENCH = """
+import sys, json, time, importlib.util
+
+class Context:
+    def get_remaining_time_in_millis(self):
+        return 20000
+
+def invoke():
+    start = time.perf_counter()
+    saml.handler(request, Context())
+    return time.perf_counter() - start
+
+request = json.loads(sys.argv[2])
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location('saml', sys.argv[1])
+saml = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(saml)
+cold = time.perf_counter() - start + invoke()
+warm = sorted(invoke() for _ in range(20))[10]
+# Same handler with a new IAM client per invocation: the cost of the client creation
+new_client = list()
+for _ in range(20):
+    saml._iam = None
+    new_client.append(invoke())
+print(json.dumps(dict(cold=cold, warm=warm, warm_new_client=sorted(new_client)[10])))
+"""
+
+
+def test_benchmark(idp, record_property):
+    """Cold and warm update invocations against the local IAM stub, timings reported as test properties (junitxml)"""
+    arn = 'arn:aws:iam::123456789012:saml-provider/idp'
+    request = dict(
+        RequestType='Update', ResponseURL=idp + '/response', StackId='arn:aws:cloudformation:us-east-1:123456789012:stack/idp/1',
+        RequestId='bench', ResourceType='Custom::SAMLProvider', LogicalResourceId='identityProvider', PhysicalResourceId=arn,
+        ResourceProperties=dict(ServiceToken='arn:aws:lambda:us-east-1:123456789012:function:saml', Name='idp', URL=idp + '/metadata'),
+        OldResourceProperties=dict(ServiceToken='arn:aws:lambda:us-east-1:123456789012:function:saml', Name='idp', URL=idp + '/metadata')
+    )
+    env = dict(os.environ, AWS_ENDPOINT_URL=idp, AWS_ACCESS_KEY_ID='bench', AWS_SECRET_ACCESS_KEY='bench', AWS_DEFAULT_REGION='us-east-1', PYTHONPATH=os.pathsep.join(sys.path))
+    result = subprocess.run([sys.executable, '-c', BENCH, SAML, json.dumps(request)], env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    assert result.returncode == 0, result.stderr[-2000:]
+    timings = json.loads(result.stdout.splitlines()[-1])
+    for name, value in timings.items():
+        record_property(f"{name}_ms", round(value * 1000, 1))
+    assert IdP.responses and all(r['Status'] == 'SUCCESS' for r in IdP.responses)
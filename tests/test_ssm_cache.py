@@ -0,0 +1,74 @@
+import json
+import time
+import pytest
+
+pytest.importorskip('aws_cdk.core')
+from aviv_cdk import core, ssm_cache
+
+ENV = core.Environment(account='123456789012', region='eu-west-1')
+
+
+class FakeSSM:
+    def __init__(self, parameters: dict) -> None:
+        self.parameters = parameters
+        self.calls = list()
+
+    def __call__(self, names, account, region):
+        self.calls.append(names)
+        return dict((name, self.parameters[name]) for name in names if name in self.parameters)
+
+
+class TestSSMCache:
+    def test_bulk_lookup(self, tmpdir):
+        resolver = FakeSSM({'/a': 'A', '/b': 'B'})
+        cache = ssm_cache.SSMCache(str(tmpdir.join('cache.json')), resolver=resolver)
+        app = core.App()
+        app.ssm_cache = cache
+        stack = core.Stack(app, 'stack', env=ENV)
+
+        a = core.ssm_lookup(stack, '/a')
+        b = core.ssm_lookup(stack, '/b')
+        assert stack.resolve(a) == 'A' and stack.resolve(b) == 'B'
+        assert resolver.calls == [['/a', '/b']]
+
+        # Persisted: a new cache doesn't call the resolver anymore
+        cache = ssm_cache.SSMCache(str(tmpdir.join('cache.json')), resolver=resolver)
+        assert cache.lookup(stack, '/a') == 'A'
+        assert len(resolver.calls) == 1
+
+    def test_ttl(self, tmpdir):
+        filename = str(tmpdir.join('cache.json'))
+        key = ssm_cache.context_key(ENV.account, ENV.region, '/a')
+        with open(filename, 'w') as fp:
+            json.dump({key: dict(value='old', timestamp=time.time() - 120)}, fp)
+        assert ssm_cache.SSMCache(filename, ttl=3600).get(key) == 'old'
+        assert ssm_cache.SSMCache(filename, ttl=60).get(key) is None
+
+    def test_env_agnostic(self, tmpdir):
+        cache = ssm_cache.SSMCache(str(tmpdir.join('cache.json')), resolver=FakeSSM({'/a': 'A'}))
+        app = core.App()
+        app.ssm_cache = cache
+        stack = core.Stack(app, 'stack')
+        with pytest.raises(ValueError, match='account/region'):
+            core.ssm_lookup(stack, '/a')
+
+    def test_boto3_account(self, monkeypatch):
+        boto3 = pytest.importorskip('boto3')
+
+        class Client:
+            def get_caller_identity(self):
+                return dict(Account='210987654321')
+
+            def get_parameters(self, Names):
+                raise AssertionError('fetched with the credentials of another account')
+
+        class Session:
+            def __init__(self, region_name):
+                pass
+
+            def client(self, service):
+                return Client()
+
+        monkeypatch.setattr(boto3.session, 'Session', Session)
+        with pytest.raises(ValueError, match='210987654321'):
+            ssm_cache.boto3_resolver(['/a'], ENV.account, ENV.region)
@@ -0,0 +1,40 @@
+import os
+import json
+import pytest
+
+pytest.importorskip('aws_cdk.core')
+from aws_cdk import aws_ssm
+from aviv_cdk import core, synth
+
+
+def build_app(outdir: str) -> core.App:
+    app = core.App(outdir=outdir)
+    for i in range(4):
+        stack = core.Stack(app, f"stack{i}")
+        aws_ssm.StringParameter(stack, 'param', string_value=str(i))
+    app.node.find_child('stack1').add_dependency(app.node.find_child('stack0'))
+    return app
+
+
+class TestSynth:
+    def test_groups(self, tmpdir):
+        app = build_app(str(tmpdir))
+        groups = [[stack.node.id for stack in group] for group in synth.stack_groups(app)]
+        assert sorted(groups) == [['stack0', 'stack1'], ['stack2'], ['stack3']]
+
+    def test_partitions_merge(self, tmpdir):
+        outdirs = list()
+        for i in range(2):
+            outdir = str(tmpdir.join(str(i)))
+            app = build_app(outdir)
+            synth.select_partition(app, i, 2)
+            app.synth()
+            outdirs.append(outdir)
+
+        manifest = synth.merge(outdirs, str(tmpdir.join('cdk.out')))
+        stacks = [aid for aid, artifact in manifest['artifacts'].items() if artifact['type'] == 'aws:cloudformation:stack']
+        assert sorted(stacks) == ['stack0', 'stack1', 'stack2', 'stack3']
+        for stack in stacks:
+            assert os.path.exists(tmpdir.join('cdk.out', f"{stack}.template.json"))
+        with open(tmpdir.join('cdk.out', 'manifest.json')) as fp:
+            assert json.load(fp) == manifest